@@ -0,0 +1,94 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+from pandassta.df import CAT_TYPE, Df, QualityFlags
+from pandassta.sta_requests import config, get_all_data, set_dryrun_var, set_sta_url
+
+from benchmarks.frost_server import DEFAULT_TOP, MAX_TOP, FrostServer, FrostStore
+from benchmarks.synthetic import START, get_response
+from src.patch_writer import PatchWriter
+from src.streaming import get_filter_time_range
+
+
+def time_fetch(server: FrostServer, count_observations: bool) -> tuple[float, int]:
+    t0 = time.perf_counter()
+    df = get_all_data(
+        thing_id=server.store.thing_id,
+        filter_cfg=get_filter_time_range(
+            (START - pd.Timedelta("1s")).to_pydatetime(),
+            (START + pd.Timedelta("1000D")).to_pydatetime(),
+        ),
+        count_observations=count_observations,
+    )
+    return time.perf_counter() - t0, df.shape[0]
+
+
+def time_patch(
+    server: FrostServer, workers: int, batch_size: int, max_retries: int
+) -> tuple[float, int]:
+    df = server.store.observations[["@iot.id"]].rename(columns={"@iot.id": Df.IOT_ID})
+    df[Df.QC_FLAG] = pd.Categorical([QualityFlags.BAD] * df.shape[0], dtype=CAT_TYPE)
+    t0 = time.perf_counter()
+    with PatchWriter(
+        server.url + "/$batch",
+        max_workers=workers,
+        batch_size=batch_size,
+        max_retries=max_retries,
+        backoff=0.0,
+    ) as writer:
+        counter = writer.submit(df).result()
+    return time.perf_counter() - t0, counter[200]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fetch (get_all_data) and patch (PatchWriter) throughput against the local FROST stand-in"
+    )
+    parser.add_argument("--datastreams", type=int, default=6)
+    parser.add_argument("--positions", type=float, default=1e4, help="Positions (1 Hz)")
+    parser.add_argument("--default-top", type=int, default=DEFAULT_TOP)
+    parser.add_argument("--max-top", type=int, default=MAX_TOP)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per request")
+    parser.add_argument("--latency-per-item", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--batch-failure-rate", type=float, default=0.0)
+    parser.add_argument("--count", action="store_true", help="count_observations in get_all_data")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="PatchWriter workers")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--max-retries", type=int, default=3)
+    args = parser.parse_args()
+
+    store = FrostStore.from_response(get_response(args.datastreams, int(args.positions)))
+    with tempfile.TemporaryDirectory() as tmp:
+        config.filename = Path(tmp).joinpath(".staconf.ini")
+        with FrostServer(
+            store,
+            default_top=args.default_top,
+            max_top=args.max_top,
+            latency=args.latency,
+            latency_per_item=args.latency_per_item,
+            failure_rate=args.failure_rate,
+            batch_failure_rate=args.batch_failure_rate,
+        ) as server:
+            set_sta_url(server.url)
+            set_dryrun_var(False)
+
+            print(f"{'stage':>12} {'rows':>10} {'time (s)':>9} {'rows/s':>10} {'requests':>9}")
+            t, nb_rows = time_fetch(server, args.count)
+            print(
+                f"{'fetch':>12} {nb_rows:>10} {t:>9.3f} {nb_rows / t:>10.0f} {server.counts['get']:>9}"
+            )
+            for workers_i in args.workers:
+                server.counts.clear()
+                t, nb_rows = time_patch(server, workers_i, args.batch_size, args.max_retries)
+                print(
+                    f"{f'patch ({workers_i})':>12} {nb_rows:>10} {t:>9.3f} {nb_rows / t:>10.0f}"
+                    f" {server.counts['batch']:>9}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from pandassta.df import Df
+
+from src.main import limit_value_fctn
+from tests.test_qc import limit_value_fctn_loop
+
+
+def get_independent_df(nb_rows: int, nb_datastreams: int = 2, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    # flow sensor: mostly within limits, with down periods of a few minutes to an hour
+    down = np.repeat(
+        rng.random(nb_rows // 60 + 1) < 0.05, 60
+    )[:nb_rows]
+    result = np.where(down, rng.uniform(0.0, 0.1, nb_rows), rng.uniform(2.0, 5.0, nb_rows))
+    df = pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(nb_rows),
+            Df.RESULT: result,
+            Df.DATASTREAM_ID: rng.integers(0, nb_datastreams, nb_rows) + 7793,
+            Df.TIME: pd.Timestamp("2024-01-01", tz="UTC")
+            + pd.to_timedelta(np.arange(nb_rows), "s"),
+            "max_allowed_downtime": "15min",
+            "dt_stabilization": "20min",
+            "QC_range_min": 0.2,
+            "QC_range_max": 10.0,
+        }
+    )
+    return df
+
+
+def time_function(f, *args, **kwargs) -> float:
+    t0 = time.perf_counter()
+    f(*args, **kwargs)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of limit_value_fctn (vectorized vs per block loop)"
+    )
+    parser.add_argument(
+        "--sizes", type=float, nargs="+", default=[1e5, 1e6, 1e7], help="Number of rows"
+    )
+    parser.add_argument(
+        "--max-loop-rows",
+        type=float,
+        default=1e6,
+        help="Largest size for which the per block loop is timed",
+    )
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'vectorized (s)':>15} {'loop (s)':>10} {'speedup':>8}")
+    for size_i in args.sizes:
+        nb_rows = int(size_i)
+        df = get_independent_df(nb_rows)
+        columns = df.columns.tolist()
+        t_vectorized = time_function(
+            limit_value_fctn, df.sort_values(Df.TIME)[columns], groupby=Df.DATASTREAM_ID
+        )
+        t_loop = float("nan")
+        if nb_rows <= args.max_loop_rows:
+            t_loop = time_function(
+                lambda df_: df_.sort_values(Df.TIME)
+                .groupby(by=[Df.DATASTREAM_ID], group_keys=False)[columns]
+                .apply(limit_value_fctn_loop),
+                df,
+            )
+        print(
+            f"{nb_rows:>10} {t_vectorized:>15.3f} {t_loop:>10.3f} {t_loop / t_vectorized:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
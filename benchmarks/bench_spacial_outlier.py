@@ -0,0 +1,75 @@
+import argparse
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from df_qc_tools.qc import get_bool_spacial_outlier_compared_to_median
+from pandassta.df import Df
+
+from src.outlier import get_bool_spacial_outlier
+
+
+def get_track(nb_rows: int, seed: int = 0) -> gpd.GeoDataFrame:
+    rng = np.random.default_rng(seed)
+    # 1 Hz track with a few jumps and invalid (0, lat == long) positions
+    lat = 51.3 + np.cumsum(rng.normal(0.0, 1e-5, nb_rows))
+    lon = 3.0 + np.cumsum(rng.normal(0.0, 1e-5, nb_rows))
+    idx = rng.choice(nb_rows, max(nb_rows // 1000, 3), replace=False)
+    lat[idx] += rng.normal(0.0, 0.2, idx.size)
+    lat[idx[: idx.size // 3]] = 0.0
+    return gpd.GeoDataFrame(
+        {
+            Df.TIME: pd.Timestamp("2024-01-01") + pd.to_timedelta(np.arange(nb_rows), "s"),
+            Df.LAT: lat,
+            Df.LONG: lon,
+        },
+        geometry=gpd.points_from_xy(lon, lat),
+        crs="EPSG:4326",
+    )
+
+
+def time_function(f, *args, **kwargs) -> float:
+    t0 = time.perf_counter()
+    f(*args, **kwargs)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the spacial outlier check (vectorized vs df_qc_tools)"
+    )
+    parser.add_argument(
+        "--sizes", type=float, nargs="+", default=[1e4, 1e5, 1e6], help="Number of positions"
+    )
+    parser.add_argument(
+        "--max-library-rows",
+        type=float,
+        default=1e5,
+        help="Largest size for which the df_qc_tools implementation is timed",
+    )
+    parser.add_argument("--time-window", default="10min")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'vectorized (s)':>15} {'library (s)':>12} {'speedup':>8}")
+    for size_i in args.sizes:
+        nb_rows = int(size_i)
+        df = get_track(nb_rows)
+        t_vectorized = time_function(
+            get_bool_spacial_outlier, df, max_dx_dt=6.89, time_window=args.time_window
+        )
+        t_library = float("nan")
+        if nb_rows <= args.max_library_rows:
+            t_library = time_function(
+                get_bool_spacial_outlier_compared_to_median,
+                df,
+                max_dx_dt=6.89,
+                time_window=args.time_window,
+            )
+        print(
+            f"{nb_rows:>10} {t_vectorized:>15.3f} {t_library:>12.3f} {t_library / t_vectorized:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from df_qc_tools.qc import (
+    get_bool_exceed_max_acceleration,
+    get_bool_exceed_max_velocity,
+    get_bool_out_of_range,
+)
+from pandassta.df import Df, QualityFlags
+from pandassta.sta import Entities
+from pandassta.sta_requests import create_patch_json, response_datastreams_to_df
+
+from benchmarks.synthetic import ETOP_FILENAME, get_cfg, get_response, write_resources
+from src.elevation import get_bool_depth_above_threshold_grid
+from src.flags import CodedQCFlagConfig
+from src.gradient import calc_gradients
+from src.land_cache import LandCache, get_bool_natural_earth_land_cached
+from src.main import (
+    get_qc_df,
+    limit_value_fctn,
+    qc_dependent_quantities,
+    qc_dependent_stabilization,
+    run_qc,
+)
+from src.outlier import get_bool_spacial_outlier, get_dt_velocity_and_acceleration
+from src.parallel import run_per_datastream, zscore_stage
+from src.patching import keep_fetched_flags
+from src.track import Track
+
+
+class StageTimer:
+    """Wall and CPU time of the stages of one run."""
+
+    def __init__(self, **metadata):
+        self.metadata = metadata
+        self.results: list[dict] = []
+
+    @contextmanager
+    def stage(self, name: str, rows: int):
+        t0, c0 = time.perf_counter(), time.process_time()
+        yield
+        wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+        self.results.append(
+            {
+                **self.metadata,
+                "stage": name,
+                "rows": rows,
+                "wall_s": wall,
+                "cpu_s": cpu,
+                "rows_per_s": rows / wall if wall > 0 else None,
+            }
+        )
+
+
+def run_stages(timer: StageTimer, response: dict, cfg, folder: Path) -> None:
+    """The stages of `main` and `run_qc`, one by one."""
+    nb_rows = sum(len(ds_i["Observations"]) for ds_i in response["Datastreams"])
+    with timer.stage("parse", nb_rows):
+        df_all = keep_fetched_flags(response_datastreams_to_df(response))
+
+    cfg_stabilization = cfg.QC_dependent[0]
+    df_independent = df_all.loc[df_all[Df.DATASTREAM_ID] == cfg_stabilization.independent]
+    df_limit = df_independent.assign(
+        max_allowed_downtime=cfg_stabilization.max_allowed_downtime,
+        dt_stabilization=cfg_stabilization.dt_stabilization,
+        QC_range_min=cfg_stabilization.QC.range[0],
+        QC_range_max=cfg_stabilization.QC.range[1],
+    )
+    columns_limit = [
+        Df.IOT_ID, Df.RESULT, Df.DATASTREAM_ID, Df.TIME, "max_allowed_downtime",
+        "dt_stabilization", "QC_range_min", "QC_range_max",
+    ]  # fmt: skip
+    with timer.stage("limit_value_fctn", df_limit.shape[0]):
+        limit_value_fctn(df_limit.sort_values(Df.TIME)[columns_limit], groupby=Df.DATASTREAM_ID)
+    with timer.stage("dependent_stabilization", nb_rows):
+        df_all = qc_dependent_stabilization(cfg, df_all, df_independent)
+
+    with timer.stage("gradient_calc", nb_rows):
+        df_all[Df.GRADIENT] = calc_gradients(df_all)
+
+    with timer.stage("track", nb_rows):
+        track = Track(df_all, crs=cfg.location.crs)
+    nb_positions = track.df.shape[0]
+    LandCache.clear()
+    with timer.stage("location_land", nb_positions):
+        qc_flag_config_land = CodedQCFlagConfig(
+            "Intersect_ne_land_polynomial",
+            track.on_track(
+                partial(
+                    get_bool_natural_earth_land_cached,
+                    path_shp=folder.joinpath("ne_10m_land.shp"),
+                )
+            ),
+            max,
+            QualityFlags.BAD,
+            QualityFlags.NO_QUALITY_CONTROL,
+        )
+        df_all[Df.FEATURE_QC_FLAG] = qc_flag_config_land.execute(
+            df_all, column=Df.FEATURE_QC_FLAG
+        )
+    with timer.stage("location_depth", nb_positions):
+        qc_flag_config_depth = CodedQCFlagConfig(
+            "Depth_ne_land",
+            track.on_track(
+                partial(
+                    get_bool_depth_above_threshold_grid,
+                    threshold=0.0,
+                    mask_to_check=qc_flag_config_land.bool_function.bool_track,
+                    etop_file=folder.joinpath(ETOP_FILENAME),
+                )
+            ),
+            max,
+            QualityFlags.BAD,
+            QualityFlags.NO_QUALITY_CONTROL,
+            QualityFlags.NO_QUALITY_CONTROL,
+        )
+        df_all[Df.QC_FLAG] = qc_flag_config_depth.execute(df_all)
+    with timer.stage("location_spacial_outlier", nb_positions):
+        qc_flag_config_outlier = CodedQCFlagConfig(
+            "spacial_outliers",
+            bool_function=track.on_track(
+                partial(
+                    get_bool_spacial_outlier,
+                    max_dx_dt=cfg.location.max_dx_dt,
+                    time_window=cfg.location.time_window,
+                )
+            ),
+            bool_merge_function=max,
+            flag_on_true=QualityFlags.BAD,
+            flag_on_nan=QualityFlags.PROBABLY_GOOD,
+        )
+        df_all[Df.FEATURE_QC_FLAG] = qc_flag_config_outlier.execute(
+            df_all, column=Df.FEATURE_QC_FLAG
+        )
+    with timer.stage("location_velocity_acceleration", nb_positions):
+        df_track_valid = track.df.loc[~qc_flag_config_outlier.bool_function.bool_track]
+        df_dt_velocity_and_acceleration = get_dt_velocity_and_acceleration(df_track_valid)
+        get_bool_exceed_max_velocity(
+            df_track_valid,
+            max_velocity=cfg.location.max_dx_dt,
+            velocity_series=df_dt_velocity_and_acceleration["velocity"],
+            dt_series=df_dt_velocity_and_acceleration["dt"],
+        )
+        get_bool_exceed_max_acceleration(
+            df_track_valid,
+            max_acceleration=cfg.location.max_ddx_dtdt,
+            acceleration_series=df_dt_velocity_and_acceleration["acceleration"],
+            dt_series=df_dt_velocity_and_acceleration["dt"],
+        )
+
+    qc_df = get_qc_df(cfg)
+    columns_at_start = df_all.columns.tolist()
+    df_all = df_all.merge(qc_df, on=qc_df.index.name, how="left")
+    for name_i, qc_on_i, qc_type_i in [
+        ("range", Df.RESULT, "range"),
+        ("gradient", Df.RESULT, "gradient"),
+    ]:
+        with timer.stage(name_i, nb_rows):
+            df_all[Df.QC_FLAG] = CodedQCFlagConfig(
+                label=name_i,
+                bool_function=partial(get_bool_out_of_range, qc_on=qc_on_i, qc_type=qc_type_i),
+                bool_merge_function=max,
+                flag_on_true=QualityFlags.BAD,
+                flag_on_false=QualityFlags.PROBABLY_GOOD,
+                flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
+            ).execute(df_all)
+    with timer.stage("zscore", nb_rows):
+        bool_zscore = df_all[Df.QC_FLAG] <= QualityFlags.PROBABLY_GOOD
+        df_all.loc[bool_zscore, Df.ZSCORE] = run_per_datastream(
+            partial(zscore_stage, rolling_time_window=cfg.QC_global.zscore.time_window),
+            df_all.loc[bool_zscore, columns_at_start],
+            int(cfg.other.workers),
+        )
+        df_all[Df.QC_FLAG] = CodedQCFlagConfig(
+            label="zscore",
+            bool_function=partial(get_bool_out_of_range, qc_on=Df.ZSCORE, qc_type="zscore"),
+            bool_merge_function=max,
+            flag_on_true=QualityFlags.BAD,
+            flag_on_false=QualityFlags.PROBABLY_GOOD,
+            flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
+        ).execute(df_all)
+
+    with timer.stage("dependent", nb_rows):
+        for dependent_i in cfg.QC_dependent:
+            df_all[Df.QC_FLAG] = qc_dependent_quantities(
+                df_all,
+                independent=dependent_i.independent,
+                dependents=[int(i) for i in str(dependent_i.dependent).split(",")],
+                range_=tuple(dependent_i.QC.range),
+                dt_tolerance=dependent_i.dt_tolerance,
+            )
+
+    with timer.stage("patch_json", nb_rows + nb_positions):
+        create_patch_json(df=df_all.copy(), columns=[Df.IOT_ID, Df.QC_FLAG])
+        create_patch_json(
+            df=track.df[[Df.FEATURE_ID]].assign(**{Df.FEATURE_QC_FLAG: QualityFlags.BAD}),
+            columns=[Df.FEATURE_ID, Df.FEATURE_QC_FLAG],
+            url_entity=Entities.FEATURESOFINTEREST,
+        )
+
+
+def run_total(timer: StageTimer, response: dict, cfg) -> None:
+    """`run_qc` as in `main`, in the folder with the resources."""
+    df_all = keep_fetched_flags(response_datastreams_to_df(response))
+    df_independent = df_all.loc[df_all[Df.DATASTREAM_ID] == cfg.QC_dependent[0].independent]
+    with timer.stage("qc_total", df_all.shape[0]):
+        df_all = qc_dependent_stabilization(cfg, df_all, df_independent)
+        run_qc(cfg, df_all, pd.Series())
+
+
+def get_git_hash() -> str | None:
+    if os.environ.get("GIT_HASH"):
+        return os.environ["GIT_HASH"]
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_versions() -> dict:
+    import geopandas
+    import shapely
+
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "geopandas": geopandas.__version__,
+        "shapely": shapely.__version__,
+    }
+
+
+def print_results(results: list[dict], results_previous: list[dict] | None = None) -> None:
+    wall_previous = {
+        (ri["nb_datastreams"], ri["nb_positions"], ri["stage"]): ri["wall_s"]
+        for ri in results_previous or []
+    }
+    print(
+        f"{'datastreams':>11} {'positions':>10} {'stage':<31} {'rows':>10} "
+        f"{'wall (s)':>9} {'cpu (s)':>8} {'rows/s':>11} {'vs prev':>8}"
+    )
+    for ri in results:
+        wall_i = wall_previous.get((ri["nb_datastreams"], ri["nb_positions"], ri["stage"]))
+        ratio = f"{wall_i / ri['wall_s']:>8.2f}" if wall_i else f"{'':>8}"
+        print(
+            f"{ri['nb_datastreams']:>11} {ri['nb_positions']:>10} {ri['stage']:<31} "
+            f"{ri['rows']:>10} {ri['wall_s']:>9.3f} {ri['cpu_s']:>8.3f} "
+            f"{ri['rows_per_s'] or float('nan'):>11.0f} {ratio}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the QC stages on synthetic ship data"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=float,
+        nargs="+",
+        default=[1e4, 1e5],
+        help="Number of positions (1 Hz) observed by each datastream",
+    )
+    parser.add_argument("--datastreams", type=int, default=6, help="Number of datastreams")
+    parser.add_argument("--outliers", type=float, default=1e-3, help="Fraction of spacial outliers")
+    parser.add_argument("--land", type=float, default=0.02, help="Fraction of the track on land")
+    parser.add_argument("--workers", type=int, default=1, help="other.workers")
+    parser.add_argument(
+        "--stage-threads", type=int, default=1, help="other.stage_threads (run_qc)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Runs per size, the fastest is kept"
+    )
+    parser.add_argument(
+        "--no-total", action="store_true", help="Don't time run_qc as a whole"
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=Path("bench_stages.json"),
+        help="Results file (JSON)",
+    )
+    parser.add_argument(
+        "--compare", type=Path, default=None, help="Results file of a previous release"
+    )
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        folder = write_resources(Path(tmp_dir).joinpath("resources"), args.land)
+        cwd = Path.cwd()
+        for size_i in args.sizes:
+            nb_positions = int(size_i)
+            response = get_response(
+                args.datastreams, nb_positions, fraction_outliers=args.outliers
+            )
+            cfg = get_cfg(args.datastreams, workers=args.workers)
+            cfg.other.stage_threads = args.stage_threads
+            runs = []
+            for _ in range(args.repeat):
+                timer = StageTimer(nb_datastreams=args.datastreams, nb_positions=nb_positions)
+                run_stages(timer, response, cfg, folder)
+                if not args.no_total:
+                    # run_qc looks for the resources in ./resources
+                    os.chdir(tmp_dir)
+                    try:
+                        run_total(timer, response, cfg)
+                    finally:
+                        os.chdir(cwd)
+                runs.append(timer.results)
+            # fastest run of each stage
+            results += [
+                min(stage_runs, key=lambda ri: ri["wall_s"]) for stage_runs in zip(*runs)
+            ]
+
+    results_previous = None
+    if args.compare:
+        results_previous = json.loads(args.compare.read_text())["results"]
+    print_results(results, results_previous)
+
+    args.output.write_text(
+        json.dumps(
+            {
+                "created": pd.Timestamp.now(tz="UTC").isoformat(),
+                "git_hash": get_git_hash(),
+                "image_tag": os.environ.get("IMAGE_TAG"),
+                "versions": get_versions(),
+                "args": {k: str(v) for k, v in vars(args).items()},
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+    print(f"Results written to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,565 @@
+"""
+Local stand-in for a FROST SensorThings server, to run the fetch and patch
+paths (`get_all_data`, `get_query_response`, `PatchWriter`/`patch_qc_flags`)
+offline, e.g. on the synthetic data of `benchmarks/synthetic.py`.
+
+Only what the QC queries use is served:
+- GET Things(id) with Datastreams expanded (nested $filter, $top, $skip,
+  $count, $select and $expand of Observations, FeatureOfInterest,
+  ObservedProperty and Sensor), the expanded collections are paged with
+  @iot.nextLink as FROST does,
+- GET Things(id)/Datastreams and Datastreams(id)/Observations (the nextLinks),
+- POST $batch with PATCHes of the resultQuality of Observations and
+  FeaturesOfInterest.
+
+The filters are `and`/`or` of comparisons (eq, ne, gt, ge, lt, le, in) of a
+property with a literal. Latency and failures (`failure_status` instead of
+the response) can be injected per request.
+"""
+import argparse
+import json
+import logging
+import operator
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+PREFIX = "/FROST-Server/v1.1"
+DEFAULT_TOP = 100
+MAX_TOP = 1000
+OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "ge": operator.ge,
+    "lt": operator.lt,
+    "le": operator.le,
+}
+RE_CONDITION = re.compile(r"^(\S+)\s+(eq|ne|gt|ge|lt|le|in)\s+(.+)$")
+RE_DATETIME = re.compile(r"^\d{4}-\d{2}-\d{2}T")
+RE_ENTITY = re.compile(r"^(\w+)\((\d+)\)$")
+
+
+def split_top_level(s: str, sep: str) -> list[str]:
+    """Split `s` on `sep`, outside of parentheses."""
+    out, depth, start, i = [], 0, 0, 0
+    while i < len(s):
+        if s[i] == "(":
+            depth += 1
+        elif s[i] == ")":
+            depth -= 1
+        elif depth == 0 and s.startswith(sep, i):
+            out.append(s[start:i])
+            i += len(sep)
+            start = i
+            continue
+        i += 1
+    out.append(s[start:])
+    return [oi for oi in out if oi]
+
+
+def parse_options(s: str, sep: str = ";") -> dict:
+    """
+    Query options ($filter, $top, $skip, $count, $select, $expand), the raw
+    strings are kept in "raw" to build the nextLinks.
+    """
+    options: dict = {"raw": {}, "$expand": {}}
+    for option_i in split_top_level(s, sep):
+        key, _, value = option_i.partition("=")
+        options["raw"][key] = value
+        if key == "$expand":
+            options["$expand"] = parse_expand(value)
+        elif key == "$select":
+            options["$select"] = [vi.strip() for vi in value.split(",") if vi.strip()]
+        elif key in ("$top", "$skip"):
+            options[key] = int(value)
+        elif key == "$count":
+            options[key] = value.strip().lower() == "true"
+        elif key == "$filter":
+            options[key] = value.strip()
+    return options
+
+
+def parse_expand(s: str) -> dict[str, dict]:
+    expand = {}
+    for entity_i in split_top_level(s, ","):
+        name, _, options_i = entity_i.strip().partition("(")
+        expand[name] = parse_options(options_i[:-1] if options_i else "")
+    return expand
+
+
+def parse_value(s: str):
+    s = s.strip()
+    if s.startswith("'") and s.endswith("'"):
+        return s[1:-1]
+    if RE_DATETIME.match(s):
+        return pd.Timestamp(s).tz_convert("UTC") if s.endswith("Z") else pd.Timestamp(s, tz="UTC")
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+
+def strip_parentheses(s: str) -> str:
+    """`s` without parentheses around all of it."""
+    s = s.strip()
+    while s.startswith("(") and s.endswith(")"):
+        depth = 0
+        for i, ci in enumerate(s):
+            depth += {"(": 1, ")": -1}.get(ci, 0)
+            if depth == 0:
+                break
+        if i != len(s) - 1:
+            break
+        s = s[1:-1].strip()
+    return s
+
+
+def get_filter_mask(df: pd.DataFrame, filter_str: str | None) -> np.ndarray:
+    """Rows of `df` (columns named as the properties) matching the filter."""
+    if not filter_str:
+        return np.ones(df.shape[0], dtype=bool)
+    mask_or = np.zeros(df.shape[0], dtype=bool)
+    for group_i in split_top_level(strip_parentheses(filter_str), " or "):
+        mask_and = np.ones(df.shape[0], dtype=bool)
+        for condition_i in split_top_level(strip_parentheses(group_i), " and "):
+            condition_i = strip_parentheses(condition_i)
+            if " and " in condition_i or " or " in condition_i:
+                mask_and &= get_filter_mask(df, condition_i)
+                continue
+            match = RE_CONDITION.match(condition_i)
+            if match is None:
+                raise ValueError(f"Unsupported filter condition: {condition_i}")
+            prop, op, value = match.groups()
+            column = df[prop]
+            if op == "in":
+                values = [parse_value(vi) for vi in strip_parentheses(value).split(",") if vi.strip()]
+                mask_and &= column.isin(values).to_numpy()
+            else:
+                mask_and &= OPERATORS[op](column, parse_value(value)).to_numpy()
+        mask_or |= mask_and
+    return mask_or
+
+
+def select(entity: dict, selection: list[str] | None) -> dict:
+    """The (nested, "a/b") properties of `selection`."""
+    if not selection:
+        return dict(entity)
+    out: dict = {}
+    for path_i in selection:
+        keys = path_i.split("/")
+        value = entity
+        for key_i in keys:
+            if not isinstance(value, dict) or key_i not in value:
+                break
+            value = value[key_i]
+        else:
+            out_i = out
+            for key_i in keys[:-1]:
+                out_i = out_i.setdefault(key_i, {})
+            out_i[keys[-1]] = value
+    return out
+
+
+def get_nb_observations(body: dict) -> int:
+    items = body.get("Datastreams", body.get("value", []))
+    if items and "Observations" in items[0]:
+        return sum(len(di["Observations"]) for di in items)
+    return len(items) if "Datastreams" not in body else 0
+
+
+class FrostStore:
+    """
+    Entities of one Thing: datastream properties, observations and features
+    (flags as int codes). Patches are applied under a lock.
+    """
+
+    def __init__(
+        self,
+        thing_id: int,
+        datastreams: list[dict],
+        observations: pd.DataFrame,
+        features: pd.DataFrame,
+    ):
+        self.thing_id = thing_id
+        self.datastreams = datastreams
+        self.df_datastreams = pd.DataFrame(
+            {
+                "@iot.id": [di["@iot.id"] for di in datastreams],
+                "name": [di.get("name") for di in datastreams],
+                "description": [di.get("description") for di in datastreams],
+            }
+        )
+        self.observations = observations
+        self.features = features
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_response(cls, response: dict, thing_id: int = 1) -> "FrostStore":
+        """Store with the entities of a Things(id) response (e.g. synthetic)."""
+        datastreams, observations, features = [], [], {}
+        for ds_i in response["Datastreams"]:
+            datastreams.append({k: v for k, v in ds_i.items() if k != "Observations"})
+            for obs_j in ds_i.get("Observations", []):
+                foi_j = obs_j["FeatureOfInterest"]
+                features[foi_j["@iot.id"]] = (
+                    *foi_j["feature"]["coordinates"],
+                    foi_j.get("properties", {}).get("resultQuality", 0),
+                )
+                observations.append(
+                    (
+                        obs_j["@iot.id"],
+                        obs_j["result"],
+                        obs_j["phenomenonTime"],
+                        obs_j.get("resultQuality", 0),
+                        ds_i["@iot.id"],
+                        foi_j["@iot.id"],
+                    )
+                )
+        df_observations = pd.DataFrame(
+            observations,
+            columns=["@iot.id", "result", "phenomenonTime_str", "resultQuality", "datastream", "feature"],
+        )
+        df_observations["phenomenonTime"] = pd.to_datetime(
+            df_observations["phenomenonTime_str"], utc=True
+        )
+        df_observations.index = df_observations["@iot.id"].to_numpy()
+        df_features = pd.DataFrame.from_dict(
+            features, orient="index", columns=["long", "lat", "resultQuality"]
+        )
+        return cls(thing_id, datastreams, df_observations, df_features)
+
+    def get_observations(self, datastream_id: int, options: dict) -> tuple[pd.DataFrame, int]:
+        """Page of the observations of a datastream and the number matching."""
+        df = self.observations.loc[self.observations["datastream"].to_numpy() == datastream_id]
+        df = df.loc[get_filter_mask(df, options.get("$filter"))]
+        skip = options.get("$skip", 0)
+        return df.iloc[skip : skip + options["_top"]], df.shape[0]
+
+    def render_observations(self, df: pd.DataFrame, options: dict) -> list[dict]:
+        expand_foi = options["$expand"].get("FeatureOfInterest")
+        selection = options.get("$select")
+        columns = ["@iot.id", "result", "phenomenonTime_str", "resultQuality", "feature"]
+        with self.lock:
+            rows = df[columns].to_numpy(dtype=object).tolist()
+            if expand_foi is not None:
+                df_foi = self.features.loc[df["feature"].to_numpy()]
+                fois = df_foi.to_numpy(dtype=object).tolist()
+        out = []
+        for i, (id_i, result_i, time_i, flag_i, feature_i) in enumerate(rows):
+            obs_i = {
+                "@iot.id": int(id_i),
+                "result": float(result_i),
+                "phenomenonTime": time_i,
+                "resultQuality": int(flag_i),
+            }
+            obs_i = select(obs_i, selection)
+            if expand_foi is not None:
+                lon_i, lat_i, foi_flag_i = fois[i]
+                foi_i = {
+                    "@iot.id": int(feature_i),
+                    "feature": {"type": "Point", "coordinates": [lon_i, lat_i]},
+                    "properties": {"resultQuality": int(foi_flag_i)},
+                }
+                obs_i["FeatureOfInterest"] = select(foi_i, expand_foi.get("$select"))
+            out.append(obs_i)
+        return out
+
+    def patch(self, requests: list[dict]) -> list[int]:
+        """Apply the PATCHes of the resultQuality, status of each request."""
+        statuses = np.full(len(requests), 400)
+        updates: dict[str, list] = {"Observations": [], "FeaturesOfInterest": []}
+        for i, request_i in enumerate(requests):
+            match = RE_ENTITY.match(request_i.get("url", "").strip("/").rsplit("/", 1)[-1])
+            if request_i.get("method", "").lower() != "patch":
+                statuses[i] = 405
+            elif match is not None and match.group(1) in updates:
+                body_i = request_i.get("body", {})
+                if match.group(1) == "FeaturesOfInterest":
+                    body_i = body_i.get("properties", {})
+                updates[match.group(1)].append(
+                    (i, int(match.group(2)), body_i.get("resultQuality"))
+                )
+        with self.lock:
+            for entity_i, df_i in [
+                ("Observations", self.observations),
+                ("FeaturesOfInterest", self.features),
+            ]:
+                if not updates[entity_i]:
+                    continue
+                idx, ids, flags = map(np.array, zip(*updates[entity_i]))
+                positions = df_i.index.get_indexer(ids)
+                statuses[idx] = np.where(positions >= 0, 200, 404)
+                bool_set = (positions >= 0) & np.array([fi is not None for fi in flags])
+                df_i.iloc[
+                    positions[bool_set], df_i.columns.get_loc("resultQuality")
+                ] = flags[bool_set].astype(int)
+        return statuses.tolist()
+
+
+class FrostServer:
+    """
+    The store served on localhost, in a background thread.
+
+    Args:
+        store (FrostStore): entities.
+        port (int, optional): 0 for a free port.
+        default_top (int, optional): page size without $top.
+        max_top (int, optional): largest page size.
+        latency (float, optional): seconds added to each request.
+        latency_per_item (float, optional): seconds added per returned
+            observation or patch.
+        failure_rate (float, optional): fraction of the GET requests answered
+            with `failure_status`.
+        batch_failure_rate (float, optional): same for the $batch requests.
+        failure_status (int, optional): status of the failed requests.
+        seed (int, optional): of the failures.
+    """
+
+    def __init__(
+        self,
+        store: FrostStore,
+        port: int = 0,
+        default_top: int = DEFAULT_TOP,
+        max_top: int = MAX_TOP,
+        latency: float = 0.0,
+        latency_per_item: float = 0.0,
+        failure_rate: float = 0.0,
+        batch_failure_rate: float = 0.0,
+        failure_status: int = 503,
+        seed: int = 0,
+    ):
+        self.store = store
+        self.default_top = default_top
+        self.max_top = max_top
+        self.latency = latency
+        self.latency_per_item = latency_per_item
+        self.failure_rate = failure_rate
+        self.batch_failure_rate = batch_failure_rate
+        self.failure_status = failure_status
+        self.counts: Counter = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._get_handler())
+        self.httpd.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{PREFIX}"
+
+    def start(self) -> "FrostServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "FrostServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[key] += n
+
+    def _fail(self, rate: float) -> bool:
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def _get_top(self, options: dict) -> dict:
+        options["_top"] = min(options.get("$top", self.default_top), self.max_top)
+        return options
+
+    def _next_link(self, path: str, options: dict, total: int) -> str | None:
+        skip = options.get("$skip", 0) + options["_top"]
+        if skip >= total:
+            return None
+        raw = {k: v for k, v in options["raw"].items() if k not in ("$top", "$skip")}
+        query = "&".join([f"{k}={v}" for k, v in raw.items()] + [f"$top={options['_top']}", f"$skip={skip}"])
+        return f"{self.url}/{path}?{query}"
+
+    def get_observations(self, datastream_id: int, options: dict) -> dict:
+        options = self._get_top(options)
+        df, total = self.store.get_observations(datastream_id, options)
+        out: dict = {}
+        if options.get("$count"):
+            out["@iot.count"] = total
+        out["value"] = self.store.render_observations(df, options)
+        next_link = self._next_link(f"Datastreams({datastream_id})/Observations", options, total)
+        if next_link:
+            out["@iot.nextLink"] = next_link
+        return out
+
+    def get_datastreams(self, options: dict) -> dict:
+        options = self._get_top(options)
+        df = self.store.df_datastreams
+        df = df.loc[get_filter_mask(df, options.get("$filter"))]
+        total = df.shape[0]
+        skip = options.get("$skip", 0)
+        ids = df["@iot.id"].iloc[skip : skip + options["_top"]].tolist()
+        datastreams = {di["@iot.id"]: di for di in self.store.datastreams}
+        out = []
+        for id_i in ids:
+            ds_i = select(datastreams[id_i], options.get("$select"))
+            for name_j, options_j in options["$expand"].items():
+                if name_j == "Observations":
+                    obs_j = self.get_observations(id_i, options_j)
+                    ds_i["Observations"] = obs_j["value"]
+                    if "@iot.count" in obs_j:
+                        ds_i["Observations@iot.count"] = obs_j["@iot.count"]
+                    if "@iot.nextLink" in obs_j:
+                        ds_i["Observations@iot.nextLink"] = obs_j["@iot.nextLink"]
+                elif name_j in datastreams[id_i]:
+                    ds_i[name_j] = select(datastreams[id_i][name_j], options_j.get("$select"))
+            out.append(ds_i)
+        response = {"value": out}
+        next_link = self._next_link(f"Things({self.store.thing_id})/Datastreams", options, total)
+        if next_link:
+            response["@iot.nextLink"] = next_link
+        return response
+
+    def get(self, path: str, query: str) -> tuple[int, dict]:
+        self._count("get")
+        parts = path[len(PREFIX) :].strip("/").split("/") if path.startswith(PREFIX) else []
+        options = parse_options(query, sep="&")
+        matches = [RE_ENTITY.match(pi) for pi in parts]
+        if len(parts) == 1 and matches[0] and matches[0].group(1) == "Things":
+            datastreams = self.get_datastreams(options["$expand"].get("Datastreams", parse_options("")))
+            response = {"Datastreams": datastreams["value"]}
+            if "@iot.nextLink" in datastreams:
+                response["Datastreams@iot.nextLink"] = datastreams["@iot.nextLink"]
+            return 200, response
+        if len(parts) == 2 and matches[0] and matches[0].group(1) == "Things" and parts[1] == "Datastreams":
+            return 200, self.get_datastreams(options)
+        if len(parts) == 2 and matches[0] and matches[0].group(1) == "Datastreams" and parts[1] == "Observations":
+            return 200, self.get_observations(int(matches[0].group(2)), options)
+        return 404, {"message": f"Not served: {path}"}
+
+    def batch(self, body: dict) -> tuple[int, dict]:
+        self._count("batch")
+        requests = body.get("requests", [])
+        responses = [
+            {"id": request_i.get("id"), "status": status_i, "body": ""}
+            for request_i, status_i in zip(requests, self.store.patch(requests))
+        ]
+        self._count("patches", len(responses))
+        return 200, {"responses": responses}
+
+    def _get_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+            def _read_body(self) -> bytes:
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    chunks = []
+                    while True:
+                        size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return b"".join(chunks)
+                        chunks.append(self.rfile.read(size))
+                        self.rfile.readline()
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def _send(self, status: int, body: dict, nb_items: int = 0) -> None:
+                time.sleep(server.latency + server.latency_per_item * nb_items)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _fail(self, rate: float) -> bool:
+                if not server._fail(rate):
+                    return False
+                server._count("failed")
+                self._send(server.failure_status, {"message": "Injected failure"})
+                return True
+
+            def do_GET(self):
+                if self._fail(server.failure_rate):
+                    return
+                url = urlsplit(self.path)
+                try:
+                    status, body = server.get(unquote(url.path), unquote(url.query))
+                except (ValueError, KeyError) as e:
+                    status, body = 400, {"message": str(e)}
+                self._send(status, body, get_nb_observations(body))
+
+            def do_POST(self):
+                body_in = self._read_body()
+                if self._fail(server.batch_failure_rate):
+                    return
+                if not urlsplit(self.path).path.endswith("$batch"):
+                    self._send(404, {"message": f"Not served: {self.path}"})
+                    return
+                try:
+                    status, body = server.batch(json.loads(body_in))
+                except json.JSONDecodeError as e:
+                    status, body = 400, {"message": str(e)}
+                self._send(status, body, len(body.get("responses", [])))
+
+        return Handler
+
+
+def main():
+    from benchmarks.synthetic import get_response
+
+    parser = argparse.ArgumentParser(
+        description="Local FROST stand-in server with synthetic ship data"
+    )
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--datastreams", type=int, default=6)
+    parser.add_argument("--positions", type=float, default=1e5, help="Positions (1 Hz)")
+    parser.add_argument("--default-top", type=int, default=DEFAULT_TOP)
+    parser.add_argument("--max-top", type=int, default=MAX_TOP)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per request")
+    parser.add_argument("--latency-per-item", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--batch-failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    store = FrostStore.from_response(get_response(args.datastreams, int(args.positions)))
+    server = FrostServer(
+        store,
+        port=args.port,
+        default_top=args.default_top,
+        max_top=args.max_top,
+        latency=args.latency,
+        latency_per_item=args.latency_per_item,
+        failure_rate=args.failure_rate,
+        batch_failure_rate=args.batch_failure_rate,
+    )
+    print(f"Serving {store.observations.shape[0]} observations on {server.url}.")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(dict(server.counts))
+
+
+if __name__ == "__main__":
+    main()
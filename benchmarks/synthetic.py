@@ -0,0 +1,214 @@
+"""
+Synthetic ship data for the benchmarks: a response of the Things query of
+`get_all_data`, the QC configuration of its datastreams and the resources
+(land polygons, elevation grid) of the location checks.
+
+The ship sails circles of `RADIUS` degrees at about 3 m/s, observed every
+second by all datastreams:
+- the first datastream is a flow sensor with down periods (stabilization
+  gaps), the other ones depend on it (QC_dependent with dt_stabilization),
+- the third datastream also depends on the second one (QC_dependent without
+  dt_stabilization, as the temperature/conductivity pairs),
+- a fraction of the positions jumps away (spacial outliers) and a fraction of
+  each circle crosses a box of land,
+- datastream i starts i seconds later (the datastreams have different
+  numbers of observations, as in the real data).
+"""
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import xarray as xr
+from omegaconf import DictConfig, OmegaConf
+from shapely.geometry import box
+
+START = pd.Timestamp("2024-01-01", tz="UTC")
+ID_DATASTREAM0 = 8000
+ID_OBSERVATION0 = 10_000_000
+ID_FEATURE0 = 1_000_000
+CENTER = (2.8, 51.6)  # lon, lat
+RADIUS = 0.3
+PERIOD = 6 * 3600  # s, one circle
+ETOP_FILENAME = "ETOPO_2022_v1_60s_N90W180_bed.nc"
+
+
+def get_track(
+    nb_positions: int,
+    fraction_outliers: float = 1e-3,
+    seed: int = 0,
+) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    angle = 2 * np.pi * np.arange(nb_positions) / PERIOD
+    lon = CENTER[0] + RADIUS * np.cos(angle) / np.cos(np.radians(CENTER[1]))
+    lat = CENTER[1] + RADIUS * np.sin(angle)
+    lon += rng.normal(0.0, 2e-6, nb_positions)
+    lat += rng.normal(0.0, 2e-6, nb_positions)
+    idx = rng.choice(
+        nb_positions, int(nb_positions * fraction_outliers), replace=False
+    )
+    lat[idx] += rng.normal(0.0, 0.2, idx.size)
+    return pd.DataFrame(
+        {
+            "time": START + pd.to_timedelta(np.arange(nb_positions), "s"),
+            "lon": lon,
+            "lat": lat,
+        }
+    )
+
+
+def get_land(fraction_land: float = 0.02) -> gpd.GeoDataFrame:
+    # the part of the circles with cos(angle) > cos(pi * fraction_land)
+    coslat = np.cos(np.radians(CENTER[1]))
+    minx = CENTER[0] + RADIUS * np.cos(np.pi * fraction_land) / coslat
+    return gpd.GeoDataFrame(
+        {"featurecla": ["Land"]},
+        geometry=[
+            box(minx, CENTER[1] - 2 * RADIUS, CENTER[0] + 2 * RADIUS / coslat, CENTER[1] + 2 * RADIUS)
+        ],
+        crs="EPSG:4326",
+    )
+
+
+def get_results(
+    nb_datastreams: int, nb_positions: int, seed: int = 0
+) -> list[np.ndarray]:
+    rng = np.random.default_rng(seed)
+    # flow sensor: down periods of a minute to an hour
+    down = np.repeat(rng.random(nb_positions // 60 + 1) < 0.05, 60)[:nb_positions]
+    results = [
+        np.where(
+            down,
+            rng.uniform(0.0, 0.1, nb_positions),
+            rng.uniform(2.0, 5.0, nb_positions),
+        )
+    ]
+    for _ in range(1, nb_datastreams):
+        result_i = 15.0 + np.cumsum(rng.normal(0.0, 0.01, nb_positions))
+        idx = rng.choice(nb_positions, max(nb_positions // 1000, 1), replace=False)
+        result_i[idx] += rng.normal(0.0, 20.0, idx.size)
+        results.append(result_i)
+    return results
+
+
+def get_datastream_ids(nb_datastreams: int) -> list[int]:
+    return [ID_DATASTREAM0 + i for i in range(nb_datastreams)]
+
+
+def get_response(
+    nb_datastreams: int,
+    nb_positions: int,
+    fraction_outliers: float = 1e-3,
+    seed: int = 0,
+) -> dict:
+    """
+    Response of the Things query of `get_all_data` (all observations
+    expanded), as returned by `get_query_response`.
+    """
+    df_track = get_track(nb_positions, fraction_outliers=fraction_outliers, seed=seed)
+    times = df_track["time"].dt.strftime("%Y-%m-%dT%H:%M:%S.000Z").tolist()
+    features = [
+        {
+            "feature": {"coordinates": [lon_i, lat_i]},
+            "@iot.id": ID_FEATURE0 + i,
+            "properties": {"resultQuality": 0},
+        }
+        for i, (lon_i, lat_i) in enumerate(
+            zip(df_track["lon"].tolist(), df_track["lat"].tolist())
+        )
+    ]
+    datastreams = []
+    for i, (id_i, result_i) in enumerate(
+        zip(get_datastream_ids(nb_datastreams), get_results(nb_datastreams, nb_positions, seed))
+    ):
+        id_obs0 = ID_OBSERVATION0 + i * nb_positions
+        datastreams.append(
+            {
+                "@iot.id": id_i,
+                "unitOfMeasurement": {"name": ["l/min", "degC"][i > 0]},
+                "Observations": [
+                    {
+                        "@iot.id": id_obs0 + j,
+                        "result": result_j,
+                        "phenomenonTime": time_j,
+                        "resultQuality": 0,
+                        "FeatureOfInterest": feature_j,
+                    }
+                    for j, (result_j, time_j, feature_j) in enumerate(
+                        zip(result_i.tolist(), times, features)
+                    )
+                    if j >= i
+                ],
+                "ObservedProperty": {"@iot.id": 100 + i, "name": f"quantity {i}"},
+            }
+        )
+    return {"Datastreams": datastreams}
+
+
+def get_cfg(nb_datastreams: int, workers: int = 1) -> DictConfig:
+    ids = get_datastream_ids(nb_datastreams)
+    qc_dependent = [
+        {
+            "independent": ids[0],
+            "dependent": ",".join(str(i) for i in ids[1:]),
+            "dt_tolerance": "0.5s",
+            "dt_stabilization": "20min",
+            "max_allowed_downtime": "15min",
+            "QC": {"range": [0.2, 10.0]},
+        }
+    ]
+    if nb_datastreams > 2:
+        qc_dependent.append(
+            {
+                "independent": ids[1],
+                "dependent": str(ids[2]),
+                "dt_tolerance": "0.5s",
+                "QC": {"range": [-2.0, 30.0]},
+            }
+        )
+    qc = [{"id": ids[0], "range": [0.2, 10.0], "gradient": [-100.0, 100.0], "zscore": [-5.0, 5.0]}]
+    qc += [
+        {"id": id_i, "range": [-2.0, 30.0], "gradient": [-100.0, 100.0], "zscore": [-5.0, 5.0]}
+        for id_i in ids[1:]
+    ]
+    return OmegaConf.create(
+        {
+            "data_api": {
+                "things": {"id": 1},
+                "filter": {"Datastreams": {"ids": ids}},
+            },
+            "reset": {"overwrite_feature_flags": True},
+            "other": {"workers": workers},
+            "location": {
+                "crs": "EPSG:4326",
+                "time_window": "10min",
+                "max_dx_dt": 6.89,
+                "max_ddx_dtdt": 0.15,
+            },
+            "QC_global": {"zscore": {"time_window": "60min"}},
+            "QC_dependent": qc_dependent,
+            "QC": qc,
+        }
+    )
+
+
+def write_resources(folder: Path, fraction_land: float = 0.02) -> Path:
+    """
+    Land polygons and elevation grid, with the file names of `get_ne_10m_shp`
+    and `get_elev_netcdf` (no download when they exist).
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    path_shp = folder.joinpath("ne_10m_land.shp")
+    get_land(fraction_land).to_file(path_shp)
+    for suffix_i in [".shx", ".prj", ".dbf", ".cpg"]:
+        path_shp.with_suffix(suffix_i).touch()
+
+    lat = np.arange(CENTER[1] - 1.0, CENTER[1] + 1.0, 1.0 / 60.0)
+    lon = np.arange(CENTER[0] - 1.5, CENTER[0] + 1.5, 1.0 / 60.0)
+    z = np.full((lat.size, lon.size), -30.0, dtype="f4")
+    # shallow (above 0) along the land
+    z[:, lon > get_land(fraction_land).total_bounds[0]] = 5.0
+    xr.Dataset({"z": (("lat", "lon"), z)}, coords={"lat": lat, "lon": lon}).to_netcdf(
+        folder.joinpath(ETOP_FILENAME)
+    )
+    return folder
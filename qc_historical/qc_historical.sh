@@ -2,14 +2,13 @@
 
 IMAGE_TAG="v0.7.1"
 CONFIG_NAME="config.yaml"
-DATE_TIME_FORMAT="+%Y-%m-%d %H:%M:%S"
 
 # 
-# ./qc_historical.sh -s "2023-05-24 09:30:00" -e "2023-05-24 10:30:00" -d "60min" -o "10" -i "tmp" -c "config.yaml" -t >> qc_historical_$(date "+%Y%m%d").log 2>&1
+# ./qc_historical.sh -s "2023-05-24 09:30:00" -e "2023-05-24 10:30:00" -d "60min" -i "tmp" -c "config.yaml" -t >> qc_historical_$(date "+%Y%m%d").log 2>&1
 
 # Function to display usage
 usage() {
-    echo "Usage: $0 -s START -e END -d total_time_window -o time_window_overlap [-i IMAGE_TAG] [-c CONFIG_NAME] [-r RESOURCES_FOLDER]"
+    echo "Usage: $0 -s START -e END -d time_window [-o time_window_overlap] [-i IMAGE_TAG] [-c CONFIG_NAME] [-t]"
     exit 1
 }
 
@@ -28,8 +27,6 @@ while getopts ":s:e:d:o:i:c:t" opt; do
         ;;
         c) CONFIG_NAME="$OPTARG"
         ;;
-        r) CONFIG_NAME="$OPTARG"
-        ;;
         t) MODE="_testing"
         ;;
         \?) echo "Invalid option -$OPTARG" >&2
@@ -42,7 +39,7 @@ while getopts ":s:e:d:o:i:c:t" opt; do
 done
 
 # Check mandatory parameters
-if [ -z "$START" ] || [ -z "$END" ] || [ -z "$TOTAL_TIME_WINDOW" ] || [ -z "$WINDOW_OVERLAP" ]; then
+if [ -z "$START" ] || [ -z "$END" ] || [ -z "$TOTAL_TIME_WINDOW" ]; then
     usage
 fi
 
@@ -52,48 +49,34 @@ echo "Parameters:"
 echo "Start: $START"
 echo "End: $END"
 echo "TOTAL_TIME_WINDOW: $TOTAL_TIME_WINDOW"
-echo "WINDOW_OVERLAP: $WINDOW_OVERLAP"
 echo "IMAGE_TAG: $IMAGE_TAG"
 echo "CONFIG_NAME: $CONFIG_NAME"
 echo "RESOURCES_FOLDER: $RESOURCES_FOLDER"
 echo "MODE: $MODE"
 echo "---------------"
+if [ -n "$WINDOW_OVERLAP" ]; then
+    # the windows are checked with the tail of the previous one (src/historical.py)
+    echo "WINDOW_OVERLAP is ignored, the overlap is the lookback of the checks."
+fi
 
 source ./env_hist$MODE
 source ./.env$MODE
 
-TIME_WINDOW_INT=$(echo $TOTAL_TIME_WINDOW | tr -dc '0-9')
-TIME_WINDOW_INT=$(($TIME_WINDOW_INT))
-TIME_WINDOW_UNIT=$(printf '%s\n' "${TOTAL_TIME_WINDOW//[[:digit:]]/}")
-
-START_SECONDS=$(date -u --date="$START" +%s)
-END_SECONDS=$(date -u --date="$END" +%s)
-
-START_I=$START
-
-while [[ $(date -u --date="$START_I UTC" "+%s") < $END_SECONDS ]]
-do
-    START_SECONDS=$(date -u --date="$START UTC" +%s)
-
-    CONFIG_FOLDER=$CONFIG_FOLDER_HIST
-    OUTPUT_FOLDER=$OUTPUT_FOLDER_HIST
-
-    START_II=$(date -u --date="$START_I UTC +""$((-WINDOW_OVERLAP))""$TIME_WINDOW_UNIT" "$DATE_TIME_FORMAT")
-
-    END_I=$(date -u --date="$START_I UTC + ""$TOTAL_TIME_WINDOW" "$DATE_TIME_FORMAT")
-
-    docker run \
-        --rm --network=host --workdir /app \
-        -v "$CONFIG_FOLDER":/app/conf \
-        -v "$OUTPUT_FOLDER":/app/outputs \
-        -v "$RESOURCES_FOLDER":/app/resources \
-        -e DEV_SENSORS_USER="$SENSORS_USER" \
-        -e DEV_SENSORS_PASS="$SENSORS_PASS" \
-        rbinsbmdc/quality_assurance_tool:$IMAGE_TAG \
-        "--config-name" $CONFIG_NAME \
-        "time.start=$START_II" "time.end=$END_I" \
-        "data_api.base_url=$BASE_URL"
-
-    START_I=$END_I
- 
-done
+CONFIG_FOLDER=$CONFIG_FOLDER_HIST
+OUTPUT_FOLDER=$OUTPUT_FOLDER_HIST
+
+# all windows in one container (src/historical.py)
+docker run \
+    --rm --network=host --workdir /app \
+    -v "$CONFIG_FOLDER":/app/conf \
+    -v "$OUTPUT_FOLDER":/app/outputs \
+    -v "$RESOURCES_FOLDER":/app/resources \
+    -e DEV_SENSORS_USER="$SENSORS_USER" \
+    -e DEV_SENSORS_PASS="$SENSORS_PASS" \
+    --entrypoint python \
+    rbinsbmdc/quality_assurance_tool:$IMAGE_TAG \
+    /app/src/historical.py \
+    "--config-name" $CONFIG_NAME \
+    "time.start=$START" "time.end=$END" \
+    "historical.window=$TOTAL_TIME_WINDOW" \
+    "data_api.base_url=$BASE_URL"
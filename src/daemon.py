@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Tuple
+from urllib.parse import urljoin
+
+import hydra
+import pandas as pd
+from df_qc_tools.config import QCconf
+from omegaconf import OmegaConf
+from pandassta.sta import Entities
+from pandassta.sta_requests import config, set_dryrun_var, set_sta_url
+
+from main import get_auth, get_chunk_data, patch_final_flags, qc_chunk
+from patch_writer import STATUS_FAILED, PatchWriter, get_patch_writer
+from patching import PatchCounter
+from seavox import SeaVoxRegions, get_seavox_regions
+from streaming import (
+    StreamState,
+    get_chunk_ranges,
+    get_filter_range,
+    get_stream_horizon,
+    get_stream_lookback,
+    utc_now,
+)
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = "10min"
+# as the 50 min read again by each run of the cron this replaces: observations
+# stored in FROST up to this long after their phenomenonTime are still checked
+DEFAULT_DELAY = "50min"
+DEFAULT_MAX_CHUNK = "6h"
+DEFAULT_WATERMARK_FILE = "outputs/watermark.json"
+
+
+def get_daemon_setting(cfg: QCconf, key: str, default: str) -> str:
+    return OmegaConf.select(cfg, f"daemon.{key}", default=default)
+
+
+def read_watermark(path: Path) -> datetime | None:
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        watermark_dict = json.load(f)
+    return datetime.fromisoformat(watermark_dict["watermark"])
+
+
+def write_watermark(path: Path, watermark: datetime) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path_tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(path_tmp, "w") as f:
+        json.dump(
+            {"watermark": watermark.isoformat(), "updated": utc_now().isoformat()}, f
+        )
+    # atomic, a crash never leaves a partial watermark file
+    os.replace(path_tmp, path)
+
+
+def init_state(cfg: QCconf, watermark: datetime | None) -> Tuple[StreamState, datetime]:
+    """
+    Create the stream state from the watermark (or the start of the configured
+    time range). The observations within the lookback before the watermark are
+    fetched again on the first tick to rebuild the tail; their flags are final
+    and they are not patched again.
+
+    Returns:
+        Tuple[StreamState, datetime]: state and the time up to which the
+            observations are fetched.
+    """
+    if watermark is None:
+        watermark = get_filter_range(cfg)[0]
+    state = StreamState(
+        boundary=watermark,
+        lookback=get_stream_lookback(cfg),
+        horizon=get_stream_horizon(cfg),
+    )
+    fetched_until = (pd.Timestamp(watermark) - state.lookback).to_pydatetime()
+    return state, fetched_until
+
+
+def get_tick_ranges(
+    fetched_until: datetime, now: datetime, delay: str, max_chunk: str
+) -> list[Tuple[datetime, datetime]]:
+    # a range is only fetched once: the delay leaves time for the late observations
+    end = (pd.Timestamp(now) - pd.Timedelta(delay)).to_pydatetime()
+    return get_chunk_ranges(fetched_until, end, max_chunk)
+
+
+def run_tick(
+    cfg: QCconf,
+    state: StreamState,
+    fetched_until: datetime,
+    writer: PatchWriter,
+    watermark_file: Path,
+    now: datetime | None = None,
+    fetch: Callable = get_chunk_data,
+    seavox_regions: SeaVoxRegions | None = None,
+) -> Tuple[datetime, int]:
+    """
+    Fetch the observations newer than `fetched_until`, QC them together with
+    the tail and patch the observations whose flags became final. The
+    watermark is written once the patches of a chunk are done; a failed patch
+    raises, so the chunk is checked again from the last watermark.
+
+    Returns:
+        Tuple[datetime, int]: new `fetched_until` and the number of patched
+            observations.
+    """
+    ranges = get_tick_ranges(
+        fetched_until,
+        now or utc_now(),
+        delay=get_daemon_setting(cfg, "delay", DEFAULT_DELAY),
+        max_chunk=get_daemon_setting(cfg, "max_chunk", DEFAULT_MAX_CHUNK),
+    )
+    nb_patched = 0
+    counter_patches = PatchCounter()
+    for ti0, ti1 in ranges:
+        df_new = fetch(cfg, ti0, ti1)
+        df_final, _ = qc_chunk(cfg, state, df_new, ti1, seavox_regions=seavox_regions)
+        if not df_final.empty:
+            counter_i, future_i = patch_final_flags(cfg, df_final, writer)
+            counter_status = future_i.result()
+            if STATUS_FAILED in counter_status:
+                raise RuntimeError(
+                    f"{counter_status[STATUS_FAILED]} patches failed for {ti0} - {ti1}."
+                )
+            counter_patches.update(counter_i)
+            nb_patched += df_final.shape[0] - counter_i.failed[str(Entities.OBSERVATIONS)]
+        fetched_until = ti1
+        write_watermark(watermark_file, state.boundary)
+    counter_patches.log(level=logging.DEBUG)
+    return fetched_until, nb_patched
+
+
+def run_daemon(cfg: QCconf, max_ticks: int | None = None) -> None:
+    config.filename = Path("outputs/.staconf.ini")
+    set_sta_url(cfg.data_api.base_url)
+    set_dryrun_var(getattr(cfg.data_api, "dry_run", False))
+    url_batch = urljoin(cfg.data_api.base_url + "/", "$batch")
+    writer = get_patch_writer(cfg, url_batch, get_auth(cfg))
+    # one region lookup (connection pool) for all ticks
+    seavox_regions = get_seavox_regions(cfg)
+    if any(cfg.reset.values()):
+        log.warning("The reset options are ignored by the daemon.")
+
+    interval = pd.Timedelta(get_daemon_setting(cfg, "interval", DEFAULT_INTERVAL))
+    watermark_file = Path(
+        get_daemon_setting(cfg, "watermark_file", DEFAULT_WATERMARK_FILE)
+    )
+    state, fetched_until = init_state(cfg, read_watermark(watermark_file))
+    log.info(f"Daemon started, watermark: {state.boundary}, interval: {interval}.")
+
+    stop = threading.Event()
+    for signal_i in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signal_i, lambda signum, frame: stop.set())
+
+    nb_ticks = 0
+    try:
+        while not stop.is_set():
+            t_tick0 = time.time()
+            try:
+                fetched_until, nb_patched = run_tick(
+                    cfg, state, fetched_until, writer, watermark_file, seavox_regions=seavox_regions
+                )
+                log.info(
+                    f"Tick done in {(time.time() - t_tick0):.2f}s: {nb_patched} observations patched, watermark {state.boundary}."
+                )
+            except Exception:
+                # restart from the persisted watermark, the tail is fetched again
+                log.exception("Tick failed, the state is reset to the last watermark.")
+                state, fetched_until = init_state(cfg, read_watermark(watermark_file))
+            nb_ticks += 1
+            if max_ticks and nb_ticks >= max_ticks:
+                break
+            stop.wait(max(interval.total_seconds() - (time.time() - t_tick0), 0.0))
+    finally:
+        writer.close()
+        if seavox_regions is not None:
+            seavox_regions.close()
+    log.info("Daemon stopped.")
+
+
+@hydra.main(config_path="../conf", config_name="config.yaml", version_base="1.2")
+def main(cfg: QCconf):
+    run_daemon(cfg)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from omegaconf import OmegaConf
+
+from metrics import RunMetrics
+from parallel import get_executor
+
+log = logging.getLogger(__name__)
+
+THREAD = "thread"
+PROCESS = "process"
+
+
+def get_stage_threads(cfg) -> int:
+    return int(OmegaConf.select(cfg, "other.stage_threads", default=None) or 1)
+
+
+@dataclass
+class Stage:
+    """
+    A stage of the QC: `func` is called with the outputs of the stages in
+    `inputs` as keyword arguments and its output is the one of the stage.
+
+    Stages of kind THREAD run in a thread (NumPy, shapely, I/O: the GIL is
+    released), the ones of kind PROCESS in the process pool of
+    `parallel.get_executor` (`func` and the inputs are pickled). `rows`, the
+    input rows of the metrics, can be a function of the inputs.
+    """
+
+    name: str
+    func: Callable[..., Any]
+    inputs: Tuple[str, ...] = ()
+    kind: str = THREAD
+    rows: int | Callable[..., int] | None = None
+
+
+def get_stage_order(stages: Sequence[Stage]) -> List[Stage]:
+    """Stages in a topological order, the declaration order among the ready ones."""
+    names = [si.name for si in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate stage names: {names}.")
+    for si in stages:
+        missing = set(si.inputs) - set(names)
+        if missing:
+            raise ValueError(f"Unknown inputs of stage {si.name}: {sorted(missing)}.")
+        if si.kind not in (THREAD, PROCESS):
+            raise ValueError(f"Unknown kind of stage {si.name}: {si.kind}.")
+    order: List[Stage] = []
+    done: set = set()
+    pending = list(stages)
+    while pending:
+        ready = [si for si in pending if set(si.inputs) <= done]
+        if not ready:
+            raise ValueError(f"Cyclic stage inputs: {[si.name for si in pending]}.")
+        order += ready
+        done |= {si.name for si in ready}
+        pending = [si for si in pending if si.name not in done]
+    return order
+
+
+def run_stages(
+    stages: Sequence[Stage],
+    threads: int = 1,
+    processes: int = 1,
+    metrics: RunMetrics | None = None,
+) -> Dict[str, Any]:
+    """
+    Run the stages as soon as their inputs are available, at most `threads`
+    at a time (sequentially in a topological order with one thread).
+
+    The outputs don't depend on the order in which the stages complete: the
+    caller merges them (e.g. the flags) in a fixed order. The first exception
+    of a stage is raised once the running stages are done, the stages which
+    didn't start are cancelled.
+
+    Returns:
+        Dict[str, Any]: output of each stage.
+    """
+    order = get_stage_order(stages)
+    metrics = metrics or RunMetrics()
+    outputs: Dict[str, Any] = {}
+
+    def run_stage(stage: Stage, **kwargs) -> Any:
+        rows = stage.rows(**kwargs) if callable(stage.rows) else stage.rows
+        with metrics.stage(stage.name, rows):
+            if stage.kind == PROCESS and processes > 1:
+                return get_executor(processes).submit(stage.func, **kwargs).result()
+            return stage.func(**kwargs)
+
+    if threads <= 1:
+        for si in order:
+            outputs[si.name] = run_stage(si, **{ni: outputs[ni] for ni in si.inputs})
+        return outputs
+
+    pending = list(order)
+    running: Dict[Future, Stage] = {}
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="stage") as executor:
+        while pending or running:
+            ready = [si for si in pending if set(si.inputs) <= outputs.keys()]
+            for si in ready:
+                kwargs = {ni: outputs[ni] for ni in si.inputs}
+                running[executor.submit(run_stage, si, **kwargs)] = si
+                pending.remove(si)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fi in done:
+                stage = running.pop(fi)
+                if fi.exception() is not None:
+                    log.error(f"Stage {stage.name} failed, cancelling {[si.name for si in pending]}.")
+                    for fj in running:
+                        fj.cancel()
+                    wait(running)
+                    raise fi.exception()  # type: ignore
+                outputs[stage.name] = fi.result()
+    return outputs
@@ -0,0 +1,165 @@
+import logging
+import struct
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pandassta.df import Df
+
+log = logging.getLogger(__name__)
+
+# magic, ny, nx, mtime_ns of the netCDF file, lat0, lon0, dlat, dlon
+HEADER = struct.Struct("<8s3q4d")
+MAGIC = b"ELEVGRD1"
+DTYPE = np.dtype("<f4")
+CHUNK_ROWS = 1024
+
+
+class ElevationGrid:
+    """
+    Regular lat/lon elevation grid (e.g. ETOPO), memory-mapped from a binary
+    file with a small header (HEADER, origin and spacing of the cell centers)
+    followed by the float32 values in lat, lon order.
+
+    A grid is converted once from the netCDF file (`from_netcdf`) and opened
+    once per process, lookups only read the pages of the cells they use.
+    """
+
+    _lock = threading.RLock()
+    _open: dict[str, "ElevationGrid"] = {}
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            magic, ny, nx, mtime_ns, lat0, lon0, dlat, dlon = HEADER.unpack(
+                f.read(HEADER.size)
+            )
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not an elevation grid.")
+        self.shape = (ny, nx)
+        self.mtime_ns = mtime_ns
+        self.lat0, self.lon0, self.dlat, self.dlon = lat0, lon0, dlat, dlon
+        self.z = np.memmap(
+            self.path, dtype=DTYPE, mode="r", offset=HEADER.size, shape=self.shape
+        )
+
+    @staticmethod
+    def get_path(etop_file: Path | str) -> Path:
+        return Path(etop_file).with_suffix(".grid")
+
+    @classmethod
+    def convert(cls, etop_file: Path | str, path: Path | str | None = None) -> Path:
+        """
+        Writes the `z` variable of a netCDF file on a regular grid to `path`
+        (default: next to the netCDF file, with the .grid suffix).
+        """
+        etop_file = Path(etop_file)
+        path = Path(path) if path is not None else cls.get_path(etop_file)
+        log.info(f"Converting {etop_file} to {path}.")
+        with xr.open_dataset(etop_file) as dataset:
+            lat = dataset["lat"].to_numpy()
+            lon = dataset["lon"].to_numpy()
+            for coord_i in [lat, lon]:
+                if coord_i.size < 2 or not np.allclose(
+                    np.diff(coord_i), coord_i[1] - coord_i[0]
+                ):
+                    raise ValueError(f"{etop_file} is not a regular grid.")
+            header = HEADER.pack(
+                MAGIC,
+                lat.size,
+                lon.size,
+                etop_file.stat().st_mtime_ns,
+                lat[0],
+                lon[0],
+                (lat[-1] - lat[0]) / (lat.size - 1),
+                (lon[-1] - lon[0]) / (lon.size - 1),
+            )
+            path_tmp = path.with_suffix(".tmp")
+            with open(path_tmp, "wb") as f:
+                f.write(header)
+                z = dataset["z"].transpose("lat", "lon")
+                for i0 in range(0, lat.size, CHUNK_ROWS):
+                    f.write(z[i0 : i0 + CHUNK_ROWS].to_numpy().astype(DTYPE).tobytes())
+            path_tmp.replace(path)
+        return path
+
+    @classmethod
+    def from_netcdf(cls, etop_file: Path | str) -> "ElevationGrid":
+        """
+        The grid of the netCDF file, converted if the .grid file is missing or
+        older than the netCDF file.
+        """
+        path = cls.get_path(etop_file)
+        mtime_ns = Path(etop_file).stat().st_mtime_ns
+        with cls._lock:
+            grid = cls._open.get(str(path))
+            if grid is not None and grid.mtime_ns == mtime_ns:
+                return grid
+            if not path.exists() or cls(path).mtime_ns != mtime_ns:
+                cls.convert(etop_file, path)
+            grid = cls(path)
+            cls._open[str(path)] = grid
+            return grid
+
+    def _get_positions(self, lat: np.ndarray, lon: np.ndarray):
+        return (lat - self.lat0) / self.dlat, (lon - self.lon0) / self.dlon
+
+    def get_nearest(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """
+        Value of the nearest cell, as `xarray.sel(method="nearest")` (ties to
+        the larger index, coordinates outside the grid to the border).
+        Missing coordinates give nan.
+        """
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        z_out = np.full(lat.shape, np.nan)
+        bool_valid = np.isfinite(lat) & np.isfinite(lon)
+        y, x = self._get_positions(lat[bool_valid], lon[bool_valid])
+        iy = np.clip(np.floor(y + 0.5), 0, self.shape[0] - 1).astype(np.intp)
+        ix = np.clip(np.floor(x + 0.5), 0, self.shape[1] - 1).astype(np.intp)
+        z_out[bool_valid] = self.z[iy, ix]
+        return z_out
+
+    def get_bilinear(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """
+        Bilinear interpolation between the 4 surrounding cells, coordinates
+        outside the grid take the border values. Missing coordinates give nan.
+        """
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        z_out = np.full(lat.shape, np.nan)
+        bool_valid = np.isfinite(lat) & np.isfinite(lon)
+        y, x = self._get_positions(lat[bool_valid], lon[bool_valid])
+        y = np.clip(y, 0, self.shape[0] - 1)
+        x = np.clip(x, 0, self.shape[1] - 1)
+        iy0 = np.minimum(np.floor(y).astype(np.intp), self.shape[0] - 2).clip(0)
+        ix0 = np.minimum(np.floor(x).astype(np.intp), self.shape[1] - 2).clip(0)
+        wy, wx = y - iy0, x - ix0
+        z00, z01 = self.z[iy0, ix0], self.z[iy0, ix0 + 1]
+        z10, z11 = self.z[iy0 + 1, ix0], self.z[iy0 + 1, ix0 + 1]
+        z_out[bool_valid] = (1 - wy) * ((1 - wx) * z00 + wx * z01) + wy * (
+            (1 - wx) * z10 + wx * z11
+        )
+        return z_out
+
+
+def get_bool_depth_above_threshold_grid(
+    df: pd.DataFrame,
+    threshold: float,
+    mask_to_check: pd.Series | None = None,
+    etop_file: str | Path | None = None,
+) -> pd.Series:
+    """
+    `df_qc_tools.qc.get_bool_depth_above_treshold` on the memory-mapped grid
+    of `etop_file`: True for the checked positions (default: without region)
+    where the nearest elevation is not below the threshold.
+    """
+    if etop_file is None:
+        etop_file = Path("./resources/ETOPO_2022_v1_60s_N90W180_bed.nc")
+    if mask_to_check is None:
+        mask_to_check = df[Df.REGION].isnull()  # type: ignore
+    df_coords = df.loc[mask_to_check, [Df.LAT, Df.LONG]]  # type: ignore
+    z = ElevationGrid.from_netcdf(etop_file).get_nearest(
+        df_coords[Df.LAT].to_numpy(), df_coords[Df.LONG].to_numpy()
+    )
+    return pd.Series(~(z < threshold), index=df_coords.index)
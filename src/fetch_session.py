@@ -0,0 +1,85 @@
+import logging
+
+import requests
+from pandassta import sta_requests
+from pandassta.sta_requests import config, retry
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 8
+
+
+class FetchSession:
+    """
+    Keep-alive session for the fetches of pandassta, which otherwise opens a
+    connection per request (`requests.get` in `get_with_retry`). Installed
+    in place of `sta_requests.get_with_retry`, with the same retries.
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._get_with_retry = None
+
+    @retry(requests.HTTPError, tries=5, delay=1, backoff=2)
+    def get_with_retry(self, query: str) -> requests.Response:
+        return self.session.get(query, auth=config.load_authentication())
+
+    def install(self) -> "FetchSession":
+        if self._get_with_retry is None:
+            self._get_with_retry = sta_requests.get_with_retry
+            sta_requests.get_with_retry = self.get_with_retry  # type: ignore
+        return self
+
+    def uninstall(self) -> None:
+        if self._get_with_retry is not None:
+            sta_requests.get_with_retry = self._get_with_retry  # type: ignore
+            self._get_with_retry = None
+
+    def close(self) -> None:
+        self.uninstall()
+        self.session.close()
+
+    def __enter__(self) -> "FetchSession":
+        return self.install()
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class RequestLimiter:
+    """
+    At most as many concurrent requests to the URLs starting with `url` as
+    `semaphore` allows, for all sessions of the process (fetches and patches,
+    in `HTTPAdapter.send`). With a multiprocessing semaphore, the limit is
+    shared by the processes (e.g. the shards of a historical run).
+    """
+
+    def __init__(self, semaphore, url: str):
+        self.semaphore = semaphore
+        self.url = url
+        self._send = None
+
+    def install(self) -> "RequestLimiter":
+        if self._send is not None:
+            return self
+        send = HTTPAdapter.send
+        limiter = self
+
+        def send_limited(adapter, request, *args, **kwargs):
+            if not request.url.startswith(limiter.url):
+                return send(adapter, request, *args, **kwargs)
+            with limiter.semaphore:
+                return send(adapter, request, *args, **kwargs)
+
+        self._send = send
+        HTTPAdapter.send = send_limited  # type: ignore
+        return self
+
+    def uninstall(self) -> None:
+        if self._send is not None:
+            HTTPAdapter.send = self._send  # type: ignore
+            self._send = None
@@ -0,0 +1,104 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from df_qc_tools.qc import QCFlagConfig, get_bool_out_of_range
+from pandassta.df import CAT_TYPE, QualityFlags
+
+log = logging.getLogger(__name__)
+
+# the categories of CAT_TYPE are ordered as QualityFlags (BAD last), the
+# maximum of the codes is the maximum of the flags
+CODE_NAN = -1
+
+
+def get_flag_code(flag: QualityFlags | None) -> int:
+    if flag is None:
+        return CODE_NAN
+    return int(CAT_TYPE.categories.get_loc(flag))
+
+
+def get_codes(series: pd.Series) -> np.ndarray:
+    return series.astype(CAT_TYPE).cat.codes.to_numpy(dtype=np.int8)
+
+
+def get_flags(codes: np.ndarray, index: pd.Index) -> pd.Series:
+    return pd.Series(
+        pd.Categorical.from_codes(codes, dtype=CAT_TYPE), index=index  # type: ignore
+    )
+
+
+def max_codes(codes: np.ndarray, codes_other: np.ndarray) -> np.ndarray:
+    # a missing flag (CODE_NAN) is replaced by the other one
+    return np.maximum(codes, codes_other)
+
+
+def keep_new(flag, flag_new):
+    # bool_merge_function overwriting the flags
+    return flag_new
+
+
+def get_bool_out_of_range_columns(
+    df: pd.DataFrame, qc_on: str, qc_type: str
+) -> pd.Series:
+    # get_bool_out_of_range reindexes (copies) the frame, only pass its columns
+    columns = [qc_on] + [
+        ci for ci in [f"qc_{qc_type}_min", f"qc_{qc_type}_max"] if ci in df.columns
+    ]
+    return get_bool_out_of_range(df[columns], qc_on=qc_on, qc_type=qc_type)
+
+
+def get_bool_evaluated(df: pd.DataFrame, bool_series: pd.Series) -> pd.Series:
+    # bool_function of a check evaluated beforehand on the same observations
+    return bool_series
+
+
+def scatter_codes(
+    index: pd.Index, index_other: pd.Index, codes_other: np.ndarray, fill: int
+) -> np.ndarray:
+    """
+    Codes aligned on `index`: `codes_other` at the positions of `index_other`
+    and `fill` elsewhere. Labels of `index_other` not in `index` are dropped.
+    """
+    codes_out = np.full(index.size, fill, dtype=np.int8)
+    positions = index.get_indexer(index_other)
+    bool_in = positions >= 0
+    codes_out[positions[bool_in]] = codes_other[bool_in]
+    return codes_out
+
+
+class CodedQCFlagConfig(QCFlagConfig):
+    """
+    QCFlagConfig merging the flags on their int8 codes instead of calling the
+    bool_merge_function per observation. Only max and keep_new are merged on
+    the codes; other merge functions (or non unique indices) use the
+    QCFlagConfig implementation.
+
+    The output has the index of the checked DataFrame; observations not in
+    the bool_series are merged with flag_on_nan, as Series.combine does.
+    """
+
+    def execute(self, df: pd.DataFrame, column: str = "resultQuality") -> pd.Series:
+        if self.bool_merge_function not in (max, keep_new) or not df.index.is_unique:
+            return super().execute(df, column=column)  # type: ignore
+        self.bool_series = self.bool_function(df)
+        if column not in df.columns:
+            log.error(f"KeyError in {self.label}. Verify if the key exists in the database.")
+            self.series_out = pd.Series(
+                self.flag_on_nan, index=self.bool_series.index, dtype=CAT_TYPE
+            )
+            return self.series_out
+        bool_values = self.bool_series.fillna(False).to_numpy(dtype=bool)
+        codes_new = np.where(
+            bool_values,
+            get_flag_code(self.flag_on_true),
+            get_flag_code(self.flag_on_false or self.flag_on_nan),
+        ).astype(np.int8)
+        codes_new = scatter_codes(
+            df.index, self.bool_series.index, codes_new, get_flag_code(self.flag_on_nan)
+        )
+        if self.bool_merge_function is max:
+            codes_new = max_codes(get_codes(df[column]), codes_new)
+        log.info(f"Execution {self.label} qc result: {bool_values.sum()} True")
+        self.series_out = get_flags(codes_new, df.index)
+        return self.series_out
@@ -0,0 +1,83 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from pandassta.df import Df
+
+log = logging.getLogger(__name__)
+
+COLUMNS_GRADIENT = [Df.DATASTREAM_ID, Df.TIME, Df.RESULT]
+
+
+def get_previous_samples(df: pd.DataFrame, df_history: pd.DataFrame) -> pd.DataFrame:
+    """
+    Last sample of `df_history` before the first observation of each
+    datastream of `df`.
+    """
+    if df_history.empty or df.empty:
+        return pd.DataFrame(columns=COLUMNS_GRADIENT)
+    t_first = df.groupby(Df.DATASTREAM_ID)[Df.TIME].min()
+    df_before = df_history.loc[
+        df_history[Df.TIME] < df_history[Df.DATASTREAM_ID].map(t_first),
+        COLUMNS_GRADIENT,
+    ]
+    return (
+        df_before.sort_values(Df.TIME, kind="stable")
+        .groupby(Df.DATASTREAM_ID)
+        .tail(1)
+        .reset_index(drop=True)
+    )
+
+
+def calc_gradients(
+    df: pd.DataFrame, df_previous: pd.DataFrame | None = None
+) -> pd.Series:
+    """
+    Time derivative (per second) of the results of each datastream, as
+    `df_qc_tools.qc.calc_gradient_results` (np.gradient on the time ordered
+    observations of a datastream), in one pass over the observations sorted
+    per datastream.
+
+    With `df_previous` (e.g. get_previous_samples from the cache), the first
+    observation of a datastream has its previous sample and gets a central
+    gradient, as it would with the observations before it in `df`.
+
+    Returns:
+        pd.Series: gradients, with the index of `df`.
+    """
+    df_samples = df[COLUMNS_GRADIENT].assign(_position=np.arange(df.shape[0]))
+    if df_previous is not None and not df_previous.empty:
+        df_previous = get_previous_samples(df, df_previous)
+        df_samples = pd.concat(
+            [df_previous.assign(_position=-1), df_samples], ignore_index=True
+        )
+    df_samples = df_samples.sort_values([Df.DATASTREAM_ID, Df.TIME], kind="stable")
+
+    ids = df_samples[Df.DATASTREAM_ID].to_numpy()
+    x = df_samples[Df.TIME].dt.as_unit("ns").astype(np.int64).to_numpy(dtype=float)
+    f = df_samples[Df.RESULT].to_numpy(dtype=float)
+    bool_prev = np.r_[False, ids[1:] == ids[:-1]]
+    bool_next = np.r_[ids[1:] == ids[:-1], False]
+
+    dx1 = x - np.r_[np.nan, x[:-1]]
+    dx2 = np.r_[x[1:], np.nan] - x
+    f_prev = np.r_[np.nan, f[:-1]]
+    f_next = np.r_[f[1:], np.nan]
+    gradient = np.full(f.size, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # second order central differences on the non uniform times, as np.gradient
+        bool_c = bool_prev & bool_next
+        a = -dx2[bool_c] / (dx1[bool_c] * (dx1[bool_c] + dx2[bool_c]))
+        b = (dx2[bool_c] - dx1[bool_c]) / (dx1[bool_c] * dx2[bool_c])
+        c = dx1[bool_c] / (dx2[bool_c] * (dx1[bool_c] + dx2[bool_c]))
+        gradient[bool_c] = a * f_prev[bool_c] + b * f[bool_c] + c * f_next[bool_c]
+        # first order at the ends
+        bool_first = ~bool_prev & bool_next
+        gradient[bool_first] = (f_next - f)[bool_first] / dx2[bool_first]
+        bool_last = bool_prev & ~bool_next
+        gradient[bool_last] = (f - f_prev)[bool_last] / dx1[bool_last]
+
+    positions = df_samples["_position"].to_numpy()
+    gradient_out = np.full(df.shape[0], np.nan)
+    gradient_out[positions[positions >= 0]] = gradient[positions >= 0] * 1e9
+    return pd.Series(gradient_out, index=df.index, name=Df.GRADIENT)
@@ -0,0 +1,359 @@
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+from urllib.parse import urljoin
+
+import hydra
+import numpy as np
+import pandas as pd
+from df_qc_tools.config import QCconf
+from hydra.core.hydra_config import HydraConfig
+from omegaconf import OmegaConf
+from pandassta.sta_requests import (
+    config,
+    get_elev_netcdf,
+    get_ne_10m_shp,
+    set_dryrun_var,
+    set_sta_url,
+)
+
+from elevation import ElevationGrid
+from fetch_session import FetchSession, RequestLimiter
+from main import get_auth, run_streaming, write_metrics
+from metrics import REQUEST_COUNTER, RunMetrics, StageMetrics
+from patch_writer import get_patch_writer
+from seavox import export_seavox_file, open_seavox_regions
+from streaming import (
+    get_chunk_ranges,
+    get_filter_range,
+    get_stream_horizon,
+    get_stream_lookback,
+)
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = "6h"
+DEFAULT_SHARDS = 1
+LOG_FORMAT_SHARD = "[%(asctime)s][shard %(process)d][%(name)s][%(levelname)s] - %(message)s"
+
+Range = Tuple[datetime, datetime]
+
+
+def get_historical_window(cfg: QCconf) -> str:
+    return OmegaConf.select(cfg, "historical.window", default=None) or DEFAULT_WINDOW
+
+
+def get_historical_shards(cfg: QCconf) -> int:
+    return int(OmegaConf.select(cfg, "historical.shards", default=None) or DEFAULT_SHARDS)
+
+
+def get_max_requests(cfg: QCconf) -> int | None:
+    return OmegaConf.select(cfg, "historical.max_requests", default=None)
+
+
+class Progress:
+    """
+    Progress of the backfill over the time range(s) of the shards, logged once
+    a window is done: fraction of the range, observations and observations/s
+    (fetched observations over the wall time since the start).
+    """
+
+    def __init__(self, ranges: List[Range], nb_windows: int):
+        self.ranges = [(pd.Timestamp(ti0), pd.Timestamp(ti1)) for ti0, ti1 in ranges]
+        self.ends = [ti0 for ti0, _ in self.ranges]
+        self.nb_windows = nb_windows
+        self.windows = 0
+        self.observations = 0
+        self._t_start = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._t_start
+
+    @property
+    def observations_per_s(self) -> float:
+        return self.observations / self.elapsed if self.elapsed > 0 else 0.0
+
+    def get_fraction(self) -> float:
+        total = sum((ti1 - ti0 for ti0, ti1 in self.ranges), pd.Timedelta(0))
+        if total <= pd.Timedelta(0):
+            return 1.0
+        done = sum(
+            (
+                min(max(end_i, ti0), ti1) - ti0
+                for end_i, (ti0, ti1) in zip(self.ends, self.ranges)
+            ),
+            pd.Timedelta(0),
+        )
+        return done / total
+
+    def update(self, end: datetime, nb_observations: int, shard: int = 0) -> None:
+        self.windows += 1
+        self.observations += nb_observations
+        self.ends[shard] = max(self.ends[shard], pd.Timestamp(end))
+        fraction = self.get_fraction()
+        eta = (
+            pd.Timedelta(seconds=round(self.elapsed * (1 - fraction) / fraction))
+            if fraction > 0
+            else None
+        )
+        log.info(
+            f"Window {self.windows}/{self.nb_windows} up to {end}"
+            + (f" (shard {shard})" if len(self.ranges) > 1 else "")
+            + f" ({fraction:.1%}): {nb_observations} observations, {self.observations} in total, "
+            f"{self.observations_per_s:.0f} observations/s, ETA {eta}."
+        )
+
+    def log(self) -> None:
+        log.info(
+            f"Historical QC of {self.ranges[0][0]} - {self.ranges[-1][1]} done in {self.elapsed:.1f} s: "
+            f"{self.windows} windows, {self.observations} observations "
+            f"({self.observations_per_s:.0f} observations/s)."
+        )
+
+
+def get_shard_ranges(t0: datetime, t1: datetime, window: str, shards: int) -> List[Range]:
+    # contiguous shards of (about) the same number of windows
+    ranges = get_chunk_ranges(t0, t1, window)
+    shards = max(min(shards, len(ranges)), 1)
+    bounds = np.linspace(0, len(ranges), shards + 1).round().astype(int)
+    return [(ranges[i0][0], ranges[i1 - 1][1]) for i0, i1 in zip(bounds[:-1], bounds[1:]) if i1 > i0]
+
+
+def get_shard_fetch_ranges(cfg: QCconf, shard_ranges: List[Range]) -> List[Range]:
+    """
+    Time ranges fetched by the shards: the lookback before a shard
+    (stabilization, z-score and spacial outlier windows) and the horizon
+    after it, so that its observations get the flags of a serial run. The
+    first and last shard start and end as the serial run.
+    """
+    lookback = get_stream_lookback(cfg).to_pytimedelta()
+    horizon = get_stream_horizon(cfg).to_pytimedelta()
+    return [
+        (
+            ti0 - lookback if i > 0 else ti0,
+            ti1 + horizon if i < len(shard_ranges) - 1 else ti1,
+        )
+        for i, (ti0, ti1) in enumerate(shard_ranges)
+    ]
+
+
+def get_shard_cfg(cfg: QCconf, fetch_range: Range) -> dict:
+    # resolved (the workers don't have the hydra resolvers), with the range to fetch
+    cfg_shard = OmegaConf.create(OmegaConf.to_container(cfg, resolve=True))
+    format_range = cfg_shard.data_api.filter.phenomenonTime.format
+    cfg_shard.data_api.filter.phenomenonTime.range = [
+        ti.strftime(format_range) for ti in fetch_range
+    ]
+    # the cache index and the z-score state aren't shared by processes, the
+    # lookback of a shard covers the z-score window
+    OmegaConf.update(cfg_shard, "other.cache", None, force_add=True)
+    OmegaConf.update(cfg_shard, "QC_global.zscore.state", None, force_add=True)
+    return OmegaConf.to_container(cfg_shard)  # type: ignore
+
+
+def prepare_resources(cfg: QCconf) -> None:
+    # downloaded, converted and exported once, before the shards use them
+    path_resources = Path().absolute().joinpath("resources")
+    get_ne_10m_shp(local_folder=path_resources)
+    ElevationGrid.from_netcdf(get_elev_netcdf(local_folder=path_resources))
+    export_seavox_file(cfg)
+
+
+_progress_queue = None
+
+
+def init_shard_worker(staconf: Path, progress_queue, semaphore, url: str, log_level: int) -> None:
+    global _progress_queue
+    logging.basicConfig(level=log_level, format=LOG_FORMAT_SHARD)
+    config.filename = staconf
+    config.read()
+    REQUEST_COUNTER.install()
+    if semaphore is not None:
+        RequestLimiter(semaphore, url).install()
+    _progress_queue = progress_queue
+
+
+def run_shard(
+    cfg_shard: dict, shard: int, shard_range: Range, window: str
+) -> Tuple[int, List[StageMetrics], StageMetrics]:
+    """
+    QC of a shard in a worker process: the fetch range of `cfg_shard` is
+    checked in windows, only the observations within `shard_range` are
+    patched.
+
+    Returns:
+        Tuple[int, List[StageMetrics], StageMetrics]: number of patched
+            observations, stages and total of the shard.
+    """
+    cfg = OmegaConf.create(cfg_shard)
+    url_batch = urljoin(cfg.data_api.base_url + "/", "$batch")
+    auth_in = get_auth(cfg)
+    metrics = RunMetrics()
+
+    def on_chunk(end: datetime, nb_observations: int) -> None:
+        if _progress_queue is not None:
+            _progress_queue.put((shard, end, nb_observations))
+
+    with FetchSession(), open_seavox_regions(cfg) as seavox_regions, get_patch_writer(
+        cfg, url_batch, auth_in
+    ) as writer:
+        nb_patched = run_streaming(
+            cfg,  # type: ignore
+            url_batch,
+            auth_in,
+            writer,
+            metrics=metrics,
+            chunk=window,
+            on_chunk=on_chunk,
+            patch_range=shard_range,
+            seavox_regions=seavox_regions,
+        )
+    return nb_patched, list(metrics.stages.values()), metrics.get_total()
+
+
+def run_shards(
+    cfg: QCconf,
+    shard_ranges: List[Range],
+    window: str,
+    progress: Progress,
+    metrics: RunMetrics,
+) -> int:
+    """
+    Run the shards in `len(shard_ranges)` worker processes, with at most
+    `historical.max_requests` concurrent requests to FROST in total.
+
+    Returns:
+        int: number of patched observations.
+    """
+    fetch_ranges = get_shard_fetch_ranges(cfg, shard_ranges)
+    max_requests = get_max_requests(cfg)
+    for key_i in ["other.cache", "QC_global.zscore.state"]:
+        if OmegaConf.select(cfg, key_i, default=None):
+            log.warning(f"{key_i} isn't used by the shards.")
+    prepare_resources(cfg)
+    ctx = multiprocessing.get_context("forkserver")
+    progress_queue = ctx.Queue()
+    semaphore = ctx.BoundedSemaphore(max_requests) if max_requests else None
+    log.info(
+        f"{len(shard_ranges)} shards, fetched with margins: "
+        + ", ".join(f"{ti0} - {ti1}" for ti0, ti1 in fetch_ranges)
+        + f" (at most {max_requests or 'unlimited'} concurrent requests)."
+    )
+
+    nb_patched = 0
+    with ProcessPoolExecutor(
+        max_workers=len(shard_ranges),
+        mp_context=ctx,
+        initializer=init_shard_worker,
+        initargs=(
+            Path(config.filename).absolute(),
+            progress_queue,
+            semaphore,
+            cfg.data_api.base_url,
+            logging.getLogger().getEffectiveLevel(),
+        ),
+    ) as executor:
+        futures = {
+            executor.submit(
+                run_shard, get_shard_cfg(cfg, fetch_i), i, shard_i, window
+            ): i
+            for i, (shard_i, fetch_i) in enumerate(zip(shard_ranges, fetch_ranges))
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            while True:
+                try:
+                    shard, end, nb_observations = progress_queue.get_nowait()
+                except queue.Empty:
+                    break
+                progress.update(end, nb_observations, shard=shard)
+            for fi in done:
+                # raises the exception of a failed shard
+                nb_patched_i, stages_i, total_i = fi.result()
+                metrics.merge(stages_i, total_i)
+                nb_patched += nb_patched_i
+                log.info(f"Shard {futures[fi]} done: {nb_patched_i} observations patched.")
+    return nb_patched
+
+
+def run_historical(cfg: QCconf, metrics: RunMetrics | None = None) -> int:
+    """
+    QC the configured time range in consecutive windows of
+    `historical.window`, in this process (as `qc_historical/qc_historical.sh`
+    did with a container per window) or split in `historical.shards` shards
+    checked in parallel by worker processes.
+
+    The resources (land polygons, elevation grid, regions) are loaded once
+    (per process), the fetches share a keep-alive session and the next
+    window is fetched while the current one is checked. Instead of fetching
+    an overlap again, each window is checked with the tail of the previous
+    one (the lookback of the stabilization and the rolling windows, see
+    `run_streaming`); a shard fetches this lookback before its range and the
+    horizon after it.
+
+    Returns:
+        int: number of patched observations.
+    """
+    metrics = metrics or RunMetrics()
+    config.filename = Path("outputs/.staconf.ini")
+    set_sta_url(cfg.data_api.base_url)
+    set_dryrun_var(getattr(cfg.data_api, "dry_run", False))
+    url_batch = urljoin(cfg.data_api.base_url + "/", "$batch")
+    auth_in = get_auth(cfg)
+
+    t0, t1 = get_filter_range(cfg)
+    window = get_historical_window(cfg)
+    shard_ranges = get_shard_ranges(t0, t1, window, get_historical_shards(cfg))
+    if len(shard_ranges) > 1 and (cfg.reset.observation_flags or cfg.reset.feature_flags):
+        # a shard would reset the flags in the margins, patched by its neighbours
+        log.warning("The reset of the flags in the database needs a serial run, no shards.")
+        shard_ranges = [(t0, t1)]
+    nb_windows = sum(
+        len(get_chunk_ranges(ti0, ti1, window))
+        for ti0, ti1 in get_shard_fetch_ranges(cfg, shard_ranges)
+    )
+    progress = Progress(shard_ranges, nb_windows)
+    log.info(f"Historical QC of {t0} - {t1} in {nb_windows} windows of {window}.")
+    if len(shard_ranges) > 1:
+        nb_patched = run_shards(cfg, shard_ranges, window, progress, metrics)
+    else:
+        with FetchSession(), open_seavox_regions(cfg) as seavox_regions, get_patch_writer(
+            cfg, url_batch, auth_in
+        ) as writer:
+            nb_patched = run_streaming(
+                cfg,
+                url_batch,
+                auth_in,
+                writer,
+                metrics=metrics,
+                chunk=window,
+                on_chunk=progress.update,
+                seavox_regions=seavox_regions,
+            )
+    progress.log()
+    return nb_patched
+
+
+@hydra.main(config_path="../conf", config_name="config.yaml", version_base="1.2")
+def main(cfg: QCconf):
+    REQUEST_COUNTER.install()
+    metrics = RunMetrics(
+        mode="historical",
+        image_tag=os.environ.get("IMAGE_TAG", None),
+        git_hash=os.environ.get("GIT_HASH", None),
+    )
+    nb_patched = run_historical(cfg, metrics=metrics)
+    log.info(f"Number of observations patched: {nb_patched}.")
+    write_metrics(metrics, Path(HydraConfig.get().runtime.output_dir))
+
+
+if __name__ == "__main__":
+    main()
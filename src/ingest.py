@@ -0,0 +1,120 @@
+import logging
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+from pandassta.df import Df
+
+log = logging.getLogger(__name__)
+
+COLUMNS_IDS = [Df.IOT_ID, Df.DATASTREAM_ID, Df.FEATURE_ID, "observed_property_id"]
+COLUMNS_COORDINATES = [Df.LONG, Df.LAT]
+COLUMNS_CATEGORIES = [Df.OBSERVATION_TYPE, Df.UNITS]
+M_PER_DEGREE = 111_320.0
+DEFAULT_COORDINATE_TOLERANCE = 0.01  # m
+DEFAULT_RESULT_TOLERANCE = 0.0
+
+
+@dataclass
+class PrecisionPolicy:
+    """
+    Dtypes of the fetched observations (`other.ingest`).
+
+    - ids: int32 when all ids fit, int64 otherwise,
+    - coordinates: float32 when the round trip error is at most
+      `coordinate_tolerance` meters. At 1 Hz, the velocity and acceleration
+      checks need centimeters: at mid latitudes (float32 resolution of about
+      0.4 m) the coordinates stay float64 with the default tolerance,
+    - results: float32 when the round trip error is at most `result_tolerance`
+      (0: only if they are exactly representable),
+    - observation types and units: categoricals.
+    """
+
+    coordinate_tolerance: float = DEFAULT_COORDINATE_TOLERANCE
+    result_tolerance: float = DEFAULT_RESULT_TOLERANCE
+
+
+def get_precision_policy(cfg) -> PrecisionPolicy | None:
+    if not OmegaConf.select(cfg, "other.ingest.compact", default=False):
+        return None
+    return PrecisionPolicy(
+        coordinate_tolerance=OmegaConf.select(
+            cfg,
+            "other.ingest.coordinate_tolerance",
+            default=DEFAULT_COORDINATE_TOLERANCE,
+        ),
+        result_tolerance=OmegaConf.select(
+            cfg, "other.ingest.result_tolerance", default=DEFAULT_RESULT_TOLERANCE
+        ),
+    )
+
+
+def fits_int32(values: np.ndarray) -> bool:
+    info = np.iinfo(np.int32)
+    return values.size == 0 or (values.min() >= info.min and values.max() <= info.max)
+
+
+def get_float32_error(values: np.ndarray) -> float:
+    # max absolute round trip error, NaN are kept
+    if values.size == 0:
+        return 0.0
+    error = np.abs(values.astype(np.float32).astype(np.float64) - values)
+    return float(np.nanmax(error)) if not np.isnan(error).all() else 0.0
+
+
+def compact_dtypes(df: pd.DataFrame, policy: PrecisionPolicy) -> pd.DataFrame:
+    """
+    Downcast the columns of the fetched observations according to `policy`.
+    Columns which don't meet the policy keep their dtype.
+    """
+    if df.empty:
+        return df
+    bytes_in = df.memory_usage(deep=True).sum()
+    changes = []
+    for ci in COLUMNS_IDS:
+        if ci not in df.columns or df[ci].dtype != np.int64:
+            continue
+        if fits_int32(df[ci].to_numpy()):
+            df[ci] = df[ci].astype(np.int32)
+            changes.append(f"{ci} int32")
+        else:
+            log.warning(f"Ids of {ci} out of the int32 range, kept as int64.")
+
+    coordinates = [
+        ci for ci in COLUMNS_COORDINATES if ci in df.columns and df[ci].dtype == np.float64
+    ]
+    if coordinates:
+        # degrees to meters (upper bound, the longitude degrees are shorter)
+        error = max(get_float32_error(df[ci].to_numpy()) for ci in coordinates) * M_PER_DEGREE
+        if error <= policy.coordinate_tolerance:
+            for ci in coordinates:
+                df[ci] = df[ci].astype(np.float32)
+            changes.append("coordinates float32")
+        else:
+            log.info(
+                f"Coordinates kept as float64 (float32 error {error:.3f} m > {policy.coordinate_tolerance} m)."
+            )
+
+    if Df.RESULT in df.columns and df[Df.RESULT].dtype == np.float64:
+        error = get_float32_error(df[Df.RESULT].to_numpy())
+        if error <= policy.result_tolerance:
+            df[Df.RESULT] = df[Df.RESULT].astype(np.float32)
+            changes.append("results float32")
+
+    for ci in COLUMNS_CATEGORIES:
+        if ci in df.columns and not isinstance(df[ci].dtype, pd.CategoricalDtype):
+            df[ci] = df[ci].astype("category")
+            changes.append(f"{ci} category")
+
+    log_memory_report(df, bytes_in, changes)
+    return df
+
+
+def log_memory_report(df: pd.DataFrame, bytes_in: int, changes: list[str]) -> None:
+    bytes_out = df.memory_usage(deep=True).sum()
+    log.info(
+        f"Compact ingest of {df.shape[0]} observations: {bytes_in / 2**20:.1f} MiB -> "
+        f"{bytes_out / 2**20:.1f} MiB ({', '.join(changes) or 'no changes'})."
+    )
+    log.debug(f"Memory per column (bytes): {df.memory_usage(deep=True).to_dict()}")
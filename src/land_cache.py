@@ -0,0 +1,176 @@
+import logging
+import math
+import tempfile
+import threading
+from pathlib import Path
+from typing import Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+log = logging.getLogger(__name__)
+
+CRS_NE = "EPSG:4326"
+DEFAULT_MARGIN = 1.0  # degrees around the track
+DEFAULT_GRID = 1.0  # the bbox is snapped outward on this grid (degrees)
+
+BBox = Tuple[float, float, float, float]
+
+
+def get_bbox(
+    geometry: gpd.GeoSeries, margin: float = DEFAULT_MARGIN, grid: float = DEFAULT_GRID
+) -> BBox | None:
+    """
+    Bounding box (minx, miny, maxx, maxy) of the points with a margin, snapped
+    outward on the grid so that similar tracks share a cached clip. None if
+    there are no valid coordinates.
+    """
+    bounds = geometry.bounds.to_numpy()
+    if not np.isfinite(bounds).any():
+        return None
+    minx, miny = np.nanmin(bounds[:, :2], axis=0) - margin
+    maxx, maxy = np.nanmax(bounds[:, 2:], axis=0) + margin
+    return (
+        max(math.floor(minx / grid) * grid, -180.0),
+        max(math.floor(miny / grid) * grid, -90.0),
+        min(math.ceil(maxx / grid) * grid, 180.0),
+        min(math.ceil(maxy / grid) * grid, 90.0),
+    )
+
+
+def bbox_contains(bbox: BBox, bbox_other: BBox) -> bool:
+    return (
+        bbox[0] <= bbox_other[0]
+        and bbox[1] <= bbox_other[1]
+        and bbox[2] >= bbox_other[2]
+        and bbox[3] >= bbox_other[3]
+    )
+
+
+class LandCache:
+    """
+    Land polygons of a Natural Earth shapefile clipped to a bounding box.
+
+    A clip is read once from the shapefile (only the features intersecting the
+    bbox), stored as a feather file in `folder`
+    (`<stem>_<mtime>_<minx>_<miny>_<maxx>_<maxy>.feather`) and kept in memory
+    with its STRtree and prepared polygons. Any clip containing the requested bbox is reused, in
+    memory or on disk. The mtime of the shapefile is part of the key, an
+    updated shapefile is clipped again.
+    """
+
+    _lock = threading.RLock()
+    _memory: dict[Tuple[str, int, BBox], gpd.GeoDataFrame] = {}
+
+    def __init__(
+        self,
+        path_shp: Path | str,
+        folder: Path | str | None = None,
+        margin: float = DEFAULT_MARGIN,
+        grid: float = DEFAULT_GRID,
+    ):
+        self.path_shp = Path(path_shp)
+        self.folder = (
+            Path(folder)
+            if folder is not None
+            else self.path_shp.parent.joinpath("ne_land_cache")
+        )
+        self.margin = margin
+        self.grid = grid
+
+    @property
+    def key(self) -> Tuple[str, int]:
+        return str(self.path_shp.absolute()), self.path_shp.stat().st_mtime_ns
+
+    def get_file(self, bbox: BBox) -> Path:
+        name = "_".join(
+            [self.path_shp.stem, str(self.key[1])] + [f"{vi:g}" for vi in bbox]
+        )
+        return self.folder.joinpath(f"{name}.feather")
+
+    def _find_file(self, bbox: BBox) -> Path | None:
+        prefix = f"{self.path_shp.stem}_{self.key[1]}_"
+        for file_i in self.folder.glob(f"{prefix}*.feather"):
+            try:
+                bbox_i = tuple(float(vi) for vi in file_i.stem[len(prefix):].split("_"))
+            except ValueError:
+                continue
+            if len(bbox_i) == 4 and bbox_contains(bbox_i, bbox):  # type: ignore
+                return file_i
+        return None
+
+    def _clip(self, bbox: BBox) -> gpd.GeoDataFrame:
+        log.info(f"Clipping {self.path_shp} to {bbox}.")
+        df_land = gpd.read_file(self.path_shp, bbox=bbox, columns=[])
+        geometry = shapely.intersection(df_land.geometry.values, shapely.box(*bbox))
+        df_land = gpd.GeoDataFrame(
+            geometry=gpd.GeoSeries(geometry, crs=df_land.crs or CRS_NE)
+        )
+        df_land = df_land.loc[~df_land.geometry.is_empty].reset_index(drop=True)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        file = self.get_file(bbox)
+        # a unique name, the shards (processes) may clip the same bbox at once
+        with tempfile.NamedTemporaryFile(
+            dir=self.folder, prefix=f"{file.stem}_", suffix=".tmp", delete=False
+        ) as file_tmp:
+            path_tmp = Path(file_tmp.name)
+        try:
+            df_land.to_feather(path_tmp)
+            path_tmp.replace(file)
+        finally:
+            path_tmp.unlink(missing_ok=True)
+        return df_land
+
+    def get(self, bbox: BBox) -> gpd.GeoDataFrame:
+        key = self.key
+        with self._lock:
+            for (path_i, mtime_i, bbox_i), df_land in self._memory.items():
+                if (path_i, mtime_i) == key and bbox_contains(bbox_i, bbox):
+                    return df_land
+            file = self._find_file(bbox)
+            if file is not None:
+                df_land = gpd.read_feather(file)
+                bbox = tuple(float(vi) for vi in file.stem.split("_")[-4:])  # type: ignore
+            else:
+                df_land = self._clip(bbox)
+            # build the STRtree and prepare the polygons once
+            df_land.sindex
+            shapely.prepare(np.asarray(df_land.geometry.values))
+            self._memory[key + (bbox,)] = df_land
+            return df_land
+
+    def get_bool_land(self, df: gpd.GeoDataFrame) -> pd.Series:
+        """
+        Points of `df` within the land polygons, as
+        `df_qc_tools.qc.get_bool_natural_earth_land`.
+        """
+        geometry = df.geometry if df.crs is None else df.geometry.to_crs(CRS_NE)
+        bool_out = np.zeros(df.shape[0], dtype=bool)
+        bbox = get_bbox(geometry, margin=self.margin, grid=self.grid)
+        if bbox is not None:
+            df_land = self.get(bbox)
+            # candidates on the bounding boxes, then point in prepared polygon
+            idx_points, idx_land = df_land.sindex.query(geometry.values)
+            bool_in = shapely.contains_xy(
+                np.asarray(df_land.geometry.values)[idx_land],
+                geometry.x.to_numpy()[idx_points],
+                geometry.y.to_numpy()[idx_points],
+            )
+            bool_out[idx_points[bool_in]] = True
+        return pd.Series(bool_out, index=df.index)
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._memory.clear()
+
+
+def get_bool_natural_earth_land_cached(
+    df: gpd.GeoDataFrame,
+    path_shp: Path | str,
+    folder: Path | str | None = None,
+    margin: float = DEFAULT_MARGIN,
+) -> pd.Series:
+    return LandCache(path_shp, folder=folder, margin=margin).get_bool_land(df)
@@ -1,37 +1,28 @@
-import copy
 import logging
 import os
 import queue
 import sys
 import threading
-import time
+from collections import Counter
+from concurrent.futures import Future
 from datetime import datetime, timedelta
 from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional, Tuple
 from urllib.parse import urljoin
 
 import aenum
-import geopandas as gpd
 import hydra
+import numpy as np
 import pandas as pd
 from df_qc_tools.config import QCconf, filter_cfg_to_query
 from df_qc_tools.qc import (
     FEATURES_BODY_TEMPLATE,
-    QCFlagConfig,
-    calc_gradient_results,
-    calc_zscore_results,
-    get_bool_depth_above_treshold,
     get_bool_exceed_max_acceleration,
     get_bool_exceed_max_velocity,
     get_bool_land_region,
-    get_bool_natural_earth_land,
     get_bool_null_region,
-    get_bool_out_of_range,
-    get_bool_spacial_outlier_compared_to_median,
-    get_qc_flag_from_bool,
     qc_dependent_quantity_base,
-    qc_dependent_quantity_secondary,
     update_flag_history_series,
 )
 from dotenv import load_dotenv
@@ -41,7 +32,6 @@ from pandassta.df import (
     Df,
     QualityFlags,
     df_type_conversions,
-    get_dt_velocity_and_acceleration_series,
 )
 from pandassta.sta import Entities, Properties, Settings
 from pandassta.sta_requests import (
@@ -57,12 +47,84 @@ from pandassta.sta_requests import (
     set_sta_url,
     write_patch_to_file,
 )
-from searegion_detection.pandaseavox import intersect_df_region
+
+from dag import Stage, get_stage_threads, run_stages
+from elevation import get_bool_depth_above_threshold_grid
+from flags import (
+    CodedQCFlagConfig,
+    get_bool_evaluated,
+    get_bool_out_of_range_columns,
+    get_codes,
+    get_flag_code,
+    get_flags,
+    keep_new,
+    max_codes,
+    scatter_codes,
+)
+from gradient import get_previous_samples
+from ingest import compact_dtypes, get_precision_policy
+from land_cache import get_bool_natural_earth_land_cached
+from metrics import REQUEST_COUNTER, RunMetrics
+from obs_cache import (
+    DEFAULT_GRADIENT_LOOKBACK,
+    DEFAULT_REVALIDATE,
+    ObservationCache,
+    get_data_cached,
+)
+from outlier import get_bool_spacial_outlier, get_dt_velocity_and_acceleration
+from parallel import (
+    COLUMNS_STAGE,
+    get_workers,
+    gradient_stage,
+    run_per_datastream,
+    zscore_stage,
+)
+from patch_writer import PatchWriter, gather_futures, get_nb_failed, get_patch_writer
+from patching import (
+    PatchCounter,
+    get_changed_features,
+    get_changed_observations,
+    keep_fetched_flags,
+    set_fetched_flags,
+)
+from seavox import SeaVoxRegions, get_seavox_regions, open_seavox_regions
+from streaming import (
+    StreamState,
+    get_chunk_ranges,
+    get_filter_range,
+    get_filter_time_range,
+    get_max_sampling_interval,
+    get_sampling_interval,
+    get_stabilization_configs,
+    get_stream_horizon,
+    get_stream_lookback,
+    get_zscore_time_window,
+    iter_done,
+    iter_prefetched,
+    utc_now,
+)
+from track import Track, TrackBoolFunction
+from zscore import (
+    COLUMNS_STATE,
+    METHOD_ONLINE,
+    get_zscore_engine,
+    get_zscore_method,
+    get_zscore_state_path,
+)
 
 log = logging.getLogger(__name__)
 
 load_dotenv()
 
+COLUMNS_DEPENDENT = [
+    Df.IOT_ID,
+    Df.DATASTREAM_ID,
+    Df.TIME,
+    Df.RESULT,
+    Df.QC_FLAG,
+    Df.OBSERVATION_TYPE,
+]
+
 
 def get_date_from_string(
     str_in: str, str_format_in: str = "%Y-%m-%d %H:%M", str_format_out: str = "%Y%m%d"
@@ -146,52 +208,299 @@ def write_datastreamid_yaml_template(thing_id, file: Path) -> None:
 def combine_df_all_w_dependency_output(
     df: pd.DataFrame, dependency_flags: pd.Series
 ) -> pd.Series:
-    df["idx"] = df.index
-    df = df.set_index(Df.IOT_ID)
-    df[Df.QC_FLAG] = df[Df.QC_FLAG].combine(dependency_flags.astype(CAT_TYPE), max, QualityFlags.NO_QUALITY_CONTROL).astype(CAT_TYPE)  # type: ignore
+    # dependency_flags is indexed by IOT_ID, the observations without
+    # dependency flag are merged with NO_QUALITY_CONTROL
+    codes_dependency = scatter_codes(
+        pd.Index(df[Df.IOT_ID]),
+        dependency_flags.index,
+        get_codes(dependency_flags),
+        get_flag_code(QualityFlags.NO_QUALITY_CONTROL),
+    )
+    codes = max_codes(get_codes(df[Df.QC_FLAG]), codes_dependency)
+    return get_flags(codes, df.index).rename(Df.QC_FLAG)
+
+
+def qc_dependent_quantities(
+    df: pd.DataFrame,
+    independent: int,
+    dependents: list[int],
+    range_: tuple[float, float],
+    dt_tolerance: str,
+) -> pd.Series:
+    """
+    Base and secondary dependent quantity flags of all the dependents of an
+    independent datastream, with a single merge_asof of the dependent
+    observations on the independent ones.
+
+    Same flags as qc_dependent_quantity_base, qc_dependent_quantity_secondary
+    and combine_df_all_w_dependency_output per dependent:
+    - base: a dependent observation gets the flag of the matching independent
+      observation when that flag is not NO_QUALITY_CONTROL or GOOD, BAD when
+      there is no match within dt_tolerance (the worst flag is kept).
+    - secondary: BAD when the result of the matching independent observation
+      is out of `range_`.
+
+    Args:
+        df (pd.DataFrame): observations.
+        independent (int): independent datastream id.
+        dependents (list[int]): dependent datastream ids.
+        range_ (tuple[float, float]): allowed range of the independent result.
+        dt_tolerance (str): max time between a dependent observation and the
+            preceding independent observation.
+
+    Returns:
+        pd.Series: updated QC flags.
+    """
+    codes = df[Df.QC_FLAG].astype(CAT_TYPE).cat.codes.to_numpy().copy()
+    pos_dep = np.flatnonzero(df[Df.DATASTREAM_ID].isin(dependents).to_numpy())
+    pos_indep = np.flatnonzero((df[Df.DATASTREAM_ID] == independent).to_numpy())
+    if pos_dep.size:
+        times = df[Df.TIME].reset_index(drop=True)
+        df_merged = pd.merge_asof(
+            pd.DataFrame({Df.TIME: times.iloc[pos_dep], "pos": pos_dep}).sort_values(
+                Df.TIME, kind="stable"
+            ),
+            pd.DataFrame(
+                {Df.TIME: times.iloc[pos_indep], "pos_indep": pos_indep}
+            ).sort_values(Df.TIME, kind="stable"),
+            on=Df.TIME,
+            tolerance=pd.Timedelta(dt_tolerance),
+        )
+        pos_d = df_merged["pos"].to_numpy()
+        bool_match = df_merged["pos_indep"].notna().to_numpy()
+        pos_i = df_merged.loc[bool_match, "pos_indep"].to_numpy(dtype=np.int64)
+
+        code_i = np.full(pos_d.size, -1, dtype=codes.dtype)
+        code_i[bool_match] = codes[pos_i]
+        result_i = np.full(pos_d.size, np.nan)
+        result_i[bool_match] = pd.to_numeric(
+            df[Df.RESULT].iloc[pos_i], errors="coerce"
+        ).to_numpy(dtype=float)
+
+        code_bad = CAT_TYPE.categories.get_loc(QualityFlags.BAD)
+        codes_ok = [
+            CAT_TYPE.categories.get_loc(fi)
+            for fi in [QualityFlags.NO_QUALITY_CONTROL, QualityFlags.GOOD]
+        ]
+        # base
+        code_base = np.where(code_i < 0, code_bad, code_i)
+        code_d = np.where(
+            np.isin(code_i, codes_ok), codes[pos_d], np.maximum(codes[pos_d], code_base)
+        )
+        # secondary
+        with np.errstate(invalid="ignore"):
+            bool_range = (result_i < range_[0]) | (result_i > range_[1])
+        code_d[bool_range] = np.maximum(code_d[bool_range], code_bad)
+        codes[pos_d] = code_d
+    return pd.Series(
+        pd.Categorical.from_codes(codes, dtype=CAT_TYPE),  # type: ignore
+        index=df.index,
+        name=Df.QC_FLAG,
+    )
+
+
+def _ffill_positions(mask: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    # position of the last row where mask is True, never crossing a group start
+    positions = np.where(mask | starts, np.arange(mask.shape[0]), 0)
+    return np.maximum.accumulate(positions)
+
+
+def _to_timedelta_series(series: pd.Series) -> pd.Series:
+    # parse the (few) distinct config values instead of every row
+    codes, uniques = pd.factorize(series)
+    return pd.Series(pd.to_timedelta(uniques)[codes], index=series.index)
 
-    df_out = df.set_index("idx", drop=True)
-    df_out.index.name = None
-    return df_out[Df.QC_FLAG]
 
+def limit_value_fctn(group: pd.DataFrame, groupby: str | None = None) -> pd.DataFrame:
+    """
+    Flag the observations of an independent quantity that fall within the
+    stabilization time after the value has been out of limits for longer than
+    the allowed downtime.
+
+    All run-length quantities (time down, time up since, blocks of consecutive
+    WITHIN_LIMITS values and the max downtime per block) are computed with
+    vectorized operations on the complete frame.
+
+    Args:
+        group (pd.DataFrame): time sorted observations.
+        groupby (str | None, optional): column with the independent
+            datastreams. If None, the frame is considered to be a single group.
+
+    Returns:
+        pd.DataFrame: input with the intermediate columns and the QC flag.
+    """
+    if groupby is not None:
+        group = group.sort_values(groupby, kind="stable")
+    nb_rows = group.shape[0]
+    if not nb_rows:
+        return group
+
+    starts = np.zeros(nb_rows, dtype=bool)
+    starts[0] = True
+    if groupby is not None:
+        keys = group[groupby].to_numpy()
+        starts[1:] = keys[1:] != keys[:-1]
+    idx_starts = np.flatnonzero(starts)
+    lengths_groups = np.diff(np.append(idx_starts, nb_rows))
+
+    within = (
+        (group[Df.RESULT] > group["QC_range_min"])
+        & (group[Df.RESULT] < group["QC_range_max"])
+    ).to_numpy()
+    group["WITHIN_LIMITS"] = within
+
+    dt = group[Df.TIME].diff()
+    td_type = dt.dtype
+    dt_i8 = dt.to_numpy().view("i8").copy()
+    dt_i8[starts] = 0
+    cumsum_i8 = np.cumsum(dt_i8)
+    cumsum_i8 -= np.repeat(cumsum_i8[idx_starts], lengths_groups)
+    group["dt"] = dt_i8.view(td_type)
+    group["cumsum"] = cumsum_i8.view(td_type)
+
+    time_down_i8 = cumsum_i8 - cumsum_i8[_ffill_positions(within, starts)]
+    group["time_down"] = time_down_i8.view(td_type)
+
+    mask_up = (
+        group["time_down"] > _to_timedelta_series(group["max_allowed_downtime"])
+    ).to_numpy()
+    time_up_since_i8 = cumsum_i8 - cumsum_i8[_ffill_positions(mask_up, starts)]
+    group["time_up_since"] = time_up_since_i8.view(td_type)
+
+    # blocks of consecutive WITHIN_LIMITS values, numbered from 1 within each group
+    change = starts.copy()
+    change[1:] |= within[1:] != within[:-1]
+    block_cumsum = np.cumsum(change)
+    group["block_id"] = block_cumsum - np.repeat(
+        block_cumsum[idx_starts] - 1, lengths_groups
+    )
 
-def limit_value_fctn(group):
-    g = (group[Df.RESULT] > group["QC_range_min"]) & (
-        group[Df.RESULT] < group["QC_range_max"]
+    # max downtime per "down" block, propagated within the block
+    idx_blocks = np.flatnonzero(change)
+    max_down_blocks = np.where(
+        within[idx_blocks], 0, np.maximum.reduceat(time_down_i8, idx_blocks)
+    )
+    max_downtime_i8 = np.repeat(
+        max_down_blocks, np.diff(np.append(idx_blocks, nb_rows))
+    )
+    group["max_downtime"] = pd.Series(
+        max_downtime_i8.view(td_type), index=group.index
+    ).astype("timedelta64[ns]")
+
+    bool_stabilizing = (
+        group["time_up_since"] < _to_timedelta_series(group["dt_stabilization"])
+    ).to_numpy()
+    group[Df.QC_FLAG] = pd.Categorical.from_codes(
+        np.where(
+            bool_stabilizing,
+            CAT_TYPE.categories.get_loc(QualityFlags.BAD),
+            CAT_TYPE.categories.get_loc(QualityFlags.NO_QUALITY_CONTROL),
+        ),
+        dtype=CAT_TYPE,
     )
-    group["WITHIN_LIMITS"] = g
-
-    group["dt"] = group[Df.TIME].diff().fillna(pd.Timedelta(seconds=0))
-    group["cumsum"] = (group["dt"]).cumsum()
-
-    tmp_down = group["cumsum"].where(group["WITHIN_LIMITS"])
-    tmp_down.iloc[0] = pd.Timedelta(seconds=0)
-    group["time_down"] = group["cumsum"] - tmp_down.ffill()
-
-    tmp_up = group["cumsum"].where((group["time_down"] > group["max_allowed_downtime"]))
-    tmp_up.iloc[0] = pd.Timedelta(seconds=0)
-    group["time_up_since"] = group["cumsum"] - tmp_up.ffill()
-
-    # Group by consecutive WITHIN_LIMITS values
-    group["block_id"] = (
-        group["WITHIN_LIMITS"] != group["WITHIN_LIMITS"].shift()
-    ).cumsum()
-
-    # Calculate max downtime per "down" block and propagate within the block
-    group["max_downtime"] = pd.Timedelta(seconds=0)  # Initialize column
-    for block_id, sub_group in group.groupby("block_id"):
-        if not sub_group["WITHIN_LIMITS"].iloc[0]:  # If the block is a "down" block
-            max_down = sub_group["time_down"].max()
-            group.loc[sub_group.index, "max_downtime"] = max_down
-
-    group[Df.QC_FLAG] = get_qc_flag_from_bool(
-        group["time_up_since"] < group["dt_stabilization"],
-        flag_on_true=QualityFlags.BAD,
-        flag_on_false=QualityFlags.NO_QUALITY_CONTROL,
-    ).astype(CAT_TYPE)
     return group
 
 
+def get_observation_cache(cfg: QCconf) -> ObservationCache | None:
+    path_cache = OmegaConf.select(cfg, "other.cache.path", default=None)
+    if not path_cache:
+        return None
+    return ObservationCache(
+        path_cache,
+        thing_id=cfg.data_api.things.id,
+        revalidate=OmegaConf.select(
+            cfg, "other.cache.revalidate", default=DEFAULT_REVALIDATE
+        ),
+    )
+
+
+def get_datastream_ids(cfg: QCconf) -> list[int] | None:
+    ids = OmegaConf.select(cfg, f"data_api.filter.{Entities.DATASTREAMS}.ids", default=None)
+    return list(ids) if ids else None
+
+
+def get_data(
+    cfg: QCconf,
+    t0: datetime,
+    t1: datetime,
+    filter_cfg_datastreams: str,
+    datastream_ids: list[int] | None,
+    closed_right: bool = False,
+    count_observations: bool = False,
+    message_str: str | None = None,
+    result_queue: Optional[queue.Queue] = None,
+) -> pd.DataFrame:
+    """
+    Get the observations within (t0, t1) (or (t0, t1] if closed_right), from
+    the observation cache if `other.cache` is configured, with compact dtypes
+    if `other.ingest.compact` is set.
+    """
+    cache = get_observation_cache(cfg)
+    if cache is None:
+        df_out = get_all_data(
+            thing_id=cfg.data_api.things.id,
+            filter_cfg=get_filter_time_range(t0, t1, closed_right=closed_right),
+            filter_cfg_datastreams=filter_cfg_datastreams,
+            count_observations=count_observations,
+            message_str=message_str,
+        )
+    else:
+        df_out = get_data_cached(
+            cache,
+            lambda ti0, ti1: get_all_data(
+                thing_id=cfg.data_api.things.id,
+                filter_cfg=get_filter_time_range(ti0, ti1, closed_right=True),
+                filter_cfg_datastreams=filter_cfg_datastreams,
+                count_observations=count_observations,
+                message_str=message_str,
+            ),
+            t0,
+            t1,
+            datastream_ids,
+            closed_right=closed_right,
+            now=utc_now(),
+        )
+    df_out = keep_fetched_flags(df_out)
+    policy = get_precision_policy(cfg)
+    if policy is not None:
+        df_out = compact_dtypes(df_out, policy)
+    if result_queue:
+        result_queue.put(df_out)
+    return df_out
+
+
+def update_cached_flags(cfg: QCconf, df: pd.DataFrame) -> None:
+    # keep the cached flags equal to the patched ones
+    cache = get_observation_cache(cfg)
+    if cache is None or getattr(cfg.data_api, "dry_run", False):
+        return
+    nb_updated = cache.update_flags(df)
+    log.debug(f"Flags of {nb_updated} cached observations updated.")
+
+
+def get_previous_observations(cfg: QCconf, df: pd.DataFrame) -> pd.DataFrame | None:
+    """
+    Last cached observation within `other.cache.gradient_lookback` before
+    the observations of each datastream of `df`, the previous samples of the
+    gradients (a row per datastream, sent to the gradient processes).
+    """
+    cache = get_observation_cache(cfg)
+    if cache is None or df.empty:
+        return None
+    lookback = pd.Timedelta(
+        OmegaConf.select(
+            cfg, "other.cache.gradient_lookback", default=DEFAULT_GRADIENT_LOOKBACK
+        )
+    )
+    t_first = df.groupby(Df.DATASTREAM_ID)[Df.TIME].min()
+    df_cached = cache.read(
+        (t_first.min() - lookback).to_pydatetime(),
+        t_first.max().to_pydatetime(),
+        df[Df.DATASTREAM_ID].unique().tolist(),
+    )
+    return get_previous_samples(df, df_cached)
+
+
 def get_independent_window_data(
     cfg: QCconf,
     count_observations: bool = False,
@@ -229,27 +538,15 @@ def get_independent_window_data(
     )
     datastreams_window_list = [ci.independent for ci in cfg_indep_time]
 
-    filter_window = copy.deepcopy(cfg.data_api.filter)
-    filter_range = getattr(filter_window, Df.TIME).get("range", "")
-    format_range = getattr(filter_window, Df.TIME).get("format", "%Y-%m-%d %H:%M")
-    filter_range[1] = copy.deepcopy(filter_range[0])
-    filter_range[0] = datetime.strftime(
-        datetime.strptime(filter_range[0], format_range) - width_hours_window,
-        format_range,
-    )
-
-    filter_window_cfg = filter_cfg_to_query(filter_window)
+    t0, t1 = get_filter_range(cfg)
     filter_window_cfg_datastreams = f"{Properties.IOT_ID} in {str(tuple(datastreams_window_list)).replace(',)',')')}"
 
-    thing_id = cfg.data_api.things.id
-    std_filter_cfg = filter_cfg_to_query(cfg.data_api.filter)
-    filter_cfg_datastreams = filter_cfg_to_query(
-        cfg.data_api.filter, level=Entities.DATASTREAMS
-    )
-    df_default_window = get_all_data(
-        thing_id=thing_id,
-        filter_cfg=std_filter_cfg,
+    df_default_window = get_data(
+        cfg,
+        t0,
+        t1,
         filter_cfg_datastreams=filter_window_cfg_datastreams,
+        datastream_ids=datastreams_window_list,
         message_str=f"Indep std window",
     )
     if df_default_window.empty:
@@ -260,10 +557,12 @@ def get_independent_window_data(
         return 0
 
     else:
-        df_additional_window = get_all_data(
-            thing_id=thing_id,
-            filter_cfg=filter_window_cfg,
+        df_additional_window = get_data(
+            cfg,
+            t0 - width_hours_window,
+            t0,
             filter_cfg_datastreams=filter_window_cfg_datastreams,
+            datastream_ids=datastreams_window_list,
             message_str=f"additional",
         )
 
@@ -277,97 +576,22 @@ def get_independent_window_data(
     return df_out
 
 
-@hydra.main(config_path="../conf", config_name="config.yaml", version_base="1.2")
-def main(cfg: QCconf):
-    log_extra = logging.getLogger(name="extra")
-    log_extra.setLevel(logging.INFO)
-    rootlog = logging.getLogger()
-    extra_log_file = Path(
-        getattr(rootlog.handlers[1], "baseFilename", "./")
-    ).parent.joinpath("history.log")
-    file_handler_extra = logging.FileHandler(extra_log_file)
-    file_handler_extra.setFormatter(rootlog.handlers[0].formatter)
-    log_extra.addHandler(file_handler_extra)
-
-    def custom_exception_handler(exc_type, exc_value, exc_traceback):
-        # Log the exception
-        log.error("Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback))
-
-        # Call the default exception hook (prints the traceback and exits)
-        sys.__excepthook__(exc_type, exc_value, exc_traceback)
-
-    sys.excepthook = custom_exception_handler
-
-    t0 = time.time()
-    docker_image_tag = os.environ.get("IMAGE_TAG", None)
-    if docker_image_tag:
-        log.info(f"Docker image tag: {docker_image_tag}.")
-    git_hash = os.environ.get("GIT_HASH", None)
-    if git_hash:
-        log.info(f"Current git commit hash: {git_hash}.")
-
-    log.info("Start")
-    history_series = pd.Series()
-
-    # setup
-    log.info("Setup")
-    t_df0 = time.time()
-    config.filename = Path("outputs/.staconf.ini")
-    set_sta_url(cfg.data_api.base_url)
-    set_dryrun_var(getattr(cfg.data_api, "dry_run", False))
-    url_batch = urljoin(cfg.data_api.base_url + "/", "$batch")
 
+def get_auth(cfg: QCconf) -> tuple | None:
     auth_tuple = (
         getattr(cfg.data_api, "auth", {}).get("username", None),
         getattr(cfg.data_api, "auth", {}).get("passphrase", None),
     )
     auth_in = [None, auth_tuple][all(auth_tuple)]
+    return auth_in
 
-    thing_id = cfg.data_api.things.id
 
-    filter_cfg = filter_cfg_to_query(cfg.data_api.filter)
-    filter_cfg_datastreams = filter_cfg_to_query(
-        cfg.data_api.filter, level=Entities.DATASTREAMS
-    )
-
-    # get data in dataframe
-    # write_datastreamid_yaml_template(thing_id=thing_id, file=Path("/tmp/test.yaml"))
-
-    queue_independent_timewindow = queue.Queue()
-    thread_df_independent_timewindow = threading.Thread(
-        target=get_independent_window_data,
-        name="independent_timewindow",
-        kwargs={
-            "cfg": cfg,
-            "count_observations": False,
-            "message_str": f"Get data independent time window.",
-            "result_queue": queue_independent_timewindow,
-        },
-    )
-    thread_df_independent_timewindow.start()
-
-    queue_all = queue.Queue()
-    thread_df_all = threading.Thread(
-        target=get_all_data,
-        name="all_data",
-        kwargs={
-            "thing_id": thing_id,
-            "filter_cfg": filter_cfg,
-            "filter_cfg_datastreams": filter_cfg_datastreams,
-            "count_observations": cfg.other.count_observations,
-            "message_str": f"Get all data.",
-            "result_queue": queue_all,
-        },
-    )
-    thread_df_all.start()
-    thread_df_all.join()
-    df_all = queue_all.get()
-
-    ## reset flags
+def reset_flags(
+    cfg: QCconf, df_all: pd.DataFrame, url_batch: str, auth_in: tuple | None
+) -> pd.DataFrame:
     RESET_OVERWRITE_FLAGS = cfg.reset.overwrite_flags
     RESET_OBSERVATION_FLAGS = cfg.reset.observation_flags
     RESET_FEATURE_FLAGS = cfg.reset.feature_flags
-    QUIT_AFTER_RESET = cfg.reset.exit
 
     if RESET_OVERWRITE_FLAGS or RESET_FEATURE_FLAGS or RESET_OBSERVATION_FLAGS:
         df_all[Df.QC_FLAG] = QualityFlags.NO_QUALITY_CONTROL
@@ -381,6 +605,8 @@ def main(cfg: QCconf):
             url=url_batch,
             auth=auth_in,
         )
+        df_all = set_fetched_flags(df_all, Df.QC_FLAG, QualityFlags.NO_QUALITY_CONTROL)
+        update_cached_flags(cfg, df_all)
     if RESET_FEATURE_FLAGS:
         counter_reset_features = patch_qc_flags(
             df_all.reset_index(),
@@ -390,22 +616,19 @@ def main(cfg: QCconf):
             url_entity=Entities.FEATURESOFINTEREST,
             json_body_template=FEATURES_BODY_TEMPLATE,
         )
+        df_all = set_fetched_flags(
+            df_all, Df.FEATURE_QC_FLAG, QualityFlags.NO_QUALITY_CONTROL
+        )
+    return df_all
 
-        if QUIT_AFTER_RESET:
-            return 0
-
-    thread_df_independent_timewindow.join()
-    df_independent_timewindow = queue_independent_timewindow.get()
-
-    if df_all.empty:
-        log.warning("Terminating script.")
-        return 0
 
+def qc_dependent_stabilization(
+    cfg: QCconf, df_all: pd.DataFrame, df_independent_timewindow: pd.DataFrame
+) -> pd.DataFrame:
     datastreams_list = df_all[Df.DATASTREAM_ID].unique()
     qc_dep_stabilize_configs = [
         li for li in getattr(cfg, "QC_dependent", []) if getattr(li, "dt_stabilization", None)
     ]
-    # LOOP STARTS HERE?
     if not df_independent_timewindow.empty:
         for cfg_dep_i in qc_dep_stabilize_configs:
             qc_df_dep_stabilize_i = pd.DataFrame.from_dict(
@@ -423,27 +646,35 @@ def main(cfg: QCconf):
                 ),
                 on="datastream_id",
             )
-            df_independent_grouped = df_independent_timewindow_i.sort_values(
-                Df.TIME
-            ).groupby(by=[Df.DATASTREAM_ID], group_keys=False)
-
-            df_independent_tmp = df_independent_grouped[
-                [
-                    str(Df.IOT_ID),
-                    str(Df.RESULT),
-                    str(Df.DATASTREAM_ID),
-                    str(Df.TIME),
-                    "max_allowed_downtime",
-                    "dt_stabilization",
-                    "QC_range_min",
-                    "QC_range_max",
-                ]
-            ].apply(limit_value_fctn)
+            df_independent_tmp = limit_value_fctn(
+                df_independent_timewindow_i.sort_values(Df.TIME)[
+                    [
+                        str(Df.IOT_ID),
+                        str(Df.RESULT),
+                        str(Df.DATASTREAM_ID),
+                        str(Df.TIME),
+                        "max_allowed_downtime",
+                        "dt_stabilization",
+                        "QC_range_min",
+                        "QC_range_max",
+                    ]
+                ],
+                groupby=Df.DATASTREAM_ID,
+            )
 
             independent_i = getattr(cfg_dep_i, "independent")
             if not df_independent_tmp.empty:
-                df_all_w_dependent = df_all.merge(
-                    df_independent_tmp,
+                dependent_list_i = [
+                    int(dep_i)
+                    for dep_i in str(getattr(cfg_dep_i, "dependent", [])).split(",")
+                    if int(dep_i) in datastreams_list
+                ]
+                # only the rows and columns used by qc_dependent_quantity_base
+                df_all_w_dependent = df_all.loc[
+                    df_all[Df.DATASTREAM_ID].isin([independent_i] + dependent_list_i),
+                    COLUMNS_DEPENDENT,
+                ].merge(
+                    df_independent_tmp[[Df.IOT_ID, Df.QC_FLAG]],
                     on=Df.IOT_ID,
                     how="left",
                     suffixes=("", "_independent"),
@@ -451,13 +682,14 @@ def main(cfg: QCconf):
                 df_all_w_dependent[Df.QC_FLAG + "_independent"] = df_all_w_dependent[
                     Df.QC_FLAG + "_independent"
                 ].fillna(QualityFlags.NO_QUALITY_CONTROL)
-                df_all_w_dependent[Df.QC_FLAG] = df_all_w_dependent[Df.QC_FLAG].combine(df_all_w_dependent[Df.QC_FLAG + "_independent"], max, QualityFlags.NO_QUALITY_CONTROL).astype(CAT_TYPE)  # type: ignore
+                df_all_w_dependent[Df.QC_FLAG] = get_flags(
+                    max_codes(
+                        get_codes(df_all_w_dependent[Df.QC_FLAG]),
+                        get_codes(df_all_w_dependent[Df.QC_FLAG + "_independent"]),
+                    ),
+                    df_all_w_dependent.index,
+                )
 
-                dependent_list_i = [
-                    int(dep_i)
-                    for dep_i in str(getattr(cfg_dep_i, "dependent", [])).split(",")
-                    if int(dep_i) in datastreams_list
-                ]
                 tolerance_i = getattr(cfg_dep_i, "dt_tolerance")
 
                 for dependent_ii in dependent_list_i:
@@ -494,8 +726,10 @@ def main(cfg: QCconf):
                 log.warning(f"No data for independent datastream {independent_i}")
     else:
         log.warning("Skipping QC_dependent!")
-    nb_observations = df_all.shape[0]
-    df_all = gpd.GeoDataFrame(df_all, geometry=gpd.points_from_xy(df_all[Df.LONG], df_all[Df.LAT]), crs=cfg.location.crs)  # type: ignore
+    return df_all
+
+
+def get_qc_df(cfg: QCconf) -> pd.DataFrame:
     # get qc check df (try to find clearer name)
     qc_config_dict = {getattr(li, "id"): li for li in cfg.QC}
     qc_df = pd.DataFrame.from_dict(qc_config_dict, orient="index")
@@ -509,363 +743,911 @@ def main(cfg: QCconf):
             print(qc_type)
 
     ## setup needed columns. Should these be removed?
-    t_ranges0 = time.time()
     for qc_type in qc_df.keys():
         qc_df[[f"qc_{'_'.join([qc_type, i])}" for i in ["min", "max"]]] = qc_df.pop(
             qc_type
         ).apply(pd.Series)
+    return qc_df
 
-    df_all = calc_gradient_results(df_all, Df.DATASTREAM_ID)
-    # df_all = calc_zscore_results(df_all, Df.DATASTREAM_ID)
-    columns_at_start_tmp = df_all.columns.tolist()
-
-    t_df1 = time.time()
-    t_qc0 = time.time()
-
-    ## find region
-    t_region0 = time.time()
-    if getattr(cfg, "location", {}).get("connection", None):
-        df_all = intersect_df_region(
-            db_credentials=cfg.location.connection,
-            df=df_all,
-            max_queries=5,
-            max_query_points=20,
-        )
 
-        qc_flag_config_nan_region = QCFlagConfig(
-            "Region nan",
-            get_bool_null_region,
-            max,
-            QualityFlags.PROBABLY_GOOD,
-            QualityFlags.NO_QUALITY_CONTROL,
+def get_track_rows(track: Track, **kwargs) -> int:
+    return track.df.shape[0]
+
+
+def run_qc(
+    cfg: QCconf,
+    df_all: pd.DataFrame,
+    history_series: pd.Series,
+    on_features_flagged: Optional[Callable[[pd.DataFrame], None]] = None,
+    metrics: Optional[RunMetrics] = None,
+    seavox_regions: Optional[SeaVoxRegions] = None,
+) -> Tuple[pd.DataFrame, pd.Series, pd.Series]:
+    """
+    Run the QC checks (location, velocity, ranges, gradient, z-score and
+    dependent quantities) on the observations.
+
+    The checks which don't depend on each other run as concurrent stages
+    (`dag.run_stages`, other.stage_threads), their flags are merged afterwards
+    in a fixed order: regions, land, depth on land, spacial outliers, range
+    and gradient. The z-score (on the observations flagged good so far) and
+    the dependent quantities follow.
+
+    Args:
+        cfg (QCconf): configuration.
+        df_all (pd.DataFrame): observations, after the stabilization check.
+        history_series (pd.Series): flag history to update.
+        on_features_flagged (Optional[Callable[[pd.DataFrame], None]], optional):
+            called as soon as the feature flags are final (e.g. to start the
+            patching while the other checks run).
+        metrics (Optional[RunMetrics], optional): run metrics, to which the
+            stages are added.
+        seavox_regions (Optional[SeaVoxRegions], optional): region lookup of
+            the caller (e.g. `open_seavox_regions`, once for all chunks),
+            otherwise one is created for this call from location.seavox.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.Series, pd.Series]: flagged observations,
+            flag history and the spacial outliers.
+    """
+    datastreams_list = df_all[Df.DATASTREAM_ID].unique()
+    nb_observations = df_all.shape[0]
+    metrics = metrics or RunMetrics()
+    qc_df = get_qc_df(cfg)
+    workers = get_workers(cfg)
+
+    # final order and index of the observations, the stages below refer to it
+    df_all = df_all.sort_values(Df.TIME)
+    df_all.index = pd.RangeIndex(df_all.shape[0])
+    # as a left merge on the datastream ids (RangeIndex), without copying df_all
+    for ci in qc_df.columns:
+        df_all[ci] = df_all[qc_df.index.name].map(qc_df[ci])
+    if nb_observations != df_all.shape[0]:
+        raise RuntimeError("Not all observations are included in the dataframe.")
+
+    path_resources = Path().absolute().joinpath("resources")
+    seavox_regions_owned = None
+    if seavox_regions is None:
+        seavox_regions = seavox_regions_owned = get_seavox_regions(cfg)
+
+    def get_region(track: Track) -> pd.DataFrame:
+        return seavox_regions.intersect_df_region(track.df)  # type: ignore
+
+    def get_depth_ne_land(
+        track: Track, location_land: TrackBoolFunction, etop_file: Path
+    ) -> TrackBoolFunction | None:
+        if not location_land.bool_track.any():  # type: ignore
+            return None
+        return track.on_track(
+            partial(
+                get_bool_depth_above_threshold_grid,
+                threshold=0.0,
+                mask_to_check=location_land.bool_track,
+                etop_file=etop_file,
+            )
+        ).evaluate()
+
+    def check_velocity_acceleration(
+        track: Track, location_spacial_outlier: TrackBoolFunction
+    ) -> None:
+        ## velocity and acceleration calculations
+        df_track_valid = track.df.loc[~location_spacial_outlier.bool_track]  # type: ignore
+        # once on the track positions, shared by the velocity and acceleration checks
+        df_dt_velocity_and_acceleration = get_dt_velocity_and_acceleration(
+            df_track_valid  #  type: ignore
         )
-        df_all[Df.QC_FLAG] = qc_flag_config_nan_region.execute(df_all)
 
-        history_series = update_flag_history_series(
-            history_series, qc_flag_config_nan_region
+        ## velocity
+        qc_flag_config_velocity = CodedQCFlagConfig(
+            "Velocity limit",
+            bool_function=partial(
+                get_bool_exceed_max_velocity,
+                max_velocity=cfg.location.max_dx_dt,
+                velocity_series=df_dt_velocity_and_acceleration["velocity"],
+                dt_series=df_dt_velocity_and_acceleration["dt"],
+            ),
+            bool_merge_function=max,
+            flag_on_true=QualityFlags.BAD,
+            flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
         )
+        qc_flag_config_velocity.execute(df_track_valid)
+        if qc_flag_config_velocity.bool_series.any():
+            log.warning(
+                f"Velocities {qc_flag_config_velocity.bool_series.sum()} exceeding the limiting value detected!"
+            )
+            log.warning(
+                f"Max velocity value: {df_dt_velocity_and_acceleration["velocity"].abs().max():.2f}"
+            )
 
-        qc_flag_config_land_region = QCFlagConfig(
-            "Region mainland",
-            get_bool_land_region,
+        ## acceleration
+        qc_flag_config_acceleration = CodedQCFlagConfig(
+            "Acceleration limit",
+            partial(
+                get_bool_exceed_max_acceleration,
+                max_acceleration=cfg.location.max_ddx_dtdt,
+                acceleration_series=df_dt_velocity_and_acceleration["acceleration"],
+                dt_series=df_dt_velocity_and_acceleration["dt"],
+            ),
             max,
             QualityFlags.BAD,
-            QualityFlags.NO_QUALITY_CONTROL,
+            flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
         )
-        df_all[Df.QC_FLAG] = qc_flag_config_land_region.execute(df_all)
-        history_series = update_flag_history_series(
-            history_series, qc_flag_config_land_region
+        qc_flag_config_acceleration.execute(df_track_valid)
+        if qc_flag_config_acceleration.bool_series.any():
+            log.warning(
+                f"Accelerations {qc_flag_config_acceleration.bool_series.sum()} exceeding the limiting value detected!"
+            )
+            log.warning(
+                f"Max acceleration value: {df_dt_velocity_and_acceleration["acceleration"].abs().max():.2f}"
+            )
+
+    # the stages only read df_all, the location checks run once per position
+    # (on the track) and the flags are merged below in the order of the checks
+    stages = [
+        Stage(
+            "gradient_calc",
+            lambda: run_per_datastream(
+                partial(gradient_stage, df_previous=get_previous_observations(cfg, df_all)),
+                df_all,
+                workers,
+            ),
+            rows=nb_observations,
+        ),
+        Stage("track", lambda: Track(df_all, crs=cfg.location.crs), rows=nb_observations),
+        Stage("etop_file", lambda: get_elev_netcdf(local_folder=path_resources)),
+        Stage("ne_10m_shp", lambda: get_ne_10m_shp(local_folder=path_resources)),
+        Stage(
+            "location_land",
+            lambda track, ne_10m_shp: track.on_track(
+                partial(
+                    get_bool_natural_earth_land_cached,
+                    path_shp=path_resources.joinpath("ne_10m_land.shp"),
+                )
+            ).evaluate(),
+            inputs=("track", "ne_10m_shp"),
+            rows=get_track_rows,
+        ),
+        Stage(
+            "location_depth_ne_land",
+            get_depth_ne_land,
+            inputs=("track", "location_land", "etop_file"),
+            rows=get_track_rows,
+        ),
+        Stage(
+            "location_spacial_outlier",
+            lambda track: track.on_track(
+                partial(
+                    get_bool_spacial_outlier,
+                    max_dx_dt=cfg.location.max_dx_dt,
+                    time_window=cfg.location.time_window,
+                )
+            ).evaluate(),
+            inputs=("track",),
+            rows=get_track_rows,
+        ),
+        Stage(
+            "location_velocity_acceleration",
+            check_velocity_acceleration,
+            inputs=("track", "location_spacial_outlier"),
+            rows=get_track_rows,
+        ),
+        Stage(
+            "range",
+            lambda: get_bool_out_of_range_columns(df_all, qc_on=Df.RESULT, qc_type="range"),
+            rows=nb_observations,
+        ),
+        Stage(
+            "gradient",
+            lambda: get_bool_out_of_range_columns(df_all, qc_on=Df.RESULT, qc_type="gradient"),
+            rows=nb_observations,
+        ),
+    ]
+    if seavox_regions is not None:
+        stages += [
+            Stage("location_region", get_region, inputs=("track",), rows=get_track_rows),
+            Stage(
+                "location_depth",
+                lambda track, location_region, etop_file: track.on_track(
+                    partial(
+                        get_bool_depth_above_threshold_grid,
+                        threshold=0.0,
+                        etop_file=etop_file,
+                    )
+                ).evaluate(location_region),
+                inputs=("track", "location_region", "etop_file"),
+                rows=get_track_rows,
+            ),
+        ]
+    try:
+        outputs = run_stages(
+            stages, threads=get_stage_threads(cfg), processes=workers, metrics=metrics
         )
+    finally:
+        # also when a stage failed (and location_region was cancelled)
+        if seavox_regions_owned is not None:
+            seavox_regions_owned.close()
+    track = outputs["track"]
+
+    with metrics.stage("merge_flags", nb_observations):
+        df_all[Df.GRADIENT] = outputs["gradient_calc"]
+        if seavox_regions is not None:
+            track.df = outputs["location_region"]
+            for ci in [Df.REGION, Df.SUB_REGION]:
+                df_all[ci] = track.broadcast(track.df[ci])
+
+            qc_flag_config_nan_region = CodedQCFlagConfig(
+                "Region nan",
+                track.on_track(get_bool_null_region),
+                max,
+                QualityFlags.PROBABLY_GOOD,
+                QualityFlags.NO_QUALITY_CONTROL,
+            )
+            df_all[Df.QC_FLAG] = qc_flag_config_nan_region.execute(df_all)
 
-        get_elev_netcdf(local_folder=Path().absolute().joinpath("resources"))
-        qc_flag_config_depth_above_threshold = QCFlagConfig(
-            "Depth",
-            partial(get_bool_depth_above_treshold, threshold=0.0),
-            max,
+            history_series = update_flag_history_series(
+                history_series, qc_flag_config_nan_region
+            )
+
+            qc_flag_config_land_region = CodedQCFlagConfig(
+                "Region mainland",
+                track.on_track(get_bool_land_region),
+                max,
+                QualityFlags.BAD,
+                QualityFlags.NO_QUALITY_CONTROL,
+            )
+            df_all[Df.QC_FLAG] = qc_flag_config_land_region.execute(df_all)
+            history_series = update_flag_history_series(
+                history_series, qc_flag_config_land_region
+            )
+
+            qc_flag_config_depth_above_threshold = CodedQCFlagConfig(
+                "Depth",
+                outputs["location_depth"],
+                max,
+                QualityFlags.BAD,
+                QualityFlags.NO_QUALITY_CONTROL,
+            )
+            df_all[Df.QC_FLAG] = qc_flag_config_depth_above_threshold.execute(df_all)
+            history_series = update_flag_history_series(
+                history_series, qc_flag_config_depth_above_threshold
+            )
+
+        feature_bool_merge_function = (max, keep_new)[
+            getattr(cfg.reset, "overwrite_feature_flags", True)
+        ]
+        qc_flag_config_land_ne_shp = CodedQCFlagConfig(
+            "Intersect_ne_land_polynomial",
+            outputs["location_land"],
+            feature_bool_merge_function,
             QualityFlags.BAD,
             QualityFlags.NO_QUALITY_CONTROL,
         )
-        df_all[Df.QC_FLAG] = qc_flag_config_depth_above_threshold.execute(df_all)
-        history_series = update_flag_history_series(
-            history_series, qc_flag_config_depth_above_threshold
+        df_all[Df.FEATURE_QC_FLAG] = qc_flag_config_land_ne_shp.execute(
+            df_all, column=Df.FEATURE_QC_FLAG
+        )
+        df_all[Df.QC_FLAG] = qc_flag_config_land_ne_shp.execute(
+            df_all, column=Df.FEATURE_QC_FLAG
         )
+        history_series = update_flag_history_series(history_series, qc_flag_config_land_ne_shp)
+
+        if outputs["location_depth_ne_land"] is not None:
+            qc_flag_config_depth_above_threshold = CodedQCFlagConfig(
+                "Depth_ne_land",
+                outputs["location_depth_ne_land"],
+                max,
+                QualityFlags.BAD,
+                QualityFlags.NO_QUALITY_CONTROL,
+                QualityFlags.NO_QUALITY_CONTROL,
+            )
+            df_all[Df.QC_FLAG] = qc_flag_config_depth_above_threshold.execute(df_all, column=Df.FEATURE_QC_FLAG)
+            history_series = update_flag_history_series(
+                history_series, qc_flag_config_depth_above_threshold
+            )
 
-    feature_bool_merge_function = (max, lambda x, y: y)[
-        getattr(cfg.reset, "overwrite_feature_flags", True)
-    ]
+        # find geographical outliers
+        qc_flag_config_outlier = CodedQCFlagConfig(
+            "spacial_outliers",
+            # bool_function=lambda x: pd.Series(False, index=x.index), # easiest method to disable this
+            bool_function=outputs["location_spacial_outlier"],
+            bool_merge_function=max,
+            flag_on_true=QualityFlags.BAD,
+            flag_on_nan=QualityFlags.PROBABLY_GOOD,
+        )
+        # df_all[Df.QC_FLAG] = qc_flag_config_outlier.execute(df_all)
+        df_all[Df.FEATURE_QC_FLAG] = qc_flag_config_outlier.execute(
+            df_all, column=Df.FEATURE_QC_FLAG
+        )
+        df_all[Df.QC_FLAG] = qc_flag_config_outlier.execute(
+            df_all, column=Df.FEATURE_QC_FLAG
+        )
 
-    get_ne_10m_shp(local_folder=Path().absolute().joinpath("resources"))
-    qc_flag_config_land_ne_shp = QCFlagConfig(
-        "Intersect_ne_land_polynomial",
-        partial(
-            get_bool_natural_earth_land, path_shp=Path().absolute().joinpath("resources/ne_10m_land.shp")
-        ),
-        feature_bool_merge_function,
-        QualityFlags.BAD,
-        QualityFlags.NO_QUALITY_CONTROL,
-    )
-    df_all[Df.FEATURE_QC_FLAG] = qc_flag_config_land_ne_shp.execute(
-        df_all, column=Df.FEATURE_QC_FLAG
-    )
-    df_all[Df.QC_FLAG] = qc_flag_config_land_ne_shp.execute(
-        df_all, column=Df.FEATURE_QC_FLAG
-    )
-    history_series = update_flag_history_series(history_series, qc_flag_config_land_ne_shp)
+        log.info(
+            f"Detected number of spacial outliers: {df_all.loc[qc_flag_config_outlier.bool_series].shape[0]}."
+        )
 
-    etop_file = get_elev_netcdf(local_folder=Path().absolute().joinpath("resources"))
-    if bool(qc_flag_config_land_ne_shp.bool_series.any()):
-        qc_flag_config_depth_above_threshold = QCFlagConfig(
-            "Depth_ne_land",
-        partial(get_bool_depth_above_treshold, threshold=0.0, mask_to_check=qc_flag_config_land_ne_shp.bool_series, etop_file=etop_file),
-            max,
-            QualityFlags.BAD,
-            QualityFlags.NO_QUALITY_CONTROL,
-            QualityFlags.NO_QUALITY_CONTROL,
+        history_series = update_flag_history_series(history_series, qc_flag_config_outlier)
+
+        qc_flag_config_range = CodedQCFlagConfig(
+            label="Range",
+            bool_function=partial(get_bool_evaluated, bool_series=outputs["range"]),
+            bool_merge_function=max,
+            flag_on_true=QualityFlags.BAD,
+            flag_on_false=QualityFlags.PROBABLY_GOOD,
+            flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
         )
-        df_all[Df.QC_FLAG] = qc_flag_config_depth_above_threshold.execute(df_all, column=Df.FEATURE_QC_FLAG)
-        history_series = update_flag_history_series(
-            history_series, qc_flag_config_depth_above_threshold
+        df_all[Df.QC_FLAG] = qc_flag_config_range.execute(df_all)
+
+        history_series = update_flag_history_series(history_series, qc_flag_config_range)
+
+        qc_flag_config_gradient = CodedQCFlagConfig(
+            label="Gradient",
+            bool_function=partial(get_bool_evaluated, bool_series=outputs["gradient"]),
+            bool_merge_function=max,
+            flag_on_true=QualityFlags.BAD,
+            flag_on_false=QualityFlags.PROBABLY_GOOD,
+            flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
         )
+        df_all[Df.QC_FLAG] = qc_flag_config_gradient.execute(df_all)
+
+        history_series = update_flag_history_series(history_series, qc_flag_config_gradient)
+
+    if on_features_flagged:
+        on_features_flagged(df_all)
+
+    with metrics.stage("zscore", nb_observations):
+        # df_all.loc[df_all[Df.QC_FLAG] <= QualityFlags.PROBABLY_GOOD] = calc_zscore_results(df_all.loc[df_all[Df.QC_FLAG] <= QualityFlags.PROBABLY_GOOD], Df.DATASTREAM_ID)
+        bool_zscore = df_all[Df.QC_FLAG] <= QualityFlags.PROBABLY_GOOD
+        if get_zscore_method(cfg) == METHOD_ONLINE:
+            zscore_engine = get_zscore_engine(cfg)
+            df_all.loc[bool_zscore, Df.ZSCORE] = zscore_engine.update(
+                df_all.loc[bool_zscore, COLUMNS_STATE]
+            )
+            if get_zscore_state_path(cfg):
+                zscore_engine.save(get_zscore_state_path(cfg))
+        else:
+            df_all.loc[bool_zscore, Df.ZSCORE] = run_per_datastream(
+                partial(zscore_stage, rolling_time_window=get_zscore_time_window(cfg)),
+                df_all.loc[bool_zscore, COLUMNS_STAGE],
+                workers,
+            )
+        qc_flag_config_zscore = CodedQCFlagConfig(
+            label="zscore",
+            bool_function=partial(get_bool_out_of_range_columns, qc_on=Df.ZSCORE, qc_type="zscore"),
+            bool_merge_function=max,
+            flag_on_true=QualityFlags.BAD,
+            flag_on_false=QualityFlags.PROBABLY_GOOD,
+            flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
+        )
+        df_all[Df.QC_FLAG] = qc_flag_config_zscore.execute(df_all)
+
+        history_series = update_flag_history_series(history_series, qc_flag_config_zscore)
+
+    with metrics.stage("dependent", nb_observations):
+        # TODO: not yet in flag_history
+        for dependent_i in getattr(cfg, "QC_dependent", []):
+            independent = dependent_i.independent
+            dependent_list_i = [
+                int(dep_i)
+                for dep_i in str(dependent_i.dependent).split(",")
+                if int(dep_i) in datastreams_list
+            ]
+            if not dependent_list_i:
+                continue
+            log.debug(
+                f"Dependent flagging. Independent: {independent}, dependents: {dependent_list_i}."
+            )
+            df_all[Df.QC_FLAG] = qc_dependent_quantities(
+                df_all,
+                independent=independent,
+                dependents=dependent_list_i,
+                range_=tuple(dependent_i.QC.range),  # type: ignore
+                dt_tolerance=dependent_i.dt_tolerance,
+            )
+    return df_all, history_series, qc_flag_config_outlier.bool_series
+
 
 
-    # find geographical outliers
-    qc_flag_config_outlier = QCFlagConfig(
-        "spacial_outliers",
-        # bool_function=lambda x: pd.Series(False, index=x.index), # easiest method to disable this
-        bool_function=partial(
-            get_bool_spacial_outlier_compared_to_median,
-            max_dx_dt=cfg.location.max_dx_dt,
-            time_window=cfg.location.time_window,
+def log_flag_summary(df_all: pd.DataFrame, bool_outlier: pd.Series) -> None:
+    log.info(f"{df_all[Df.QC_FLAG].value_counts(dropna=False).to_json()=}")
+    log.info(f"Observation types flagged as {QualityFlags.PROBABLY_BAD} or worse.")
+    for obst_i in df_all.loc[
+        (
+            (df_all[Df.QC_FLAG] >= QualityFlags.PROBABLY_BAD)
+            & (~bool_outlier)
         ),
-        bool_merge_function=max,
-        flag_on_true=QualityFlags.BAD,
-        flag_on_nan=QualityFlags.PROBABLY_GOOD,
+        Df.OBSERVATION_TYPE,
+    ].unique():
+        log.info(f"{'.'*10}{obst_i}")
+
+
+def get_chunk_data(
+    cfg: QCconf, t0: datetime, t1: datetime, last: bool = False
+) -> pd.DataFrame:
+    # a chunk includes its right boundary, except the last one (as the full range)
+    df_out = get_data(
+        cfg,
+        t0,
+        t1,
+        filter_cfg_datastreams=filter_cfg_to_query(
+            cfg.data_api.filter, level=Entities.DATASTREAMS
+        ),
+        datastream_ids=get_datastream_ids(cfg),
+        closed_right=not last,
+        message_str=f"Get data {t0} - {t1}.",
     )
-    # df_all[Df.QC_FLAG] = qc_flag_config_outlier.execute(df_all)
-    df_all[Df.FEATURE_QC_FLAG] = qc_flag_config_outlier.execute(
-        df_all, column=Df.FEATURE_QC_FLAG
+    return df_out
+
+
+def get_independent_context_data(cfg: QCconf, t0: datetime) -> pd.DataFrame:
+    # observations of the independent quantities before the start of the range
+    cfg_indep_time = get_stabilization_configs(cfg)
+    if not cfg_indep_time:
+        return pd.DataFrame()
+    width_hours_window = max(
+        [pd.Timedelta(ci.dt_stabilization) for ci in cfg_indep_time]
     )
-    df_all[Df.QC_FLAG] = qc_flag_config_outlier.execute(
-        df_all, column=Df.FEATURE_QC_FLAG
+    datastreams_window_list = [ci.independent for ci in cfg_indep_time]
+    df_out = get_data(
+        cfg,
+        t0 - width_hours_window,
+        t0,
+        filter_cfg_datastreams=f"{Properties.IOT_ID} in {str(tuple(datastreams_window_list)).replace(',)',')')}",
+        datastream_ids=datastreams_window_list,
+        message_str=f"Independent window before {t0}.",
     )
+    return df_out
 
-    log.info(
-        f"Detected number of spacial outliers: {df_all.loc[qc_flag_config_outlier.bool_series].shape[0]}."
+
+def get_independent_timewindow(
+    cfg: QCconf, df_chunk: pd.DataFrame, df_independent_context: pd.DataFrame
+) -> pd.DataFrame:
+    independent_ids = [ci.independent for ci in get_stabilization_configs(cfg)]
+    df_independent_list = [
+        dfi
+        for dfi in [
+            df_independent_context,
+            df_chunk.loc[df_chunk[Df.DATASTREAM_ID].isin(independent_ids)],
+        ]
+        if not dfi.empty
+    ]
+    if not independent_ids or not df_independent_list:
+        return pd.DataFrame()
+    df_out = (
+        pd.concat(df_independent_list, ignore_index=True)
+        .drop_duplicates(subset=Df.IOT_ID)
+        .sort_values(Df.TIME)
+        .reset_index(drop=True)
     )
+    return df_out
 
-    history_series = update_flag_history_series(history_series, qc_flag_config_outlier)
 
-    counter_flag_outliers = threading.Thread(
-        target=patch_qc_flags,
-        name="Patch_qc_spacial_outliers",
-        kwargs={
-            "df": df_all.reset_index(),
-            # "df": df_all.reset_index(),
-            "url": url_batch,
-            "auth": auth_in,
-            "columns": [Df.FEATURE_ID, Df.FEATURE_QC_FLAG],
-            "url_entity": Entities.FEATURESOFINTEREST,
-            "json_body_template": FEATURES_BODY_TEMPLATE,
-            "bool_write_patch_to_file": cfg.other.write_flags_to_json,
-        },
-    )
-    counter_flag_outliers.start()
+def qc_chunk(
+    cfg: QCconf,
+    state: StreamState,
+    df_new: pd.DataFrame,
+    end: datetime,
+    last: bool = False,
+    df_independent_context: Optional[pd.DataFrame] = None,
+    metrics: Optional[RunMetrics] = None,
+    seavox_regions: Optional[SeaVoxRegions] = None,
+) -> Tuple[pd.DataFrame, pd.Series]:
+    """
+    QC the new observations together with the tail of the stream.
 
-    df_all = df_all.sort_values(Df.TIME)
-    ## velocity and acceleration calculations
-    series_dt_velocity_and_acceleration = get_dt_velocity_and_acceleration_series(
-        df_all.loc[~qc_flag_config_outlier.bool_series].sort_values(
-            Df.TIME
-        )  #  type: ignore
-    )
+    Args:
+        cfg (QCconf): configuration.
+        state (StreamState): stream state, updated in place.
+        df_new (pd.DataFrame): observations up to `end`.
+        end (datetime): right boundary of the new observations.
+        last (bool, optional): no observations will follow.
+        df_independent_context (Optional[pd.DataFrame], optional): observations
+            of the independent quantities before the stream.
+        metrics (Optional[RunMetrics], optional): run metrics.
+        seavox_regions (Optional[SeaVoxRegions], optional): region lookup
+            shared by the chunks, see `run_qc`.
 
-    ## velocity
-    qc_flag_config_velocity = QCFlagConfig(
-        "Velocity limit",
-        bool_function=partial(
-            get_bool_exceed_max_velocity,
-            max_velocity=cfg.location.max_dx_dt,
-            velocity_series=series_dt_velocity_and_acceleration[1],
-            dt_series=series_dt_velocity_and_acceleration[0],
-        ),
-        bool_merge_function=max,
-        flag_on_true=QualityFlags.BAD,
-        flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
-    )
-    output_qc_velocity = qc_flag_config_velocity.execute(
-        df_all.loc[~qc_flag_config_outlier.bool_series]
+    Returns:
+        Tuple[pd.DataFrame, pd.Series]: observations with final flags and the
+            flag history.
+    """
+    df_chunk = state.add(df_new)
+    if df_chunk.empty:
+        return pd.DataFrame(), pd.Series()
+    df_independent_timewindow = get_independent_timewindow(
+        cfg,
+        df_chunk,
+        pd.DataFrame() if df_independent_context is None else df_independent_context,
     )
-    if qc_flag_config_velocity.bool_series.any():
-        log.warning(
-            f"Velocities {qc_flag_config_velocity.bool_series.sum()} exceeding the limiting value detected!"
+    metrics = metrics or RunMetrics()
+    with metrics.stage("dependent_stabilization", df_chunk.shape[0]):
+        df_qc = qc_dependent_stabilization(
+            cfg, df_chunk.copy(), df_independent_timewindow
         )
+    sampling_interval = get_max_sampling_interval(df_chunk)
+    if sampling_interval > get_sampling_interval(cfg):
         log.warning(
-            f"Max velocity value: {series_dt_velocity_and_acceleration[1].abs().max():.2f}"
+            f"Sampling interval of {sampling_interval} exceeds"
+            f" other.stream_sampling_interval ({get_sampling_interval(cfg)}):"
+            " the gradient at the chunk boundaries is one-sided."
         )
+    # the next chunk takes the flags before the z-score as input (single pass)
+    flags_pre_zscore = {}
 
-    # history_series = update_flag_history_series(history_series, qc_flag_config_velocity)
-
-    ## acceleration
-    qc_flag_config_acceleration = QCFlagConfig(
-        "Acceleration limit",
-        partial(
-            get_bool_exceed_max_acceleration,
-            max_acceleration=cfg.location.max_ddx_dtdt,
-            acceleration_series=series_dt_velocity_and_acceleration[2],
-            dt_series=series_dt_velocity_and_acceleration[0],
-        ),
-        max,
-        QualityFlags.BAD,
-        flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
+    def keep_flags_pre_zscore(df_all: pd.DataFrame) -> None:
+        columns = [
+            ci for ci in [Df.IOT_ID, Df.QC_FLAG, Df.FEATURE_QC_FLAG] if ci in df_all
+        ]
+        flags_pre_zscore["df"] = df_all[columns].copy()
+
+    df_qc, history_series, bool_outlier = run_qc(
+        cfg,
+        df_qc,
+        pd.Series(),
+        on_features_flagged=keep_flags_pre_zscore,
+        metrics=metrics,
+        seavox_regions=seavox_regions,
     )
-    output_qc_acceleration = qc_flag_config_acceleration.execute(
-        df_all.loc[~qc_flag_config_outlier.bool_series]
+    df_final = state.finalize(
+        df_chunk, df_qc, end, last=last, df_flags=flags_pre_zscore.get("df")
+    )
+    return df_final, history_series
+
+
+def patch_features(
+    df: pd.DataFrame,
+    writer: PatchWriter,
+    counter: PatchCounter,
+) -> Future:
+    df_changed = get_changed_features(df)
+    counter.add(
+        Entities.FEATURESOFINTEREST,
+        df_changed.shape[0],
+        df[Df.FEATURE_ID].nunique() - df_changed.shape[0],
+    )
+    return writer.submit(
+        df_changed,
+        columns=[Df.FEATURE_ID, Df.FEATURE_QC_FLAG],
+        url_entity=Entities.FEATURESOFINTEREST,
+        json_body_template=FEATURES_BODY_TEMPLATE,
     )
-    if qc_flag_config_acceleration.bool_series.any():
-        log.warning(
-            f"Accelerations {qc_flag_config_acceleration.bool_series.sum()} exceeding the limiting value detected!"
-        )
-        log.warning(
-            f"Max acceleration value: {series_dt_velocity_and_acceleration[2].abs().max():.2f}"
-        )
 
-    # history_series = update_flag_history_series(
-    # history_series, qc_flag_config_acceleration
-    # )
 
-    t_region1 = time.time()
+def patch_observations(
+    cfg: QCconf,
+    df: pd.DataFrame,
+    writer: PatchWriter,
+    counter: PatchCounter,
+) -> Future:
+    df_changed = get_changed_observations(df)
+    counter.add(
+        Entities.OBSERVATIONS, df_changed.shape[0], df.shape[0] - df_changed.shape[0]
+    )
 
-    df_all = df_all.merge(qc_df, on=qc_df.index.name, how="left")
-    df_all.set_index(Df.IOT_ID)
-    if nb_observations != df_all.shape[0]:
-        raise RuntimeError("Not all observations are included in the dataframe.")
+    def on_done(df_patched: pd.DataFrame, counter_status: Counter) -> None:
+        # the cache only gets the flags of the requests which fully succeeded,
+        # the failed ones are patched again by the next run
+        if set(counter_status.keys()) == {200}:
+            update_cached_flags(cfg, df_patched)
+        else:
+            counter.add_failed(Entities.OBSERVATIONS, get_nb_failed(counter_status))
 
-    qc_flag_config_range = QCFlagConfig(
-        label="Range",
-        bool_function=partial(get_bool_out_of_range, qc_on=Df.RESULT, qc_type="range"),
-        bool_merge_function=max,
-        flag_on_true=QualityFlags.BAD,
-        flag_on_false=QualityFlags.PROBABLY_GOOD,
-        flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
-    )
-    df_all[Df.QC_FLAG] = qc_flag_config_range.execute(df_all)
+    return writer.submit(df_changed, on_done=on_done)
 
-    history_series = update_flag_history_series(history_series, qc_flag_config_range)
 
-    qc_flag_config_gradient = QCFlagConfig(
-        label="Gradient",
-        bool_function=partial(
-            get_bool_out_of_range, qc_on=Df.RESULT, qc_type="gradient"
-        ),
-        bool_merge_function=max,
-        flag_on_true=QualityFlags.BAD,
-        flag_on_false=QualityFlags.PROBABLY_GOOD,
-        flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
+def patch_final_flags(
+    cfg: QCconf, df_final: pd.DataFrame, writer: PatchWriter
+) -> Tuple[PatchCounter, Future]:
+    """
+    Patch the changed flags of the features and observations.
+
+    Returns:
+        Tuple[PatchCounter, Future]: counter of the sent/skipped patches and a
+            future with the Counter of the response status codes.
+    """
+    counter = PatchCounter()
+    future_features = patch_features(df_final, writer, counter)
+    future_observations = patch_observations(cfg, df_final, writer, counter)
+    return counter, gather_futures([future_features, future_observations])
+
+
+def log_patch_status(counter_status: Counter) -> None:
+    if set(counter_status.keys()) - {200}:
+        log.error(f"Not all patches succeeded: {dict(counter_status)}.")
+    else:
+        log.debug(f"Patch responses: {dict(counter_status)}.")
+
+
+def run_streaming(
+    cfg: QCconf,
+    url_batch: str,
+    auth_in: tuple | None,
+    writer: PatchWriter,
+    log_history: logging.Logger | None = None,
+    metrics: Optional[RunMetrics] = None,
+    chunk: str | None = None,
+    on_chunk: Optional[Callable[[datetime, int], None]] = None,
+    patch_range: Optional[Tuple[datetime, datetime]] = None,
+    seavox_regions: Optional[SeaVoxRegions] = None,
+) -> int:
+    """
+    Run the QC on time ordered chunks of `chunk` (default:
+    `other.stream_chunk`). The next chunk
+    is downloaded while the current one is checked and patched. Each chunk
+    is checked together with a tail of the previous one (the lookback) and only
+    the observations whose flags can't change anymore (older than the
+    horizon) are patched; the others are checked again with the next chunk.
+    The stages are added to `metrics`, summed over the chunks, and
+    `on_chunk(end, nb_observations)` is called once a chunk is done. With
+    `patch_range` (start, end], only the observations within it are patched
+    (e.g. a shard of a longer range, fetched with margins).
+    The region lookup `seavox_regions` of the caller is used by all chunks.
+
+    Returns:
+        int: number of patched observations (final flags, unchanged or
+            successfully patched).
+    """
+    metrics = metrics or RunMetrics()
+    t0, t1 = get_filter_range(cfg)
+    ranges = get_chunk_ranges(t0, t1, chunk or cfg.other.stream_chunk)
+    items = [(ti0, ti1, i == len(ranges) - 1) for i, (ti0, ti1) in enumerate(ranges)]
+    state = StreamState(
+        boundary=t0,
+        lookback=get_stream_lookback(cfg),
+        horizon=get_stream_horizon(cfg),
     )
-    df_all[Df.QC_FLAG] = qc_flag_config_gradient.execute(df_all)
-
-    history_series = update_flag_history_series(history_series, qc_flag_config_gradient)
-
-    # df_all.loc[df_all[Df.QC_FLAG] <= QualityFlags.PROBABLY_GOOD] = calc_zscore_results(df_all.loc[df_all[Df.QC_FLAG] <= QualityFlags.PROBABLY_GOOD], Df.DATASTREAM_ID)
-    df_all.loc[df_all[Df.QC_FLAG] <= QualityFlags.PROBABLY_GOOD, Df.ZSCORE] = calc_zscore_results(df_all.loc[df_all[Df.QC_FLAG] <= QualityFlags.PROBABLY_GOOD, columns_at_start_tmp ], Df.DATASTREAM_ID, rolling_time_window=cfg.QC_global.zscore.time_window)
-    qc_flag_config_zscore = QCFlagConfig(
-        label="zscore",
-        bool_function=partial(get_bool_out_of_range, qc_on=Df.ZSCORE, qc_type="zscore"),
-        bool_merge_function=max,
-        flag_on_true=QualityFlags.BAD,
-        flag_on_false=QualityFlags.PROBABLY_GOOD,
-        flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
+    log.info(
+        f"Streaming {len(ranges)} chunks (lookback: {state.lookback}, horizon: {state.horizon})."
     )
-    df_all[Df.QC_FLAG] = qc_flag_config_zscore.execute(df_all)
 
-    history_series = update_flag_history_series(history_series, qc_flag_config_zscore)
+    with metrics.stage("fetch_independent") as stage:
+        df_independent_context = get_independent_context_data(cfg, t0)
+        stage.rows_out = df_independent_context.shape[0]
+    skip_qc = cfg.reset.exit and cfg.reset.feature_flags
 
-    t_ranges1 = time.time()
+    def get_chunk_data_measured(item: tuple) -> pd.DataFrame:
+        # in the prefetch thread, while the previous chunk is checked
+        with metrics.stage("fetch") as stage:
+            df_out = get_chunk_data(cfg, item[0], item[1], last=item[2])
+            stage.rows_out = df_out.shape[0]
+        return df_out
 
-    t_flag_ranges0 = time.time()
+    nb_patched = 0
+    counters_patches = []
+    futures_patches = []
+
+    def chunk_done(item: tuple) -> None:
+        (_, ti1, _), df_new = item
+        if on_chunk:
+            on_chunk(ti1, df_new.shape[0])
+
+    for (ti0, ti1, last_i), df_new in iter_done(
+        iter_prefetched(get_chunk_data_measured, items), chunk_done
+    ):
+        if not df_new.empty:
+            with metrics.stage("reset_flags", df_new.shape[0]):
+                df_new = reset_flags(cfg, df_new, url_batch, auth_in)
+        if skip_qc:
+            continue
+        df_final, history_series = qc_chunk(
+            cfg,
+            state,
+            df_new,
+            ti1,
+            last=last_i,
+            df_independent_context=df_independent_context,
+            metrics=metrics,
+            seavox_regions=seavox_regions,
+        )
+        # the context is only needed until the tail covers the stabilization time
+        if not df_independent_context.empty:
+            df_independent_context = df_independent_context.loc[
+                df_independent_context[Df.TIME] > state.boundary - state.lookback
+            ]
+        if log_history:
+            log_history.debug(history_series.to_json())
+
+        log.info(f"Chunk {ti0} - {ti1}: {df_final.shape[0]} observations with final flags.")
+        if patch_range and not df_final.empty:
+            df_final = df_final.loc[
+                (df_final[Df.TIME] > patch_range[0]) & (df_final[Df.TIME] <= patch_range[1])
+            ]
+        if df_final.empty:
+            continue
+        # the patches are sent while the next chunk is checked
+        with metrics.stage("patch_submit", df_final.shape[0]):
+            counter_i, future_i = patch_final_flags(cfg, df_final, writer)
+        counters_patches.append(counter_i)
+        futures_patches.append(future_i)
+        nb_patched += df_final.shape[0]
+    with metrics.stage("patch_wait"):
+        log_patch_status(gather_futures(futures_patches).result())
+    # the failed patches are known once the responses are
+    counter_patches = PatchCounter()
+    for counter_i in counters_patches:
+        counter_patches.update(counter_i)
+    counter_patches.log()
+    return nb_patched - counter_patches.failed[str(Entities.OBSERVATIONS)]
+
+
+def write_metrics(metrics: RunMetrics, folder: Path) -> None:
+    metrics.log()
+    try:
+        paths = metrics.write(folder)
+    except OSError as e:
+        log.warning(f"Couldn't write the run metrics: {e}")
+        return
+    log.info(f"Run metrics written to {', '.join(str(pi) for pi in paths)}.")
 
-    t_flag_ranges1 = time.time()
 
-    t_dependent0 = time.time()
-    # TODO: not yet in flag_history
-    for dependent_i in getattr(cfg, "QC_dependent", []):
-        independent = dependent_i.independent
-        dependent = dependent_i.dependent
-        dt_tolerance = dependent_i.dt_tolerance
-        dependent_list_i = [
-            int(dep_i)
-            for dep_i in str(dependent).split(",")
-            if int(dep_i) in datastreams_list
-        ]
-        for dependent_ii in dependent_list_i:
-            log.debug(
-                f"Dependent base flagging. Independent: {independent}, dependent: {dependent_ii}."
-            )
-            base_flags = qc_dependent_quantity_base(
-                df_all,
-                independent=independent,
-                dependent=dependent_ii,
-                dt_tolerance=dt_tolerance,
-            )
-            log.debug(
-                f"Dependent secondary flagging. Independent: {independent}, dependent: {dependent_ii}."
-            )
-            # df_all.update({Df.QC_FLAG: base_flags})  # type: ignore
-            df_all[Df.QC_FLAG] = combine_df_all_w_dependency_output(df_all, base_flags)
-            secondary_flags = qc_dependent_quantity_secondary(
-                df_all,
-                independent=independent,
-                dependent=dependent_ii,
-                range_=tuple(dependent_i.QC.range),  # type: ignore
-                dt_tolerance=cfg.QC_dependent[0].dt_tolerance,
-            )
-            df_all[Df.QC_FLAG] = combine_df_all_w_dependency_output(
-                df_all, secondary_flags
+@hydra.main(config_path="../conf", config_name="config.yaml", version_base="1.2")
+def main(cfg: QCconf):
+    log_extra = logging.getLogger(name="extra")
+    log_extra.setLevel(logging.INFO)
+    rootlog = logging.getLogger()
+    output_dir = Path(getattr(rootlog.handlers[1], "baseFilename", "./")).parent
+    extra_log_file = output_dir.joinpath("history.log")
+    file_handler_extra = logging.FileHandler(extra_log_file)
+    file_handler_extra.setFormatter(rootlog.handlers[0].formatter)
+    log_extra.addHandler(file_handler_extra)
+
+    def custom_exception_handler(exc_type, exc_value, exc_traceback):
+        # Log the exception
+        log.error("Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback))
+
+        # Call the default exception hook (prints the traceback and exits)
+        sys.__excepthook__(exc_type, exc_value, exc_traceback)
+
+    sys.excepthook = custom_exception_handler
+
+    REQUEST_COUNTER.install()
+    docker_image_tag = os.environ.get("IMAGE_TAG", None)
+    if docker_image_tag:
+        log.info(f"Docker image tag: {docker_image_tag}.")
+    git_hash = os.environ.get("GIT_HASH", None)
+    if git_hash:
+        log.info(f"Current git commit hash: {git_hash}.")
+    metrics = RunMetrics(image_tag=docker_image_tag, git_hash=git_hash)
+
+    log.info("Start")
+    history_series = pd.Series()
+
+    # setup
+    log.info("Setup")
+    config.filename = Path("outputs/.staconf.ini")
+    set_sta_url(cfg.data_api.base_url)
+    set_dryrun_var(getattr(cfg.data_api, "dry_run", False))
+    url_batch = urljoin(cfg.data_api.base_url + "/", "$batch")
+
+    auth_in = get_auth(cfg)
+
+    if getattr(cfg.other, "stream_chunk", None):
+        with open_seavox_regions(cfg) as seavox_regions, get_patch_writer(
+            cfg, url_batch, auth_in
+        ) as writer:
+            nb_patched = run_streaming(
+                cfg,
+                url_batch,
+                auth_in,
+                writer,
+                log_history=log_extra,
+                metrics=metrics,
+                seavox_regions=seavox_regions,
             )
-    t_dependent1 = time.time()
+        log.info(f"Number of observations patched: {nb_patched}.")
+        write_metrics(metrics, output_dir)
+        log.info("End")
+        return 0
 
-    log.info(f"{df_all[Df.QC_FLAG].value_counts(dropna=False).to_json()=}")
-    log.info(f"Observation types flagged as {QualityFlags.PROBABLY_BAD} or worse.")
-    for obst_i in df_all.loc[
-        (
-            (df_all[Df.QC_FLAG] >= QualityFlags.PROBABLY_BAD)
-            & (~qc_flag_config_outlier.bool_series)
-        ),
-        Df.OBSERVATION_TYPE,
-    ].unique():
-        log.info(f"{'.'*10}{obst_i}")
+    filter_cfg_datastreams = filter_cfg_to_query(
+        cfg.data_api.filter, level=Entities.DATASTREAMS
+    )
 
-    t_qc1 = time.time()
-    t_patch0 = time.time()
-    t3 = time.time()
+    def get_independent_window_data_measured(**kwargs) -> None:
+        with metrics.stage("fetch_independent") as stage:
+            df_out = get_independent_window_data(**kwargs)
+            stage.rows_out = df_out.shape[0] if isinstance(df_out, pd.DataFrame) else 0
 
-    if cfg.other.write_flags_to_json:
-        write_patch_to_file(
-            create_patch_json(
-                df=df_all,
-                columns=[Df.IOT_ID, Df.QC_FLAG],
-                url_entity=Entities.OBSERVATIONS,
-            ),
-            file_path=Path(log.root.handlers[1].baseFilename).parent,  # type: ignore
-            log_level="INFO",
-        )
-        write_patch_to_file(
-            create_patch_json(
-                df=df_all,
-                columns=[Df.FEATURE_ID, Df.FEATURE_QC_FLAG],
-                json_body_template=FEATURES_BODY_TEMPLATE,
-                url_entity=Entities.FEATURESOFINTEREST,
-            ),
-            file_path=Path(log.root.handlers[1].baseFilename).parent,  # type: ignore
-            log_level="INFO",
-        )
+    queue_independent_timewindow = queue.Queue()
+    thread_df_independent_timewindow = threading.Thread(
+        target=get_independent_window_data_measured,
+        name="independent_timewindow",
+        kwargs={
+            "cfg": cfg,
+            "count_observations": False,
+            "message_str": f"Get data independent time window.",
+            "result_queue": queue_independent_timewindow,
+        },
+    )
+    thread_df_independent_timewindow.start()
 
-    auth_tuple = (
-        getattr(cfg.data_api, "auth", {}).get("username", None),
-        getattr(cfg.data_api, "auth", {}).get("passphrase", None),
+    queue_all = queue.Queue()
+    t_start, t_end = get_filter_range(cfg)
+    thread_df_all = threading.Thread(
+        target=get_data,
+        name="all_data",
+        kwargs={
+            "cfg": cfg,
+            "t0": t_start,
+            "t1": t_end,
+            "filter_cfg_datastreams": filter_cfg_datastreams,
+            "datastream_ids": get_datastream_ids(cfg),
+            "count_observations": cfg.other.count_observations,
+            "message_str": f"Get all data.",
+            "result_queue": queue_all,
+        },
     )
-    auth_in = [None, auth_tuple][all(auth_tuple)]
-    log_waiting_status = True
-    while counter_flag_outliers.is_alive():
-        if log_waiting_status:
-            log.info("Waiting spacial outlier flag patching.")
-            log_waiting_status = False
-        time.sleep(5)
-    counter = patch_qc_flags(
-        df_all.reset_index(),
-        url=url_batch,
-        auth=auth_in,
-        bool_write_patch_to_file=cfg.other.write_flags_to_json,
+    with metrics.stage("fetch") as stage:
+        thread_df_all.start()
+        thread_df_all.join()
+        df_all = queue_all.get()
+        stage.rows_out = df_all.shape[0]
+
+    ## reset flags
+    with metrics.stage("reset_flags", df_all.shape[0]):
+        df_all = reset_flags(cfg, df_all, url_batch, auth_in)
+    if cfg.reset.feature_flags and cfg.reset.exit:
+        write_metrics(metrics, output_dir)
+        return 0
+
+    thread_df_independent_timewindow.join()
+    df_independent_timewindow = queue_independent_timewindow.get()
+
+    if df_all.empty:
+        log.warning("Terminating script.")
+        write_metrics(metrics, output_dir)
+        return 0
+
+    # LOOP STARTS HERE?
+    with metrics.stage("dependent_stabilization", df_all.shape[0]):
+        df_all = qc_dependent_stabilization(cfg, df_all, df_independent_timewindow)
+
+    writer = get_patch_writer(cfg, url_batch, auth_in)
+    futures_patches = []
+    counter_patches = PatchCounter()
+
+    def start_patch_features(df_features: pd.DataFrame) -> None:
+        with metrics.stage("patch_submit", df_features[Df.FEATURE_ID].nunique()):
+            futures_patches.append(patch_features(df_features, writer, counter_patches))
+
+    df_all, history_series, bool_outlier = run_qc(
+        cfg,
+        df_all,
+        history_series,
+        on_features_flagged=start_patch_features,
+        metrics=metrics,
     )
-    t_patch1 = time.time()
-    tend = time.time()
-    log.info(f"df requests/construction duration: {(t_df1 - t_df0):.2f}")
-    log.info(f"Region check duration: {(t_region1 - t_region0):.2f}")
-    log.info(f"Ranges check duration: {(t_ranges1 - t_ranges0):.2f}")
-    log.info(f"Flagging ranges duration: {(t_flag_ranges1 - t_flag_ranges0):.2f}")
-    log.info(f"Total QC check duration: {(t_qc1 - t_qc0):.2f}")
-    log.info(f"Patch duration: {(t_patch1 - t_patch0):.2f}")
-    log.info(f"Total duration: {(tend-t0):.2f}")
+    log_flag_summary(df_all, bool_outlier)
+
+    if cfg.other.write_flags_to_json:
+        with metrics.stage("write_flags_json", df_all.shape[0]):
+            write_patch_to_file(
+                create_patch_json(
+                    df=df_all,
+                    columns=[Df.IOT_ID, Df.QC_FLAG],
+                    url_entity=Entities.OBSERVATIONS,
+                ),
+                file_path=Path(log.root.handlers[1].baseFilename).parent,  # type: ignore
+                log_level="INFO",
+            )
+            write_patch_to_file(
+                create_patch_json(
+                    df=df_all,
+                    columns=[Df.FEATURE_ID, Df.FEATURE_QC_FLAG],
+                    json_body_template=FEATURES_BODY_TEMPLATE,
+                    url_entity=Entities.FEATURESOFINTEREST,
+                ),
+                file_path=Path(log.root.handlers[1].baseFilename).parent,  # type: ignore
+                log_level="INFO",
+            )
+
+    with metrics.stage("patch_submit", df_all.shape[0]):
+        futures_patches.append(
+            patch_observations(cfg, df_all, writer, counter_patches)
+        )
+    with metrics.stage("patch_wait"):
+        log_patch_status(gather_futures(futures_patches).result())
+        writer.close()
+    counter_patches.log()
+    write_metrics(metrics, output_dir)
     log.info("End")
     log_extra.debug(history_series.to_json())
 
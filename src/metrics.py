@@ -0,0 +1,273 @@
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List
+
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+REPORT_FILENAME = "metrics.json"
+PROMETHEUS_FILENAME = "metrics.prom"
+PROMETHEUS_PREFIX = "qc"
+
+
+class RequestCounter:
+    """
+    Number of HTTP requests per method sent by this process, counted in
+    `HTTPAdapter.send` (the fetches of pandassta and the `$batch` requests of
+    the PatchWriter, retries included).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+        self._send = None
+
+    def install(self) -> "RequestCounter":
+        if self._send is not None:
+            return self
+        send = HTTPAdapter.send
+        counter = self
+
+        def send_counted(adapter, request, *args, **kwargs):
+            with counter._lock:
+                counter._counts[request.method] += 1
+            return send(adapter, request, *args, **kwargs)
+
+        self._send = send
+        HTTPAdapter.send = send_counted  # type: ignore
+        return self
+
+    def uninstall(self) -> None:
+        if self._send is not None:
+            HTTPAdapter.send = self._send  # type: ignore
+            self._send = None
+
+    def get(self) -> Counter:
+        with self._lock:
+            return self._counts.copy()
+
+
+REQUEST_COUNTER = RequestCounter()
+
+
+def get_max_rss() -> int:
+    """Peak resident set size of the process (bytes)."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+@dataclass
+class StageMetrics:
+    """
+    Metrics of a stage, summed over its calls (e.g. one per chunk).
+
+    `rows_out` is `rows_in` unless set in the stage (e.g. the number of
+    fetched observations). The CPU time is the one of the process, all threads
+    included.
+    """
+
+    name: str
+    calls: int = 0
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    rows_in: int = 0
+    rows_out: int = 0
+    requests: Counter = field(default_factory=Counter)
+
+    @property
+    def rows_per_s(self) -> float | None:
+        rows = max(self.rows_in, self.rows_out)
+        return rows / self.wall_s if self.wall_s > 0 else None
+
+    def to_dict(self) -> dict:
+        return {
+            "stage": self.name,
+            "calls": self.calls,
+            "wall_s": self.wall_s,
+            "cpu_s": self.cpu_s,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "rows_per_s": self.rows_per_s,
+            "requests": dict(self.requests),
+        }
+
+
+class StageRecord:
+    """Handle of a running stage, to set its number of output rows."""
+
+    def __init__(self, rows_in: int | None):
+        self.rows_in = rows_in
+        self.rows_out = rows_in
+
+
+class RunMetrics:
+    """
+    Wall/CPU time, rows and HTTP requests of the fetch, QC and patch stages of
+    a run, written as a JSON report and a Prometheus textfile.
+
+    The requests of a stage are the requests sent by the process while it
+    runs: stages which overlap (the fetch of the independent time window, the
+    patches sent during the QC) share them, the totals of the run are exact.
+    """
+
+    def __init__(self, **labels):
+        self.labels = {ki: str(vi) for ki, vi in labels.items() if vi is not None}
+        self.stages: Dict[str, StageMetrics] = {}
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self._c0 = time.process_time()
+        self._requests0 = REQUEST_COUNTER.get()
+        self._merged = StageMetrics("merged")
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int | None = None) -> Iterator[StageRecord]:
+        record = StageRecord(rows_in)
+        requests0 = REQUEST_COUNTER.get()
+        t0, c0 = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+            requests = REQUEST_COUNTER.get()
+            requests.subtract(requests0)
+            with self._lock:
+                stage = self.stages.setdefault(name, StageMetrics(name))
+                stage.calls += 1
+                stage.wall_s += wall
+                stage.cpu_s += cpu
+                stage.rows_in += record.rows_in or 0
+                stage.rows_out += record.rows_out or 0
+                stage.requests.update(+requests)
+            log.debug(f"Stage {name}: {wall:.2f} s.")
+
+    def merge(self, stages: Iterable[StageMetrics], total: StageMetrics | None = None) -> None:
+        """
+        Add the stages of another run (e.g. a worker process) to the ones of
+        this run, the CPU time and requests of its `total` to the total.
+        """
+        with self._lock:
+            for stage_i in stages:
+                stage = self.stages.setdefault(stage_i.name, StageMetrics(stage_i.name))
+                stage.calls += stage_i.calls
+                stage.wall_s += stage_i.wall_s
+                stage.cpu_s += stage_i.cpu_s
+                stage.rows_in += stage_i.rows_in
+                stage.rows_out += stage_i.rows_out
+                stage.requests.update(stage_i.requests)
+            if total is not None:
+                self._merged.cpu_s += total.cpu_s
+                self._merged.requests.update(total.requests)
+
+    def get_total(self) -> StageMetrics:
+        requests = REQUEST_COUNTER.get()
+        requests.subtract(self._requests0)
+        with self._lock:
+            requests.update(self._merged.requests)
+            cpu_merged = self._merged.cpu_s
+        return StageMetrics(
+            "total",
+            calls=1,
+            wall_s=time.perf_counter() - self._t0,
+            cpu_s=time.process_time() - self._c0 + cpu_merged,
+            requests=+requests,
+        )
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            stages = [si.to_dict() for si in self.stages.values()]
+        return {
+            "labels": self.labels,
+            "stages": stages,
+            "total": self.get_total().to_dict(),
+            "max_rss_bytes": get_max_rss(),
+        }
+
+    def to_prometheus(self) -> str:
+        """Gauges of the stages, in the Prometheus text exposition format."""
+        report = self.to_dict()
+        metrics = {
+            "stage_wall_seconds": ("wall_s", "Wall time of the stage."),
+            "stage_cpu_seconds": ("cpu_s", "CPU time of the process during the stage."),
+            "stage_rows_in": ("rows_in", "Input rows of the stage."),
+            "stage_rows_out": ("rows_out", "Output rows of the stage."),
+            "stage_rows_per_second": ("rows_per_s", "Rows per second of the stage."),
+        }
+        lines = []
+        for name_i, (key_i, help_i) in metrics.items():
+            lines += [
+                f"# HELP {PROMETHEUS_PREFIX}_{name_i} {help_i}",
+                f"# TYPE {PROMETHEUS_PREFIX}_{name_i} gauge",
+            ]
+            for stage_j in report["stages"] + [report["total"]]:
+                if stage_j[key_i] is None:
+                    continue
+                labels_j = get_prometheus_labels(self.labels, stage=stage_j["stage"])
+                lines.append(f"{PROMETHEUS_PREFIX}_{name_i}{labels_j} {stage_j[key_i]}")
+        name = f"{PROMETHEUS_PREFIX}_max_rss_bytes"
+        lines += [
+            f"# HELP {name} Peak resident set size of the run.",
+            f"# TYPE {name} gauge",
+            f"{name}{get_prometheus_labels(self.labels)} {report['max_rss_bytes']}",
+        ]
+        name = f"{PROMETHEUS_PREFIX}_stage_http_requests"
+        lines += [
+            f"# HELP {name} HTTP requests sent during the stage.",
+            f"# TYPE {name} gauge",
+        ]
+        for stage_j in report["stages"] + [report["total"]]:
+            for method_k, count_k in sorted(stage_j["requests"].items()):
+                labels_j = get_prometheus_labels(
+                    self.labels, stage=stage_j["stage"], method=method_k
+                )
+                lines.append(f"{name}{labels_j} {count_k}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, folder: Path) -> List[Path]:
+        """
+        Write the JSON report and the Prometheus textfile in `folder` (the
+        Prometheus file is replaced atomically, for the node exporter).
+        """
+        folder.mkdir(parents=True, exist_ok=True)
+        path_report = folder.joinpath(REPORT_FILENAME)
+        path_report.write_text(json.dumps(self.to_dict(), indent=2))
+        path_prometheus = folder.joinpath(PROMETHEUS_FILENAME)
+        path_tmp = path_prometheus.with_suffix(".prom.tmp")
+        path_tmp.write_text(self.to_prometheus())
+        os.replace(path_tmp, path_prometheus)
+        return [path_report, path_prometheus]
+
+    def log(self, level: int = logging.INFO) -> None:
+        report = self.to_dict()
+        for stage_i in report["stages"] + [report["total"]]:
+            rows_per_s = stage_i["rows_per_s"]
+            log.log(
+                level,
+                f"Stage {stage_i['stage']}: {stage_i['wall_s']:.2f} s wall, {stage_i['cpu_s']:.2f} s CPU, "
+                f"{stage_i['rows_in']} -> {stage_i['rows_out']} rows"
+                + (f" ({rows_per_s:.0f} rows/s)" if rows_per_s else "")
+                + (f", requests: {stage_i['requests']}" if stage_i["requests"] else "")
+                + ".",
+            )
+        log.log(level, f"Peak RSS: {report['max_rss_bytes'] / 2**20:.0f} MiB.")
+
+
+def get_prometheus_labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escaped = {
+        ki: str(vi).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for ki, vi in labels.items()
+    }
+    return "{" + ",".join(f'{ki}="{vi}"' for ki, vi in escaped.items()) + "}"
@@ -0,0 +1,328 @@
+import json
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Sequence, Tuple
+
+import pandas as pd
+from pandassta.df import CAT_TYPE, Df
+
+from flags import get_codes
+
+log = logging.getLogger(__name__)
+
+ALL_DATASTREAMS = "*"
+COLUMNS_FLAGS = [Df.QC_FLAG, Df.FEATURE_QC_FLAG]
+DEFAULT_REVALIDATE = "2h"
+DEFAULT_GRADIENT_LOOKBACK = "1h"  # search window of the previous samples of the gradient
+
+Interval = Tuple[datetime, datetime]
+
+
+def merge_intervals(intervals: Sequence[Interval]) -> list[Interval]:
+    merged = []
+    for t0, t1 in sorted(intervals):
+        if merged and t0 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], t1))
+        else:
+            merged.append((t0, t1))
+    return merged
+
+
+def intersect_intervals(a: Sequence[Interval], b: Sequence[Interval]) -> list[Interval]:
+    out = []
+    for a0, a1 in a:
+        for b0, b1 in b:
+            t0, t1 = max(a0, b0), min(a1, b1)
+            if t0 < t1:
+                out.append((t0, t1))
+    return merge_intervals(out)
+
+
+def subtract_intervals(t0: datetime, t1: datetime, covered: Sequence[Interval]) -> list[Interval]:
+    out = []
+    t_i = t0
+    for c0, c1 in merge_intervals(covered):
+        if c1 <= t_i or c0 >= t1:
+            continue
+        if c0 > t_i:
+            out.append((t_i, c0))
+        t_i = max(t_i, c1)
+    if t_i < t1:
+        out.append((t_i, t1))
+    return out
+
+
+def flags_to_codes(df: pd.DataFrame) -> pd.DataFrame:
+    # the flags are enum members, which can't be stored as such
+    df = df.copy()
+    for ci in set(COLUMNS_FLAGS).intersection(df.columns):
+        df[ci] = get_codes(df[ci])
+    return df
+
+
+def codes_to_flags(df: pd.DataFrame) -> pd.DataFrame:
+    for ci in set(COLUMNS_FLAGS).intersection(df.columns):
+        df[ci] = pd.Categorical.from_codes(df[ci].to_numpy(), dtype=CAT_TYPE)
+    return df
+
+
+class ObservationCache:
+    """
+    Parquet cache of the observations of a thing, partitioned per datastream
+    and per day (`thing_<id>/datastream_<id>/<date>.parquet`).
+
+    The time ranges which are complete in the cache are tracked per datastream
+    as (t0, t1] intervals in `coverage.json`. Coverage more recent than
+    `revalidate` before now is ignored, as observations can still be added.
+    """
+
+    _lock = threading.RLock()
+
+    def __init__(
+        self,
+        root: Path | str,
+        thing_id: int,
+        revalidate: str | pd.Timedelta = DEFAULT_REVALIDATE,
+    ):
+        self.path = Path(root).joinpath(f"thing_{thing_id}")
+        self.revalidate = pd.Timedelta(revalidate)
+
+    @property
+    def path_coverage(self) -> Path:
+        return self.path.joinpath("coverage.json")
+
+    def read_coverage(self) -> dict[str, list[Interval]]:
+        if not self.path_coverage.exists():
+            return {}
+        with open(self.path_coverage, "r") as f:
+            coverage_in = json.load(f)
+        return {
+            k: [(datetime.fromisoformat(t0), datetime.fromisoformat(t1)) for t0, t1 in v]
+            for k, v in coverage_in.items()
+        }
+
+    def write_coverage(self, coverage: dict[str, list[Interval]]) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        path_tmp = self.path_coverage.with_suffix(".json.tmp")
+        with open(path_tmp, "w") as f:
+            json.dump(
+                {
+                    k: [[t0.isoformat(), t1.isoformat()] for t0, t1 in v]
+                    for k, v in coverage.items()
+                },
+                f,
+            )
+        path_tmp.replace(self.path_coverage)
+
+    def get_covered(
+        self, datastream_ids: Sequence[int] | None, now: datetime | None = None
+    ) -> list[Interval]:
+        coverage = self.read_coverage()
+        covered_all = coverage.get(ALL_DATASTREAMS, [])
+        if datastream_ids is None:
+            covered = merge_intervals(covered_all)
+        else:
+            covered = None
+            for ds_i in datastream_ids:
+                covered_i = merge_intervals(coverage.get(str(ds_i), []) + covered_all)
+                covered = covered_i if covered is None else intersect_intervals(covered, covered_i)
+            covered = covered or []
+        if now is not None:
+            covered = intersect_intervals(
+                covered, [(datetime.min, (pd.Timestamp(now) - self.revalidate).to_pydatetime())]
+            )
+        return covered
+
+    def plan(
+        self,
+        t0: datetime,
+        t1: datetime,
+        datastream_ids: Sequence[int] | None,
+        now: datetime | None = None,
+    ) -> list[Interval]:
+        """
+        Time ranges (t0, t1] which need to be fetched to have (t0, t1) complete
+        in the cache.
+        """
+        return subtract_intervals(t0, t1, self.get_covered(datastream_ids, now=now))
+
+    def get_partition_files(self, datastream_ids: Sequence[int] | None) -> list[Path]:
+        if datastream_ids is None:
+            return sorted(self.path.glob("datastream_*/*.parquet"))
+        return sorted(
+            pi
+            for ds_i in datastream_ids
+            for pi in self.path.joinpath(f"datastream_{ds_i}").glob("*.parquet")
+        )
+
+    def read(
+        self,
+        t0: datetime,
+        t1: datetime,
+        datastream_ids: Sequence[int] | None,
+        closed_right: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Observations with t0 < phenomenonTime < t1 (as the filter of the
+        configuration), or phenomenonTime <= t1 if closed_right.
+        """
+        dates = pd.date_range(pd.Timestamp(t0).normalize(), t1, freq="D")
+        files = [
+            fi
+            for fi in self.get_partition_files(datastream_ids)
+            if pd.Timestamp(fi.stem) in dates
+        ]
+        if not files:
+            return pd.DataFrame()
+        with self._lock:
+            df = pd.concat([pd.read_parquet(fi) for fi in files], ignore_index=True)
+        if datastream_ids is not None:
+            df = df.loc[df[Df.DATASTREAM_ID].isin(datastream_ids)]
+        bool_right = df[Df.TIME] <= t1 if closed_right else df[Df.TIME] < t1
+        df = df.loc[(df[Df.TIME] > t0) & bool_right]
+        df = codes_to_flags(df.sort_values(Df.TIME, kind="stable").reset_index(drop=True))
+        return df
+
+    def _write_partition(self, path_partition: Path, df: pd.DataFrame, t0, t1) -> None:
+        df_list = [df]
+        if path_partition.exists():
+            df_old = pd.read_parquet(path_partition)
+            df_list.insert(
+                0, df_old.loc[(df_old[Df.TIME] <= t0) | (df_old[Df.TIME] > t1)]
+            )
+        df_list = [dfi for dfi in df_list if not dfi.empty]
+        if not df_list:
+            path_partition.unlink(missing_ok=True)
+            return
+        df_out = pd.concat(df_list, ignore_index=True)
+        df_out = df_out.drop_duplicates(subset=Df.IOT_ID, keep="last").sort_values(Df.TIME)
+        path_partition.parent.mkdir(parents=True, exist_ok=True)
+        df_out.to_parquet(path_partition, index=False)
+
+    def write(
+        self,
+        df: pd.DataFrame,
+        t0: datetime,
+        t1: datetime,
+        datastream_ids: Sequence[int] | None,
+    ) -> None:
+        """
+        Store the observations fetched for (t0, t1] and mark the range as
+        covered. The cached observations of the datastreams in this range are
+        replaced.
+        """
+        with self._lock:
+            ids_partitions = set(datastream_ids or [])
+            if not df.empty:
+                ids_partitions |= set(df[Df.DATASTREAM_ID].unique().tolist())
+            if datastream_ids is None:
+                ids_partitions |= {
+                    int(pi.name.removeprefix("datastream_"))
+                    for pi in self.path.glob("datastream_*")
+                }
+            df_codes = flags_to_codes(df)
+            dates = pd.date_range(pd.Timestamp(t0).normalize(), t1, freq="D")
+            for ds_i in ids_partitions:
+                df_ds = (
+                    df_codes.loc[df_codes[Df.DATASTREAM_ID] == ds_i]
+                    if not df_codes.empty
+                    else df_codes
+                )
+                for date_i in dates:
+                    df_ds_date = (
+                        df_ds.loc[df_ds[Df.TIME].dt.normalize() == date_i]
+                        if not df_ds.empty
+                        else df_ds
+                    )
+                    self._write_partition(
+                        self.path.joinpath(
+                            f"datastream_{ds_i}", f"{date_i.strftime('%Y-%m-%d')}.parquet"
+                        ),
+                        df_ds_date,
+                        t0,
+                        t1,
+                    )
+
+            coverage = self.read_coverage()
+            keys = (
+                [ALL_DATASTREAMS]
+                if datastream_ids is None
+                else [str(ds_i) for ds_i in datastream_ids]
+            )
+            for key_i in keys:
+                coverage[key_i] = merge_intervals(coverage.get(key_i, []) + [(t0, t1)])
+            self.write_coverage(coverage)
+
+    def update_flags(self, df: pd.DataFrame) -> int:
+        """
+        Write the (patched) flags of the observations back to the cache.
+
+        Returns:
+            int: number of updated observations.
+        """
+        columns = [ci for ci in COLUMNS_FLAGS if ci in df.columns]
+        if df.empty or not columns:
+            return 0
+        df_codes = flags_to_codes(
+            pd.DataFrame(df[[Df.IOT_ID, Df.DATASTREAM_ID, Df.TIME] + columns])
+        )
+        nb_updated = 0
+        with self._lock:
+            for (ds_i, date_i), df_i in df_codes.groupby(
+                [df_codes[Df.DATASTREAM_ID], df_codes[Df.TIME].dt.normalize()]
+            ):
+                path_partition = self.path.joinpath(
+                    f"datastream_{ds_i}", f"{date_i.strftime('%Y-%m-%d')}.parquet"
+                )
+                if not path_partition.exists():
+                    continue
+                df_cached = pd.read_parquet(path_partition)
+                flags_i = df_i.drop_duplicates(subset=Df.IOT_ID, keep="last").set_index(Df.IOT_ID)
+                mask = df_cached[Df.IOT_ID].isin(flags_i.index)
+                for ci in columns:
+                    if ci in df_cached.columns:
+                        df_cached.loc[mask, ci] = flags_i.loc[
+                            df_cached.loc[mask, Df.IOT_ID], ci
+                        ].to_numpy()
+                df_cached.to_parquet(path_partition, index=False)
+                nb_updated += int(mask.sum())
+        return nb_updated
+
+
+def get_data_cached(
+    cache: ObservationCache,
+    fetch: Callable[[datetime, datetime], pd.DataFrame],
+    t0: datetime,
+    t1: datetime,
+    datastream_ids: Sequence[int] | None,
+    closed_right: bool = False,
+    now: datetime | None = None,
+) -> pd.DataFrame:
+    """
+    Get the observations from the cache, fetching only the ranges which are
+    not (or no longer) covered.
+
+    Args:
+        cache (ObservationCache): cache of the thing.
+        fetch (Callable[[datetime, datetime], pd.DataFrame]): fetches the
+            observations of the datastreams within (t0, t1].
+        t0 (datetime): start (excluded).
+        t1 (datetime): end.
+        datastream_ids (Sequence[int] | None): datastreams, None for all the
+            datastreams of the thing.
+        closed_right (bool, optional): include t1.
+        now (datetime | None, optional): current time (UTC), used to
+            re-validate the recent observations.
+
+    Returns:
+        pd.DataFrame: observations.
+    """
+    ranges = cache.plan(t0, t1, datastream_ids, now=now)
+    log.info(
+        f"Cache: {len(ranges)} range(s) to fetch for {t0} - {t1}: {[(str(ti0), str(ti1)) for ti0, ti1 in ranges]}."
+    )
+    for ti0, ti1 in ranges:
+        cache.write(fetch(ti0, ti1), ti0, ti1, datastream_ids)
+    return cache.read(t0, t1, datastream_ids, closed_right=closed_right)
@@ -0,0 +1,116 @@
+import logging
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from pandassta.df import Df
+from pyproj import Geod
+
+log = logging.getLogger(__name__)
+
+# geodesic on the WGS-84 ellipsoid (Karney), as geopy.distance.distance
+GEOD = Geod(ellps="WGS84")
+
+
+def get_rolling_median_time(
+    df: pd.DataFrame, columns: list[str], time_window: str
+) -> pd.DataFrame:
+    """
+    Centered time window median of the columns of `df` (sorted on time), on
+    the sorted window (skiplist) of pandas' rolling median.
+    """
+    return (
+        df[[Df.TIME] + columns].rolling(time_window, on=Df.TIME, center=True).median()
+    )
+
+
+def get_rolling_span_time(times: pd.Series, time_window: str) -> pd.Series:
+    """
+    Time (s) between the first and the last observation of the centered time
+    window of each observation (`times` sorted).
+    """
+    df_dt = pd.DataFrame(
+        {Df.TIME: times, "dt": (times - times.min()).dt.total_seconds()}
+    )
+    rolling_dt = df_dt.rolling(time_window, on=Df.TIME, center=True)["dt"]
+    return rolling_dt.max() - rolling_dt.min()
+
+
+def get_bool_spacial_outlier(
+    df: gpd.GeoDataFrame, max_dx_dt: float, time_window: str
+) -> pd.Series:
+    """
+    `df_qc_tools.qc.get_bool_spacial_outlier_compared_to_median` with the
+    geodesic distances to the rolling median computed in one vectorized call
+    instead of per row.
+
+    Positions farther from the median position of their centered time window
+    than `max_dx_dt` times the time span of the window are outliers. The
+    positions with lat == long or a zero coordinate are left out of the
+    medians, they are compared with the median of the previous position.
+
+    Returns:
+        pd.Series: bool, with the index of `df` in time order.
+    """
+    log.info("Start calculating spacial outliers.")
+    df_time_sorted = df.sort_values(Df.TIME)
+    bool_excluded = (
+        (df_time_sorted[Df.LAT] == df_time_sorted[Df.LONG])
+        | (df_time_sorted[Df.LAT] == 0)
+        | (df_time_sorted[Df.LONG] == 0)
+    )
+    rolling_median = (
+        get_rolling_median_time(
+            df_time_sorted.loc[~bool_excluded], [Df.LONG, Df.LAT], time_window
+        )
+        .reindex(df_time_sorted.index)[[Df.LONG, Df.LAT]]
+        .ffill()
+        .bfill()
+    )
+    rolling_span = get_rolling_span_time(df_time_sorted[Df.TIME], time_window)
+
+    geometry = df_time_sorted.geometry
+    _, _, distance = GEOD.inv(
+        geometry.x.to_numpy(),
+        geometry.y.to_numpy(),
+        rolling_median[Df.LONG].to_numpy(),
+        rolling_median[Df.LAT].to_numpy(),
+    )
+    bool_series = distance > (rolling_span * max_dx_dt).to_numpy()
+    return pd.Series(bool_series, index=df_time_sorted.index)
+
+
+def get_dt_velocity_and_acceleration(df: gpd.GeoDataFrame) -> pd.DataFrame:
+    """
+    `pandassta.df.get_dt_velocity_and_acceleration_series` with the geodesic
+    distances to the next position computed in one vectorized call. `df` is
+    only sorted when it is not in time order yet (e.g. the track).
+
+    Returns:
+        pd.DataFrame: dt (s), velocity (m/s) and acceleration (m/s²) columns,
+            with the index of `df`; NaN for the left out duplicate
+            (time, feature) rows.
+    """
+    log.info("Velocity and acceleration calculations.")
+    df_sorted = df
+    if not df[Df.TIME].is_monotonic_increasing:
+        df_sorted = df.sort_values(Df.TIME, kind="stable")
+    bool_unique = ~df_sorted.duplicated(subset=[Df.TIME, Df.FEATURE_ID]).to_numpy()
+    times = df_sorted[Df.TIME].loc[bool_unique]
+    geometry = df_sorted.geometry.loc[bool_unique]
+
+    dt = (times.shift(-1) - times).dt.total_seconds().abs()
+    x, y = geometry.x.to_numpy(), geometry.y.to_numpy()
+    _, _, distance = GEOD.inv(x[:-1], y[:-1], x[1:], y[1:])
+    distance = pd.Series(np.r_[distance, np.nan], index=times.index)
+
+    velocity = distance / dt
+    acceleration = (velocity.shift(-1) - velocity) / dt
+    # the infinite values (dt == 0) as the library
+    velocity = velocity.bfill().replace(np.inf, np.nan)
+    velocity = velocity.bfill().replace(-np.inf, np.nan)
+    acceleration = acceleration.bfill().replace(np.inf, np.nan)
+    acceleration = acceleration.bfill().replace(-np.inf, np.nan)
+    return pd.DataFrame(
+        {"dt": dt, "velocity": velocity, "acceleration": acceleration}
+    ).reindex(df.index)
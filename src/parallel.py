@@ -0,0 +1,137 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from df_qc_tools.qc import calc_zscore_results
+from omegaconf import OmegaConf
+from pandassta.df import Df
+
+from gradient import calc_gradients
+
+log = logging.getLogger(__name__)
+
+COLUMNS_STAGE = [Df.DATASTREAM_ID, Df.TIME, Df.RESULT]
+SHARED_MEMORY_DIR = Path("/dev/shm")
+
+_executors: Dict[int, ProcessPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_workers(cfg) -> int:
+    return int(OmegaConf.select(cfg, "other.workers", default=None) or 1)
+
+
+def get_executor(workers: int) -> ProcessPoolExecutor:
+    """
+    Process pool of `workers` processes, kept for the next calls (e.g. the
+    next chunk in streaming mode). The processes are forked from a server
+    process which imported this module, not from the (threaded) caller.
+    """
+    with _executors_lock:
+        if workers not in _executors:
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload([__name__])
+            _executors[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+        return _executors[workers]
+
+
+def get_shards(sizes: pd.Series, nb_shards: int) -> List[list]:
+    """
+    Distribute the groups over `nb_shards` shards with a similar number of
+    rows (largest group first, to the smallest shard).
+
+    Args:
+        sizes (pd.Series): number of rows per group key.
+        nb_shards (int): maximum number of shards.
+
+    Returns:
+        List[list]: group keys per shard, without empty shards.
+    """
+    shards = [[] for _ in range(min(nb_shards, sizes.size))]
+    rows = np.zeros(len(shards), dtype=np.int64)
+    for key_i, size_i in sizes.sort_values(ascending=False, kind="stable").items():
+        shard_i = int(rows.argmin())
+        shards[shard_i].append(key_i)
+        rows[shard_i] += size_i
+    return shards
+
+
+def write_shard(df: pd.DataFrame, folder: str) -> str:
+    # Arrow IPC file in shared memory, memory mapped by the worker
+    fd, path = tempfile.mkstemp(suffix=".arrow", dir=folder)
+    os.close(fd)
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return path
+
+
+def read_shard(path: str) -> pd.DataFrame:
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def _run_shard(func: Callable[[pd.DataFrame], pd.Series], path: str) -> pd.Series:
+    return func(read_shard(path))
+
+
+def run_per_datastream(
+    func: Callable[[pd.DataFrame], pd.Series],
+    df: pd.DataFrame,
+    workers: int,
+    columns: List[str] = COLUMNS_STAGE,
+) -> pd.Series:
+    """
+    Apply a per datastream stage on the observations, in a process pool when
+    `workers` > 1. The observations are sharded by datastream and only
+    `columns` are sent to the workers (as Arrow files in shared memory).
+
+    Args:
+        func (Callable[[pd.DataFrame], pd.Series]): stage, picklable (module
+            level function or partial of it).
+        df (pd.DataFrame): observations.
+        workers (int): number of processes.
+        columns (List[str], optional): columns needed by the stage.
+
+    Returns:
+        pd.Series: output of the stage, with the index of `df`.
+    """
+    df_stage = df[columns].set_axis(pd.RangeIndex(df.shape[0]))
+    sizes = df_stage[Df.DATASTREAM_ID].value_counts()
+    if workers <= 1 or sizes.size < 2:
+        return func(df_stage).reindex(df_stage.index).set_axis(df.index)
+
+    folder = str(SHARED_MEMORY_DIR) if SHARED_MEMORY_DIR.is_dir() else None
+    paths = []
+    try:
+        for keys_i in get_shards(sizes, workers):
+            df_shard_i = df_stage.loc[df_stage[Df.DATASTREAM_ID].isin(keys_i)]
+            paths.append(write_shard(df_shard_i, folder))  # type: ignore
+        executor = get_executor(workers)
+        series_out = pd.concat(
+            list(executor.map(_run_shard, [func] * len(paths), paths))
+        )
+    finally:
+        for path_i in paths:
+            Path(path_i).unlink(missing_ok=True)
+    return series_out.reindex(df_stage.index).set_axis(df.index)
+
+
+def gradient_stage(df: pd.DataFrame, df_previous: pd.DataFrame | None = None) -> pd.Series:
+    # df_previous: the previous sample of each datastream (get_previous_samples),
+    # sent with the function to each shard
+    return calc_gradients(df, df_previous)
+
+
+def zscore_stage(df: pd.DataFrame, rolling_time_window: str = "60min") -> pd.Series:
+    return calc_zscore_results(
+        df, Df.DATASTREAM_ID, rolling_time_window=rolling_time_window
+    )[Df.ZSCORE]
@@ -0,0 +1,227 @@
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable, List, Sequence
+
+import pandas as pd
+import requests
+from omegaconf import OmegaConf
+from pandassta.df import Df
+from pandassta.sta import Entities
+from pandassta.sta_requests import config, create_patch_json, write_patch_to_file
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+DEFAULT_TIMEOUT = 120.0
+STATUS_RETRY = {429, 500, 502, 503, 504}
+STATUS_FAILED = "failed"
+
+
+def get_nb_failed(counter_status: Counter) -> int:
+    return sum(vi for ki, vi in counter_status.items() if ki != 200)
+
+
+def call_on_done(
+    on_done: Callable[[pd.DataFrame, Counter], None], df: pd.DataFrame, future: Future
+) -> None:
+    # done callback of a request, the exceptions are raised by gather_futures
+    if future.exception() is None:
+        on_done(df, future.result())
+
+
+def gather_futures(futures: Sequence[Future]) -> Future:
+    """
+    Future with the sum of the Counters of the futures, done when all are done.
+    """
+    future_out = Future()
+    if not futures:
+        future_out.set_result(Counter())
+        return future_out
+    lock = threading.Lock()
+    pending = [len(futures)]
+
+    def on_done(_):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        counter = Counter()
+        for fi in futures:
+            if fi.exception() is not None:
+                future_out.set_exception(fi.exception())  # type: ignore
+                return
+            counter.update(fi.result())
+        future_out.set_result(counter)
+
+    for fi in futures:
+        fi.add_done_callback(on_done)
+    return future_out
+
+
+class PatchWriter:
+    """
+    Sends flag patches as `$batch` requests over a shared keep-alive session.
+
+    The rows are split in requests of `batch_size` patches, which are sent by
+    `max_workers` threads; at most 2 * `max_workers` requests are in flight or
+    waiting, `submit` blocks otherwise. Failed requests (connection errors and
+    status codes in STATUS_RETRY) are retried with an exponential backoff,
+    the other failures (e.g. an invalid response body) are written to the
+    log folder.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        auth: tuple | None = None,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+        timeout: float = DEFAULT_TIMEOUT,
+        session: requests.Session | None = None,
+    ):
+        self.url = url
+        self.auth = auth
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="patch"
+        )
+        self._slots = threading.BoundedSemaphore(2 * max_workers)
+
+    def __enter__(self) -> "PatchWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+        self.session.close()
+
+    def submit(
+        self,
+        df: pd.DataFrame,
+        columns: List[Df] = [Df.IOT_ID, Df.QC_FLAG],
+        url_entity: Entities = Entities.OBSERVATIONS,
+        json_body_template: str | None = None,
+        on_done: Callable[[pd.DataFrame, Counter], None] | None = None,
+    ) -> Future:
+        """
+        Patch the flags of the rows.
+
+        Args:
+            df (pd.DataFrame): rows to patch.
+            columns (List[Df], optional): id and flag column.
+            url_entity (Entities, optional): patched entity.
+            json_body_template (str | None, optional): template of the body.
+            on_done (Callable[[pd.DataFrame, Counter], None] | None, optional):
+                called with the rows and the Counter of the response status
+                codes of each request once it is done, before the returned
+                future.
+
+        Returns:
+            Future: Counter of the response status codes (STATUS_FAILED for
+                the patches of the requests which failed).
+        """
+        if config.load_dryrun_var():
+            log.warning(f"[DRY-RUN] Skipping: patch {url_entity}")
+            return gather_futures([])
+        df_patch = df[columns].reset_index(drop=True)
+        futures = []
+        for start_i in range(0, df_patch.shape[0], self.batch_size):
+            final_json = create_patch_json(
+                df=df_patch.iloc[start_i : start_i + self.batch_size].copy(),
+                columns=columns,
+                url_entity=url_entity,
+                json_body_template=json_body_template,
+            )
+            self._slots.acquire()
+            future_i = self._executor.submit(self._post, final_json)
+            future_i.add_done_callback(lambda _: self._slots.release())
+            if on_done:
+                future_i.add_done_callback(
+                    partial(call_on_done, on_done, df.iloc[start_i : start_i + self.batch_size])
+                )
+            futures.append(future_i)
+        log.info(f"Patch {url_entity}: {df_patch.shape[0]} patches in {len(futures)} requests.")
+        return gather_futures(futures)
+
+    def _post(self, final_json: dict) -> Counter:
+        nb_patches = len(final_json["requests"])
+        for attempt_i in range(self.max_retries + 1):
+            try:
+                response = self.session.post(
+                    self.url, json=final_json, auth=self.auth, timeout=self.timeout
+                )
+                if response.status_code in STATUS_RETRY and attempt_i < self.max_retries:
+                    log.warning(
+                        f"Batch patch returned status {response.status_code}, retry {attempt_i + 1}."
+                    )
+                    time.sleep(self.backoff * 2**attempt_i)
+                    continue
+                response.raise_for_status()
+                count_res = Counter([ri["status"] for ri in response.json()["responses"]])
+                if set(count_res.keys()) != {200}:
+                    log.error(f"Didn't succeed patching: {dict(count_res)}.")
+                return count_res
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt_i == self.max_retries:
+                    log.error(f"An error occurred while making the request: {e}")
+                    break
+                log.warning(f"Batch patch failed ({e}), retry {attempt_i + 1}.")
+                time.sleep(self.backoff * 2**attempt_i)
+            except requests.HTTPError as e:
+                if response.status_code == 401:
+                    log.error("Incorrect authentication credentials.")
+                else:
+                    log.error(f"An HTTP error occurred: {e}")
+                break
+            except (ValueError, KeyError) as e:
+                # a response without the statuses of the patches
+                log.error(f"Invalid batch response ({type(e).__name__}: {e}).")
+                break
+        self._write_failed(final_json)
+        return Counter({STATUS_FAILED: nb_patches})
+
+    @staticmethod
+    def _write_failed(final_json: dict) -> None:
+        try:
+            file_path = Path(log.root.handlers[1].baseFilename).parent  # type: ignore
+        except (IndexError, AttributeError):
+            log.warning("Couldn't detect log location.")
+            return
+        write_patch_to_file(final_json=final_json, file_path=file_path, log_level="WARNING")
+
+
+def get_patch_writer(cfg, url: str, auth: tuple | None) -> PatchWriter:
+    return PatchWriter(
+        url,
+        auth=auth,
+        max_workers=OmegaConf.select(
+            cfg, "data_api.patch.max_workers", default=DEFAULT_MAX_WORKERS
+        ),
+        batch_size=OmegaConf.select(
+            cfg, "data_api.patch.batch_size", default=DEFAULT_BATCH_SIZE
+        ),
+        max_retries=OmegaConf.select(
+            cfg, "data_api.patch.max_retries", default=DEFAULT_MAX_RETRIES
+        ),
+        backoff=OmegaConf.select(cfg, "data_api.patch.backoff", default=DEFAULT_BACKOFF),
+    )
@@ -0,0 +1,91 @@
+import logging
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+
+import pandas as pd
+from pandassta.df import Df
+from pandassta.sta import Entities
+
+log = logging.getLogger(__name__)
+
+FETCHED_SUFFIX = "_fetched"
+COLUMNS_FLAGS = [Df.QC_FLAG, Df.FEATURE_QC_FLAG]
+
+
+def get_fetched_column(column: str) -> str:
+    return f"{column}{FETCHED_SUFFIX}"
+
+
+def keep_fetched_flags(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Keep a copy of the flags as fetched, to only patch the changed flags.
+    Existing copies are not overwritten.
+    """
+    for ci in COLUMNS_FLAGS:
+        if ci in df.columns and get_fetched_column(ci) not in df.columns:
+            df[get_fetched_column(ci)] = df[ci].copy()
+    return df
+
+
+def set_fetched_flags(df: pd.DataFrame, column: str, value) -> pd.DataFrame:
+    # the flags in the database are changed (reset)
+    if get_fetched_column(column) in df.columns:
+        df[get_fetched_column(column)] = pd.Series(value, index=df.index).astype(
+            df[column].dtype
+        )
+    return df
+
+
+def get_bool_changed(df: pd.DataFrame, column: str) -> pd.Series:
+    column_fetched = get_fetched_column(column)
+    if column_fetched not in df.columns:
+        return pd.Series(True, index=df.index)
+    # a missing flag (fetched or new) is considered changed
+    bool_equal = (df[column] == df[column_fetched]).fillna(False).astype(bool)
+    return ~bool_equal
+
+
+def get_changed_observations(df: pd.DataFrame) -> pd.DataFrame:
+    return df.loc[get_bool_changed(df, Df.QC_FLAG)]
+
+
+def get_changed_features(df: pd.DataFrame) -> pd.DataFrame:
+    # a feature is patched once, with the flag of its last observation
+    df_features = df.drop_duplicates(subset=Df.FEATURE_ID, keep="last")
+    return df_features.loc[get_bool_changed(df_features, Df.FEATURE_QC_FLAG)]
+
+
+@dataclass
+class PatchCounter:
+    """
+    Number of sent, skipped (unchanged) and failed flag patches per entity.
+    The failed ones are added once the responses are known (from the
+    threads of the patch writer).
+    """
+
+    sent: Counter = field(default_factory=Counter)
+    skipped: Counter = field(default_factory=Counter)
+    failed: Counter = field(default_factory=Counter)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, entity: str, nb_sent: int, nb_skipped: int) -> None:
+        self.sent[str(entity)] += nb_sent
+        self.skipped[str(entity)] += nb_skipped
+
+    def add_failed(self, entity: str, nb_failed: int) -> None:
+        with self._lock:
+            self.failed[str(entity)] += nb_failed
+
+    def update(self, other: "PatchCounter") -> None:
+        self.sent.update(other.sent)
+        self.skipped.update(other.skipped)
+        with self._lock:
+            self.failed.update(other.failed)
+
+    def log(self, level: int = logging.INFO) -> None:
+        for entity_i in [Entities.OBSERVATIONS, Entities.FEATURESOFINTEREST]:
+            log.log(
+                level,
+                f"Patches {entity_i}: {self.sent[str(entity_i)]} sent, {self.skipped[str(entity_i)]} skipped (unchanged), {self.failed[str(entity_i)]} failed.",
+            )
@@ -0,0 +1,267 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Sequence, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pandassta.df import Df, df_type_conversions
+from psycopg2.pool import ThreadedConnectionPool
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_BATCH_SIZE = 5000
+TABLE = "seavox_sea_areas"
+
+# one row per point: the first region (ordered) intersecting it, or nulls
+QUERY_REGIONS = f"""
+    SELECT points.i, regions.region, regions.sub_region
+    FROM unnest(%s::int[], %s::float8[], %s::float8[]) AS points (i, x, y)
+    LEFT JOIN LATERAL (
+        SELECT region, sub_region
+        FROM {TABLE} AS regions_table
+        WHERE ST_Intersects(
+            regions_table.geom,
+            ST_SetSRID(ST_MakePoint(points.x, points.y), ST_SRID(regions_table.geom))
+        )
+        ORDER BY region, sub_region
+        LIMIT 1
+    ) AS regions ON true;"""
+QUERY_EXPORT = f"""
+    SELECT region, sub_region, ST_AsBinary(geom)
+    FROM {TABLE}
+    ORDER BY region, sub_region;"""
+
+Region = Tuple[str | None, str | None]
+
+
+class SeaVoxRegions:
+    """
+    SeaVox region lookups of positions in bulk. The unique positions are sent
+    as arrays (`unnest`) in batches of `batch_size` points, up to
+    `max_workers` batches run concurrently on connections of a pool.
+
+    `db_credentials` has the fields of
+    `searegion_detection.queryregion.DbCredentials` (location.connection).
+    """
+
+    def __init__(
+        self,
+        db_credentials=None,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        pool=None,
+    ):
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.pool = pool
+        if self.pool is None:
+            self.pool = ThreadedConnectionPool(
+                1,
+                max_workers,
+                database=db_credentials.database,
+                user=db_credentials.user,
+                password=db_credentials.passphrase,
+                host=db_credentials.host,
+                port=db_credentials.port,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.pool.closeall()
+
+    def _query(self, x: Sequence[float], y: Sequence[float]) -> List[Region]:
+        connection = self.pool.getconn()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(QUERY_REGIONS, (list(range(len(x))), list(x), list(y)))
+                rows = cursor.fetchall()
+            connection.rollback()  # read only, ends the transaction
+        finally:
+            self.pool.putconn(connection)
+        regions: List[Region] = [(None, None)] * len(x)
+        for i, region, sub_region in rows:
+            regions[i] = (region, sub_region)
+        return regions
+
+    def query(self, x: np.ndarray, y: np.ndarray) -> List[Region]:
+        """
+        (region, sub_region) of the points, (None, None) outside the regions.
+        """
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        slices = [
+            slice(i0, i0 + self.batch_size) for i0 in range(0, x.size, self.batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            batches = executor.map(
+                lambda s: self._query(x[s].tolist(), y[s].tolist()), slices
+            )
+            return [region for batch in batches for region in batch]
+
+    def intersect_df_region(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Region and sub region of the positions without region, as
+        `searegion_detection.pandaseavox.intersect_df_region`. Each unique
+        position is queried once.
+        """
+        df_out = df.copy()
+        for ci in [Df.REGION, Df.SUB_REGION]:
+            if ci not in df_out:
+                df_out[ci] = None
+            df_out[ci] = df_out[ci].astype(object)
+        bool_nan = df_out[Df.REGION].isnull() & df_out[[Df.LONG, Df.LAT]].notnull().all(
+            axis=1
+        )
+        if bool_nan.any():
+            points = df_out.loc[bool_nan, [Df.LONG, Df.LAT]]
+            ids, points_unique = pd.factorize(pd.MultiIndex.from_frame(points))
+            log.info(
+                f"Query seavox regions of {len(points_unique)} positions"
+                f" in batches of {self.batch_size}."
+            )
+            regions = self.query(
+                points_unique.get_level_values(0).to_numpy(),
+                points_unique.get_level_values(1).to_numpy(),
+            )
+            regions_array = np.empty((len(regions), 2), dtype=object)
+            regions_array[:] = regions
+            df_out.loc[bool_nan, Df.REGION] = regions_array[ids, 0]
+            df_out.loc[bool_nan, Df.SUB_REGION] = regions_array[ids, 1]
+        return df_type_conversions(df_out)
+
+    def export(self, path: Path | str) -> Path:
+        """
+        Writes the regions (ordered as in the lookups) to a GeoParquet file,
+        for SeaVoxRegionsOffline.
+        """
+        path = Path(path)
+        connection = self.pool.getconn()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(QUERY_EXPORT)
+                rows = cursor.fetchall()
+            connection.rollback()
+        finally:
+            self.pool.putconn(connection)
+        log.info(f"Export {len(rows)} seavox regions to {path}.")
+        df_regions = gpd.GeoDataFrame(
+            {
+                Df.REGION: [ri[0] for ri in rows],
+                Df.SUB_REGION: [ri[1] for ri in rows],
+            },
+            geometry=shapely.from_wkb([bytes(ri[2]) for ri in rows]),
+            crs="EPSG:4326",
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = path.with_suffix(".tmp")
+        df_regions.to_parquet(path_tmp)
+        path_tmp.replace(path)
+        return path
+
+
+class SeaVoxRegionsOffline(SeaVoxRegions):
+    """
+    SeaVox region lookups on an exported GeoParquet file (SeaVoxRegions.export)
+    instead of the database. The regions are read once per process and
+    prepared with their STRtree; as in the database query, a point on a
+    border is in the region and the first of overlapping regions is kept.
+    """
+
+    _lock = threading.RLock()
+    _regions: dict[Tuple[str, int], gpd.GeoDataFrame] = {}
+
+    def __init__(self, path: Path | str, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.path = Path(path)
+        self.batch_size = batch_size
+
+    def close(self) -> None:
+        pass
+
+    def get_regions(self) -> gpd.GeoDataFrame:
+        key = (str(self.path.absolute()), self.path.stat().st_mtime_ns)
+        with self._lock:
+            df_regions = self._regions.get(key)
+            if df_regions is None:
+                df_regions = gpd.read_parquet(self.path)
+                df_regions.sindex
+                shapely.prepare(np.asarray(df_regions.geometry.values))
+                self._regions[key] = df_regions
+            return df_regions
+
+    def query(self, x: np.ndarray, y: np.ndarray) -> List[Region]:
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        df_regions = self.get_regions()
+        idx_points, idx_regions = df_regions.sindex.query(shapely.points(x, y))
+        bool_in = shapely.intersects_xy(
+            np.asarray(df_regions.geometry.values)[idx_regions],
+            x[idx_points],
+            y[idx_points],
+        )
+        # first region (in the order of the file) of each point
+        idx_first = np.full(x.size, len(df_regions))
+        np.minimum.at(idx_first, idx_points[bool_in], idx_regions[bool_in])
+        regions = list(
+            zip(df_regions[Df.REGION].tolist(), df_regions[Df.SUB_REGION].tolist())
+        ) + [(None, None)]
+        return [regions[i] for i in idx_first]
+
+
+def export_seavox_file(cfg) -> None:
+    """
+    Export the regions of location.connection to location.seavox.file if it
+    doesn't exist yet (e.g. once before starting worker processes).
+    """
+    cfg_location = getattr(cfg, "location", {})
+    cfg_seavox = cfg_location.get("seavox", None) or {}
+    connection = cfg_location.get("connection", None)
+    file = cfg_seavox.get("file", None)
+    if file and not Path(file).exists() and connection:
+        with SeaVoxRegions(connection, max_workers=1) as seavox_regions:
+            seavox_regions.export(file)
+
+
+def get_seavox_regions(cfg) -> SeaVoxRegions | None:
+    """
+    Region lookups of location.seavox: on the exported file if `file` is set
+    (exported from the database first if it doesn't exist yet), otherwise on
+    the database of location.connection. None without both.
+    """
+    cfg_location = getattr(cfg, "location", {})
+    cfg_seavox = cfg_location.get("seavox", None) or {}
+    connection = cfg_location.get("connection", None)
+    file = cfg_seavox.get("file", None)
+    batch_size = cfg_seavox.get("batch_size", DEFAULT_BATCH_SIZE)
+    export_seavox_file(cfg)
+    if file and Path(file).exists():
+        return SeaVoxRegionsOffline(file, batch_size=batch_size)
+    if connection:
+        return SeaVoxRegions(
+            connection,
+            max_workers=cfg_seavox.get("max_workers", DEFAULT_MAX_WORKERS),
+            batch_size=batch_size,
+        )
+    return None
+
+
+@contextmanager
+def open_seavox_regions(cfg) -> Iterator[SeaVoxRegions | None]:
+    """
+    `get_seavox_regions`, closed on exit: one lookup (connection pool) for
+    all the chunks or ticks of a run.
+    """
+    seavox_regions = get_seavox_regions(cfg)
+    try:
+        yield seavox_regions
+    finally:
+        if seavox_regions is not None:
+            seavox_regions.close()
@@ -0,0 +1,247 @@
+import logging
+import queue
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+import pandas as pd
+from omegaconf import OmegaConf
+from pandassta.df import Df
+from pandassta.logging_constants import ISO_STR_FORMAT
+from pandassta.sta import Properties
+
+log = logging.getLogger(__name__)
+
+# the gradient and velocity need (at least) the next sample of each datastream,
+# other.stream_sampling_interval: largest sampling interval of the datastreams
+DEFAULT_SAMPLING_INTERVAL = "1min"
+DEFAULT_ZSCORE_TIME_WINDOW = "60min"
+
+
+def utc_now() -> datetime:
+    # the phenomenon times in the dataframes are naive (UTC)
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def get_filter_range(cfg) -> Tuple[datetime, datetime]:
+    format_range = cfg.data_api.filter.phenomenonTime.format
+    t0, t1 = [
+        datetime.strptime(str(ti), format_range)
+        for ti in cfg.data_api.filter.phenomenonTime.range
+    ]
+    return t0, t1
+
+
+def get_filter_time_range(t0: datetime, t1: datetime, closed_right: bool = False) -> str:
+    operator_right = ["lt", "le"][closed_right]
+    filter_condition = (
+        f"{Properties.PHENOMENONTIME} gt {t0.strftime(ISO_STR_FORMAT)} and "
+        f"{Properties.PHENOMENONTIME} {operator_right} {t1.strftime(ISO_STR_FORMAT)}"
+    )
+    return filter_condition
+
+
+def get_chunk_ranges(
+    t0: datetime, t1: datetime, chunk: str | pd.Timedelta
+) -> list[Tuple[datetime, datetime]]:
+    chunk = pd.Timedelta(chunk)
+    if chunk <= pd.Timedelta(0):
+        raise ValueError(f"The chunk size should be positive ({chunk}).")
+    ranges_out = []
+    t_i = t0
+    while t_i < t1:
+        t_next = min(t_i + chunk.to_pytimedelta(), t1)
+        ranges_out.append((t_i, t_next))
+        t_i = t_next
+    return ranges_out
+
+
+def get_stabilization_configs(cfg) -> list:
+    return [
+        li
+        for li in getattr(cfg, "QC_dependent", [])
+        if getattr(li, "dt_stabilization", None)
+    ]
+
+
+def get_zscore_time_window(cfg) -> str:
+    return OmegaConf.select(
+        cfg, "QC_global.zscore.time_window", default=DEFAULT_ZSCORE_TIME_WINDOW
+    )
+
+
+def get_sampling_interval(cfg) -> pd.Timedelta:
+    return pd.Timedelta(
+        OmegaConf.select(
+            cfg,
+            "other.stream_sampling_interval",
+            default=DEFAULT_SAMPLING_INTERVAL,
+        )
+    )
+
+
+def get_stream_horizon(cfg) -> pd.Timedelta:
+    """
+    Time after an observation needed before its flags are final: the full
+    z-score window (a centered MAD around a centered median), half the
+    centered window of the spacial outlier check and the next sample of the
+    gradient (other.stream_sampling_interval). Datastreams sampled less often
+    than other.stream_sampling_interval get a one-sided gradient at the
+    boundary of a chunk.
+    """
+    windows = [
+        pd.Timedelta(get_zscore_time_window(cfg)),
+        pd.Timedelta(cfg.location.time_window) / 2,
+    ]
+    return max(windows) + get_sampling_interval(cfg)
+
+
+def get_stream_lookback(cfg) -> pd.Timedelta:
+    """
+    Time before an observation needed to flag it: stabilization time of the
+    independent quantities and the (full) rolling windows.
+    """
+    windows = [
+        pd.Timedelta(get_zscore_time_window(cfg)),
+        pd.Timedelta(cfg.location.time_window),
+    ] + [pd.Timedelta(ci.dt_stabilization) for ci in get_stabilization_configs(cfg)]
+    return max(windows)
+
+
+def get_max_sampling_interval(df: pd.DataFrame) -> pd.Timedelta:
+    """
+    Largest (median) sampling interval of the datastreams in df, the gaps of
+    a datastream are ignored.
+    """
+    if df.empty:
+        return pd.Timedelta(0)
+    intervals = (
+        df.sort_values(Df.TIME)
+        .groupby(Df.DATASTREAM_ID, observed=True)[Df.TIME]
+        .diff()
+        .groupby(df[Df.DATASTREAM_ID], observed=True)
+        .median()
+    )
+    return intervals.max() if intervals.notna().any() else pd.Timedelta(0)
+
+
+@dataclass
+class StreamState:
+    """
+    Carry-over between time ordered chunks.
+
+    Observations up to (and including) `boundary` have final flags. The tail
+    holds the observations needed as lookback for the next chunk, with the
+    flags before the z-score for the observations before the boundary (the
+    z-score and the dependent checks of the next chunk take these as input,
+    as in a single pass) and the flags as fetched for the others (these are
+    flagged again with the next chunk).
+    """
+
+    boundary: datetime
+    lookback: pd.Timedelta
+    horizon: pd.Timedelta
+    tail: pd.DataFrame = field(default_factory=pd.DataFrame)
+
+    def add(self, df_new: pd.DataFrame) -> pd.DataFrame:
+        df_list = [dfi for dfi in [self.tail, df_new] if not dfi.empty]
+        if not df_list:
+            return pd.DataFrame()
+        df_out = (
+            pd.concat(df_list, ignore_index=True)
+            .drop_duplicates(subset=Df.IOT_ID, keep="last")
+            .sort_values(Df.TIME, kind="stable")
+            .reset_index(drop=True)
+        )
+        return df_out
+
+    def finalize(
+        self,
+        df_chunk: pd.DataFrame,
+        df_qc: pd.DataFrame,
+        end: datetime,
+        last: bool = False,
+        df_flags: Optional[pd.DataFrame] = None,
+    ) -> pd.DataFrame:
+        """
+        Select the observations of the QC'ed chunk with final flags, and
+        update the boundary and the tail.
+
+        Args:
+            df_chunk (pd.DataFrame): chunk as returned by add.
+            df_qc (pd.DataFrame): chunk after the QC.
+            end (datetime): right boundary of the chunk.
+            last (bool, optional): the flags of all observations are final.
+            df_flags (Optional[pd.DataFrame], optional): flags (by iot id)
+                kept in the tail for the observations which became final,
+                e.g. the ones before the z-score. Defaults to df_qc.
+
+        Returns:
+            pd.DataFrame: rows of df_qc which became final.
+        """
+        boundary_new = pd.Timestamp(end)
+        if not last:
+            boundary_new = max(pd.Timestamp(self.boundary), boundary_new - self.horizon)
+
+        times_qc = df_qc[Df.TIME]
+        df_final = df_qc.loc[(times_qc > self.boundary) & (times_qc <= boundary_new)]
+
+        tail = df_chunk.loc[df_chunk[Df.TIME] > boundary_new - self.lookback].copy()
+        # the flags before the previous boundary are already set
+        mask_done = (tail[Df.TIME] > self.boundary) & (tail[Df.TIME] <= boundary_new)
+        columns_flags = [
+            ci for ci in [Df.QC_FLAG, Df.FEATURE_QC_FLAG] if ci in tail.columns
+        ]
+        df_flags = df_qc if df_flags is None else df_flags
+        flags_qc = df_flags.drop_duplicates(subset=Df.IOT_ID).set_index(Df.IOT_ID)
+        for ci in columns_flags:
+            tail.loc[mask_done, ci] = flags_qc.loc[
+                tail.loc[mask_done, Df.IOT_ID], ci
+            ].to_numpy()
+
+        self.tail = tail.reset_index(drop=True)
+        self.boundary = boundary_new.to_pydatetime()
+        return df_final
+
+
+def iter_prefetched(
+    fetch: Callable, items: Iterable, prefetch: int = 1
+) -> Iterator[Tuple]:
+    """
+    Iterate over (item, fetch(item)), fetching the next item(s) in a
+    background thread while the current one is processed. At most `prefetch`
+    results are waiting, which bounds the memory.
+    """
+    queue_fetched = queue.Queue(maxsize=prefetch)
+    sentinel = object()
+
+    def producer():
+        try:
+            for item_i in items:
+                queue_fetched.put((item_i, fetch(item_i)))
+        except Exception as e:
+            queue_fetched.put((sentinel, e))
+            return
+        queue_fetched.put((sentinel, None))
+
+    thread_fetch = threading.Thread(target=producer, name="prefetch", daemon=True)
+    thread_fetch.start()
+    while True:
+        item_i, result_i = queue_fetched.get()
+        if item_i is sentinel:
+            if isinstance(result_i, Exception):
+                raise result_i
+            break
+        yield item_i, result_i
+    thread_fetch.join()
+
+
+def iter_done(items: Iterable, done: Callable) -> Iterator:
+    """
+    Iterate over `items`, calling `done(item)` once the loop over them is
+    done with an item (also after a `continue`).
+    """
+    for item_i in items:
+        yield item_i
+        done(item_i)
@@ -0,0 +1,93 @@
+import logging
+from typing import Callable, List
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from pandassta.df import Df
+
+log = logging.getLogger(__name__)
+
+COLUMNS_TRACK = [Df.FEATURE_ID, Df.TIME, Df.LAT, Df.LONG]
+
+
+class Track:
+    """
+    Unique positions (feature, time, lat, long) of the observations. The
+    observations of the different datastreams at a position share a row, the
+    location checks run on the track and their results are broadcast to the
+    observations.
+
+    Attributes:
+        df (gpd.GeoDataFrame): positions (with a RangeIndex) and the flags of
+            their first observation.
+        ids (np.ndarray): position of each observation in `df`.
+        index (pd.Index): index of the observations.
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        crs: str | None = None,
+        columns: List[str] = [Df.QC_FLAG, Df.FEATURE_QC_FLAG],
+    ):
+        self.ids = (
+            df.groupby(COLUMNS_TRACK, sort=False, dropna=False).ngroup().to_numpy()
+        )
+        _, idx_first = np.unique(self.ids, return_index=True)
+        columns_track = COLUMNS_TRACK + [ci for ci in columns if ci in df.columns]
+        df_track = df.iloc[idx_first][columns_track].reset_index(drop=True)
+        self.df = gpd.GeoDataFrame(
+            df_track,
+            geometry=gpd.points_from_xy(df_track[Df.LONG], df_track[Df.LAT]),
+            crs=crs,
+        )
+        self.index = df.index
+        log.info(f"Track of {self.df.shape[0]} positions for {self.index.size} observations.")
+
+    def broadcast(self, series: pd.Series) -> pd.Series:
+        """
+        Values of the positions for their observations. The observations of
+        the positions missing in `series` are left out, as they would be when
+        checking the observations.
+        """
+        bool_in = np.zeros(self.df.shape[0], dtype=bool)
+        bool_in[self.df.index.get_indexer(series.index)] = True
+        bool_obs = bool_in[self.ids]
+        values = series.reindex(self.df.index).to_numpy()
+        return pd.Series(
+            values[self.ids[bool_obs]],
+            index=self.index[bool_obs],
+            name=series.name,
+        ).astype(series.dtype)
+
+    def on_track(self, bool_function: Callable) -> "TrackBoolFunction":
+        return TrackBoolFunction(self, bool_function)
+
+
+class TrackBoolFunction:
+    """
+    QCFlagConfig bool_function evaluated once on the track (e.g. a check
+    merged in both flag columns), the result for the positions is kept in
+    `bool_track`.
+    """
+
+    def __init__(self, track: Track, bool_function: Callable):
+        self.track = track
+        self.bool_function = bool_function
+        self.bool_track: pd.Series | None = None
+
+    def evaluate(self, df_track: pd.DataFrame | None = None) -> "TrackBoolFunction":
+        """
+        Evaluate the check on the positions beforehand (e.g. in a stage of
+        the QC), on `df_track` instead of `track.df` if given (same index).
+        """
+        if self.bool_track is None:
+            self.bool_track = self.bool_function(
+                self.track.df if df_track is None else df_track
+            )
+        return self
+
+    def __call__(self, df: pd.DataFrame) -> pd.Series:
+        self.evaluate()
+        return self.track.broadcast(self.bool_track)  # type: ignore
@@ -105,6 +105,15 @@ schema = {
                     },
                 },
             },
+            "patch": {
+                "type": "dict",
+                "schema": {
+                    "max_workers": {"type": "integer", "min": 1},
+                    "batch_size": {"type": "integer", "min": 1},
+                    "max_retries": {"type": "integer", "min": 0},
+                    "backoff": {"type": "number", "min": 0},
+                },
+            },
         },
     },
     "reset": {
@@ -121,6 +130,69 @@ schema = {
         "schema": {
             "count_observations": {"type": "boolean"},
             "write_flags_to_json": {"type": "boolean"},
+            "stream_chunk": {
+                "type": "string",
+                "nullable": True,
+                "regex": rf"^\d+({timedelta_units_pattern})$",
+            },
+            "stream_sampling_interval": {
+                "type": "string",
+                "regex": rf"^\d+({timedelta_units_pattern})$",
+            },
+            "workers": {"type": "integer", "nullable": True, "min": 1},
+            "stage_threads": {"type": "integer", "nullable": True, "min": 1},
+            "ingest": {
+                "type": "dict",
+                "schema": {
+                    "compact": {"type": "boolean"},
+                    "coordinate_tolerance": {"type": "number", "min": 0},
+                    "result_tolerance": {"type": "number", "min": 0},
+                },
+            },
+            "cache": {
+                "type": "dict",
+                "nullable": True,
+                "schema": {
+                    "path": {"type": "string"},
+                    "revalidate": {
+                        "type": "string",
+                        "regex": rf"^\d+({timedelta_units_pattern})$",
+                    },
+                    "gradient_lookback": {
+                        "type": "string",
+                        "regex": rf"^\d+({timedelta_units_pattern})$",
+                    },
+                },
+            },
+        },
+    },
+    "daemon": {
+        "type": "dict",
+        "schema": {
+            "interval": {
+                "type": "string",
+                "regex": rf"^\d+({timedelta_units_pattern})$",
+            },
+            "delay": {
+                "type": "string",
+                "regex": rf"^\d+({timedelta_units_pattern})$",
+            },
+            "max_chunk": {
+                "type": "string",
+                "regex": rf"^\d+({timedelta_units_pattern})$",
+            },
+            "watermark_file": {"type": "string"},
+        },
+    },
+    "historical": {
+        "type": "dict",
+        "schema": {
+            "window": {
+                "type": "string",
+                "regex": rf"^\d+({timedelta_units_pattern})$",
+            },
+            "shards": {"type": "integer", "nullable": True, "min": 1},
+            "max_requests": {"type": "integer", "nullable": True, "min": 1},
         },
     },
     "location": {
@@ -136,6 +208,14 @@ schema = {
                     "passphrase": {"type": "string"},
                 },
             },
+            "seavox": {
+                "type": "dict",
+                "schema": {
+                    "max_workers": {"type": "integer", "min": 1},
+                    "batch_size": {"type": "integer", "min": 1},
+                    "file": {"type": "string"},
+                },
+            },
             "crs": {"type": "string"},
             "time_window": {
                 "type": "string",
@@ -204,6 +284,8 @@ schema = {
                         "regex": rf"^\d+({timedelta_units_pattern})$",
                     },
                     "range": {"type": "list", "schema": {"type": "float"}},
+                    "method": {"type": "string", "allowed": ["median", "online"]},
+                    "state": {"type": "string"},
                 },
             },
             "range": {
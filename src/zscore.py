@@ -0,0 +1,118 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+from pandassta.df import Df
+
+from streaming import get_zscore_time_window
+
+log = logging.getLogger(__name__)
+
+COLUMNS_STATE = [Df.DATASTREAM_ID, Df.IOT_ID, Df.TIME, Df.RESULT]
+METHOD_MEDIAN = "median"  # calc_zscore_results, centered rolling median and MAD
+METHOD_ONLINE = "online"  # RollingZScore
+
+
+def get_rolling_stats(
+    times: np.ndarray, values: np.ndarray, window: pd.Timedelta
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Mean and (sample) standard deviation of the trailing time window
+    (t - window, t] of each sample, as pandas `rolling(window, on=time)`.
+    The times (ns) are sorted. The sums are taken relative to the mean of
+    the values, expired samples are removed exactly by differencing them.
+    """
+    start = np.searchsorted(times, times - window.value, side="right")
+    end = np.arange(1, times.size + 1)
+    ref = values.mean()
+    cumsum = np.concatenate([[0.0], np.cumsum(values - ref)])
+    cumsum_sq = np.concatenate([[0.0], np.cumsum((values - ref) ** 2)])
+    nb = end - start
+    s1 = cumsum[end] - cumsum[start]
+    s2 = cumsum_sq[end] - cumsum_sq[start]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = ref + s1 / nb
+        var = np.where(nb > 1, (s2 - s1**2 / nb) / (nb - 1), np.nan)
+    return mean, np.sqrt(np.clip(var, 0.0, None))
+
+
+class RollingZScore:
+    """
+    Z-score (x - mean) / std of each observation on the observations of its
+    datastream in the trailing time window.
+
+    The samples of the last time window of each datastream are kept as the
+    state, so updating with new observations only needs the new rows and
+    the state. Observations already in the state (same @iot.id) are
+    replaced, so chunks overlapping the previous ones can be added again;
+    observations older than the state have a truncated window.
+    """
+
+    def __init__(self, time_window: str, state: pd.DataFrame | None = None):
+        self.time_window = pd.Timedelta(time_window)
+        self.state = (
+            pd.DataFrame(columns=COLUMNS_STATE) if state is None else state[COLUMNS_STATE]
+        )
+
+    @classmethod
+    def load(cls, path: Path | str, time_window: str) -> "RollingZScore":
+        state = pd.read_parquet(path) if Path(path).exists() else None
+        return cls(time_window, state=state)
+
+    def save(self, path: Path | str) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = path.with_suffix(".tmp")
+        self.state.reset_index(drop=True).to_parquet(path_tmp)
+        path_tmp.replace(path)
+
+    def update(self, df: pd.DataFrame) -> pd.Series:
+        """
+        Z-scores of the observations of `df`, with the index of `df`. The
+        observations are added to the state.
+        """
+        df_new = df[COLUMNS_STATE].assign(_position=np.arange(df.shape[0]))
+        df_list = [dfi for dfi in [self.state.assign(_position=-1), df_new] if not dfi.empty]
+        df_samples = (
+            pd.concat(df_list, ignore_index=True)
+            .drop_duplicates(subset=Df.IOT_ID, keep="last")
+            .dropna(subset=[Df.RESULT])
+            .sort_values([Df.DATASTREAM_ID, Df.TIME], kind="stable")
+            .reset_index(drop=True)
+        )
+        zscore = np.full(df.shape[0], np.nan)
+        bool_state = np.zeros(df_samples.shape[0], dtype=bool)
+        times = df_samples[Df.TIME].dt.as_unit("ns").astype(np.int64).to_numpy()
+        values = df_samples[Df.RESULT].to_numpy(dtype=float)
+        positions = df_samples["_position"].to_numpy()
+        for _, idx_i in df_samples.groupby(Df.DATASTREAM_ID, sort=False).indices.items():
+            times_i, values_i, positions_i = times[idx_i], values[idx_i], positions[idx_i]
+            mean_i, std_i = get_rolling_stats(times_i, values_i, self.time_window)
+            bool_new_i = positions_i >= 0
+            with np.errstate(invalid="ignore", divide="ignore"):
+                zscore_i = (values_i - mean_i) / np.where(std_i > 0, std_i, np.nan)
+            zscore[positions_i[bool_new_i]] = zscore_i[bool_new_i]
+            bool_state[idx_i] = times_i > times_i.max() - self.time_window.value
+        self.state = df_samples.loc[bool_state, COLUMNS_STATE].reset_index(drop=True)
+        log.info(
+            f"Online z-score of {df.shape[0]} observations, {self.state.shape[0]}"
+            " samples in the state."
+        )
+        return pd.Series(zscore, index=df.index, name=Df.ZSCORE)
+
+
+def get_zscore_method(cfg) -> str:
+    return OmegaConf.select(cfg, "QC_global.zscore.method", default=METHOD_MEDIAN)
+
+
+def get_zscore_state_path(cfg) -> str | None:
+    return OmegaConf.select(cfg, "QC_global.zscore.state", default=None)
+
+
+def get_zscore_engine(cfg) -> RollingZScore:
+    path = get_zscore_state_path(cfg)
+    if path is None:
+        return RollingZScore(get_zscore_time_window(cfg))
+    return RollingZScore.load(path, get_zscore_time_window(cfg))
@@ -0,0 +1,202 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from omegaconf import OmegaConf
+from pandassta.df import CAT_TYPE, Df, QualityFlags
+from pandassta.sta_requests import response_datastreams_to_df
+
+import daemon
+from benchmarks.synthetic import get_cfg, get_response, write_resources
+from daemon import get_tick_ranges, init_state, read_watermark, run_tick, write_watermark
+from main import qc_chunk
+from patch_writer import gather_futures
+from patching import PatchCounter, keep_fetched_flags
+
+
+@pytest.fixture
+def cfg_daemon():
+    cfg = OmegaConf.create(
+        {
+            "data_api": {
+                "filter": {
+                    "phenomenonTime": {
+                        "format": "%Y-%m-%d %H:%M",
+                        "range": ["2024-01-01 00:00", "2024-01-01 01:00"],
+                    }
+                }
+            },
+            "location": {"time_window": "10min"},
+            "QC_global": {"zscore": {"time_window": "20min"}},
+            "other": {"write_flags_to_json": False},
+            "daemon": {"delay": "0min", "max_chunk": "30min"},
+        }
+    )
+    return cfg
+
+
+@pytest.fixture
+def df_observations() -> pd.DataFrame:
+    nb = 180
+    df = pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(nb) + 1,
+            Df.DATASTREAM_ID: 10,
+            Df.TIME: pd.Timestamp("2023-12-31 23:30")
+            + pd.to_timedelta(np.arange(nb), "min"),
+            Df.RESULT: np.arange(nb, dtype=float),
+            Df.QC_FLAG: pd.Series(
+                QualityFlags.NO_QUALITY_CONTROL, index=range(nb)
+            ).astype(CAT_TYPE),
+        }
+    )
+    return df
+
+
+class TestDaemon:
+    def test_watermark_roundtrip(self, tmp_path):
+        path = tmp_path.joinpath("sub", "watermark.json")
+        assert read_watermark(path) is None
+        write_watermark(path, datetime(2024, 1, 1, 12, 30))
+        assert read_watermark(path) == datetime(2024, 1, 1, 12, 30)
+        assert not path.with_suffix(".json.tmp").exists()
+
+    def test_init_state(self, cfg_daemon):
+        state, fetched_until = init_state(cfg_daemon, None)
+        assert state.boundary == datetime(2024, 1, 1)
+        assert state.lookback == pd.Timedelta("20min")
+        assert fetched_until == datetime(2023, 12, 31, 23, 40)
+
+        state, fetched_until = init_state(cfg_daemon, datetime(2024, 2, 1))
+        assert state.boundary == datetime(2024, 2, 1)
+        assert fetched_until == datetime(2024, 1, 31, 23, 40)
+
+    def test_get_tick_ranges(self):
+        ranges = get_tick_ranges(
+            datetime(2024, 1, 1), datetime(2024, 1, 1, 1, 5), "5min", "30min"
+        )
+        assert ranges == [
+            (datetime(2024, 1, 1), datetime(2024, 1, 1, 0, 30)),
+            (datetime(2024, 1, 1, 0, 30), datetime(2024, 1, 1, 1)),
+        ]
+        assert not get_tick_ranges(
+            datetime(2024, 1, 1), datetime(2024, 1, 1), "5min", "30min"
+        )
+
+    @pytest.mark.parametrize("delay, nb_missed", [("0min", 10), ("30min", 0)])
+    def test_late_observations(
+        self, cfg_daemon, df_observations, tmp_path, monkeypatch, delay, nb_missed
+    ):
+        # the observations of 00:10 - 00:19 are stored in FROST 20 min later
+        times = df_observations[Df.TIME]
+        bool_late = times.between(pd.Timestamp("2024-01-01 00:10"), pd.Timestamp("2024-01-01 00:19"))
+        times_stored = times + pd.Timedelta("20min") * bool_late
+        now = datetime(2024, 1, 1)
+
+        def fetch(cfg, t0, t1):
+            return df_observations.loc[(times > t0) & (times <= t1) & (times_stored <= now)]
+
+        def qc_chunk(cfg, state, df_new, end, **kwargs):
+            df_chunk = state.add(df_new)
+            return state.finalize(df_chunk, df_chunk, end), pd.Series()
+
+        patched = []
+
+        def patch_final_flags(cfg, df, writer):
+            patched.append(df)
+            return PatchCounter(), gather_futures([])
+
+        monkeypatch.setattr(daemon, "qc_chunk", qc_chunk)
+        monkeypatch.setattr(daemon, "patch_final_flags", patch_final_flags)
+        path = tmp_path.joinpath("watermark.json")
+
+        cfg_daemon.daemon.delay = delay
+        state, fetched_until = init_state(cfg_daemon, None)
+        for _ in range(24):
+            now += pd.Timedelta("5min")
+            fetched_until, _ = run_tick(
+                cfg_daemon, state, fetched_until, None, path, now=now, fetch=fetch
+            )
+        ids_patched = pd.concat(patched)[Df.IOT_ID]
+        nb_late_patched = df_observations.loc[bool_late, Df.IOT_ID].isin(ids_patched).sum()
+        assert nb_late_patched == bool_late.sum() - nb_missed
+
+    def test_run_tick(self, cfg_daemon, df_observations, tmp_path, monkeypatch):
+        def fetch(cfg, t0, t1):
+            times = df_observations[Df.TIME]
+            return df_observations.loc[(times > t0) & (times <= t1)]
+
+        def qc_chunk(cfg, state, df_new, end, **kwargs):
+            df_chunk = state.add(df_new)
+            return state.finalize(df_chunk, df_chunk, end), pd.Series()
+
+        patched = []
+        monkeypatch.setattr(daemon, "qc_chunk", qc_chunk)
+        def patch_final_flags(cfg, df, writer):
+            patched.append(df)
+            return PatchCounter(), gather_futures([])
+
+        monkeypatch.setattr(daemon, "patch_final_flags", patch_final_flags)
+        path = tmp_path.joinpath("watermark.json")
+
+        state, fetched_until = init_state(cfg_daemon, None)
+        ticks = [datetime(2024, 1, 1, 0, 35), datetime(2024, 1, 1, 1, 40)]
+        for now_i in ticks:
+            fetched_until, _ = run_tick(
+                cfg_daemon, state, fetched_until, None, path, now=now_i, fetch=fetch
+            )
+            assert fetched_until == now_i
+            assert read_watermark(path) == now_i - daemon.get_stream_horizon(cfg_daemon)
+
+        df_patched = pd.concat(patched)
+        assert df_patched[Df.IOT_ID].is_unique
+        assert df_patched[Df.TIME].min() > pd.Timestamp("2024-01-01")
+        assert df_patched[Df.TIME].max() == pd.Timestamp(state.boundary)
+
+
+    def test_run_tick_zscore(self, cfg_daemon, tmp_path, monkeypatch):
+        # real QC with the default 60 min z-score window and limits close to
+        # the data: the patched flags are the ones of a single pass
+        write_resources(tmp_path.joinpath("resources"))
+        monkeypatch.chdir(tmp_path)
+        df_all = keep_fetched_flags(response_datastreams_to_df(get_response(3, 3 * 3600)))
+        t0 = df_all[Df.TIME].min().to_pydatetime() - pd.Timedelta("1s")
+        cfg = get_cfg(3)
+        for qc_i in cfg.QC:
+            qc_i.zscore = [-2.5, 2.5]
+        cfg.merge_with({key_i: cfg_daemon[key_i] for key_i in ["data_api", "other", "daemon"]})
+        cfg.data_api.filter.phenomenonTime.range = [
+            t0.strftime("%Y-%m-%d %H:%M"),
+            "2024-01-02 00:00",
+        ]
+        cfg.daemon.max_chunk = "20min"
+
+        def fetch(cfg, t0, t1):
+            times = df_all[Df.TIME]
+            return df_all.loc[(times > t0) & (times <= t1)]
+
+        patched = []
+
+        def patch_final_flags(cfg, df, writer):
+            patched.append(df)
+            return PatchCounter(), gather_futures([])
+
+        monkeypatch.setattr(daemon, "patch_final_flags", patch_final_flags)
+        path = tmp_path.joinpath("watermark.json")
+        state, fetched_until = init_state(cfg, None)
+        for now_i in pd.date_range("2024-01-01 00:25", "2024-01-01 03:00", freq="25min"):
+            fetched_until, _ = run_tick(
+                cfg, state, fetched_until, None, path, now=now_i.to_pydatetime(), fetch=fetch
+            )
+
+        state_ref, _ = init_state(cfg, None)
+        df_ref, _ = qc_chunk(cfg, state_ref, df_all, fetched_until, last=True)
+        df_patched = pd.concat(patched).set_index(Df.IOT_ID)
+        df_ref = df_ref.set_index(Df.IOT_ID).loc[df_patched.index]
+        assert df_patched.index.is_unique
+        assert df_patched[Df.TIME].max() > pd.Timestamp("2024-01-01 01:30")
+        assert (df_ref[Df.ZSCORE].abs() > 2.5).sum() > 10
+        for ci in [Df.QC_FLAG, Df.FEATURE_QC_FLAG, Df.ZSCORE]:
+            pdt.assert_series_equal(df_patched[ci], df_ref[ci])
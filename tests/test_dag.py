@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from pandassta.df import Df, QualityFlags
+from pandassta.sta_requests import response_datastreams_to_df
+
+from benchmarks.synthetic import get_cfg, get_response, write_resources
+from dag import PROCESS, Stage, get_stage_order, run_stages
+from main import qc_dependent_stabilization, run_qc
+from metrics import RunMetrics
+from parallel import gradient_stage
+from patching import keep_fetched_flags
+
+
+def get_stages() -> list[Stage]:
+    return [
+        Stage("c", lambda a, b: a + b, inputs=("a", "b")),
+        Stage("a", lambda: 1),
+        Stage("b", lambda a: a * 10, inputs=("a",)),
+        Stage("d", lambda: 5),
+    ]
+
+
+class TestStageOrder:
+    def test_order(self):
+        assert [si.name for si in get_stage_order(get_stages())] == ["a", "d", "b", "c"]
+
+    @pytest.mark.parametrize(
+        "stages, match",
+        [
+            ([Stage("a", lambda b: b, inputs=("b",))], "Unknown inputs"),
+            (
+                [Stage("a", lambda b: b, inputs=("b",)), Stage("b", lambda a: a, inputs=("a",))],
+                "Cyclic",
+            ),
+            ([Stage("a", lambda: 1), Stage("a", lambda: 2)], "Duplicate"),
+            ([Stage("a", lambda: 1, kind="gpu")], "Unknown kind"),
+        ],
+    )
+    def test_invalid(self, stages, match):
+        with pytest.raises(ValueError, match=match):
+            get_stage_order(stages)
+
+
+class TestRunStages:
+    @pytest.mark.parametrize("threads", [1, 3])
+    def test_outputs(self, threads):
+        metrics = RunMetrics()
+        outputs = run_stages(get_stages(), threads=threads, metrics=metrics)
+        assert outputs == {"a": 1, "b": 10, "c": 11, "d": 5}
+        assert set(metrics.stages) == {"a", "b", "c", "d"}
+
+    def test_concurrent(self):
+        barrier = threading.Barrier(2, timeout=5)
+        stages = [
+            Stage("a", lambda: barrier.wait() is not None),
+            Stage("b", lambda: barrier.wait() is not None),
+        ]
+        # both stages wait for each other
+        assert run_stages(stages, threads=2) == {"a": True, "b": True}
+
+    def test_exception(self):
+        calls = []
+
+        def fail():
+            time.sleep(0.05)
+            raise RuntimeError("stage failed")
+
+        stages = [
+            Stage("a", fail),
+            Stage("b", lambda: time.sleep(0.2)),
+            Stage("c", lambda a: calls.append(a), inputs=("a",)),
+        ]
+        with pytest.raises(RuntimeError, match="stage failed"):
+            run_stages(stages, threads=2)
+        assert calls == []
+
+    def test_rows(self):
+        metrics = RunMetrics()
+        stages = [
+            Stage("a", lambda: [1, 2, 3]),
+            Stage("b", lambda a: sum(a), inputs=("a",), rows=lambda a: len(a)),
+        ]
+        run_stages(stages, threads=2, metrics=metrics)
+        assert metrics.stages["b"].rows_in == 3
+
+    def test_process(self):
+        rng = np.random.default_rng(3)
+        df = pd.DataFrame(
+            {
+                Df.DATASTREAM_ID: np.repeat([1, 2], 50),
+                Df.TIME: pd.Timestamp("2024-01-01") + pd.to_timedelta(np.tile(np.arange(50), 2), "s"),
+                Df.RESULT: rng.normal(size=100),
+            }
+        )
+        stages = [
+            Stage("df", lambda: df),
+            Stage("gradient", gradient_stage, inputs=("df",), kind=PROCESS),
+            Stage("pid", os.getpid, kind=PROCESS),
+        ]
+        outputs = run_stages(stages, threads=2, processes=2)
+        pdt.assert_series_equal(outputs["gradient"], gradient_stage(df))
+        assert outputs["pid"] != os.getpid()
+
+
+class TestRunQcStageThreads:
+    def test_flags_equal(self, tmp_path, monkeypatch):
+        write_resources(tmp_path.joinpath("resources"))
+        monkeypatch.chdir(tmp_path)
+        df_all_ref = keep_fetched_flags(
+            response_datastreams_to_df(get_response(3, 2000, fraction_outliers=1e-2))
+        )
+        outputs = []
+        for threads_i in [1, 4]:
+            cfg = get_cfg(3)
+            cfg.other.stage_threads = threads_i
+            df_independent = df_all_ref.loc[
+                df_all_ref[Df.DATASTREAM_ID] == cfg.QC_dependent[0].independent
+            ]
+            df_all = qc_dependent_stabilization(cfg, df_all_ref.copy(), df_independent)
+            outputs.append(run_qc(cfg, df_all, pd.Series()))
+        (df_1, history_1, outlier_1), (df_4, history_4, outlier_4) = outputs
+        pdt.assert_frame_equal(df_1, df_4)
+        pdt.assert_series_equal(history_1, history_4)
+        pdt.assert_series_equal(outlier_1, outlier_4)
+        assert outlier_1.any()
+        # the outliers are labelled as the returned observations
+        assert (df_1.loc[outlier_1.index[outlier_1], Df.QC_FLAG] == QualityFlags.BAD).all()
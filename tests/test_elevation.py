@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+import xarray as xr
+from df_qc_tools.qc import get_bool_depth_above_treshold
+from pandassta.df import Df
+
+from elevation import ElevationGrid, get_bool_depth_above_threshold_grid
+
+
+def write_etop(path, z_offset=0.0):
+    lat = np.arange(49.0, 53.0, 1.0 / 60.0) + 1.0 / 120.0
+    lon = np.arange(0.0, 5.0, 1.0 / 60.0) + 1.0 / 120.0
+    rng = np.random.default_rng(11)
+    z = rng.normal(-5.0, 20.0, (lat.size, lon.size)).astype("f4") + z_offset
+    xr.Dataset(
+        {"z": (("lat", "lon"), z)}, coords={"lat": lat, "lon": lon}
+    ).to_netcdf(path)
+    return path
+
+
+@pytest.fixture
+def etop_file(tmp_path):
+    return write_etop(tmp_path.joinpath("etop.nc"))
+
+
+@pytest.fixture
+def df_positions() -> pd.DataFrame:
+    rng = np.random.default_rng(4)
+    nb = 400
+    df = pd.DataFrame(
+        {
+            Df.LAT: rng.uniform(48.5, 53.5, nb),
+            Df.LONG: rng.uniform(-0.5, 5.5, nb),
+            Df.REGION: None,
+        },
+        index=np.arange(nb) * 2 + 1,
+    )
+    df.loc[df.index[::5], Df.REGION] = "North Sea"
+    return df
+
+
+@pytest.fixture(autouse=True)
+def close_grids():
+    ElevationGrid._open.clear()
+    yield
+    ElevationGrid._open.clear()
+
+
+class TestElevationGrid:
+    def test_nearest_as_xarray(self, etop_file, df_positions):
+        grid = ElevationGrid.from_netcdf(etop_file)
+        with xr.open_dataset(etop_file) as dataset:
+            z_ref = (
+                dataset["z"]
+                .sel(
+                    lat=xr.DataArray(df_positions[Df.LAT].to_numpy()),
+                    lon=xr.DataArray(df_positions[Df.LONG].to_numpy()),
+                    method="nearest",
+                )
+                .to_numpy()
+            )
+        np.testing.assert_array_equal(
+            grid.get_nearest(df_positions[Df.LAT], df_positions[Df.LONG]), z_ref
+        )
+
+    def test_bilinear_as_xarray(self, etop_file, df_positions):
+        grid = ElevationGrid.from_netcdf(etop_file)
+        lat = df_positions[Df.LAT].clip(49.1, 52.9).to_numpy()
+        lon = df_positions[Df.LONG].clip(0.1, 4.9).to_numpy()
+        with xr.open_dataset(etop_file) as dataset:
+            z_ref = (
+                dataset["z"]
+                .astype(float)
+                .interp(lat=xr.DataArray(lat), lon=xr.DataArray(lon))
+                .to_numpy()
+            )
+        np.testing.assert_allclose(grid.get_bilinear(lat, lon), z_ref, rtol=1e-6)
+
+    def test_nan_coordinates(self, etop_file):
+        grid = ElevationGrid.from_netcdf(etop_file)
+        z = grid.get_nearest(np.array([np.nan, 50.0]), np.array([1.0, 1.0]))
+        assert np.isnan(z[0]) and np.isfinite(z[1])
+
+    def test_converted_once(self, etop_file, monkeypatch):
+        ElevationGrid.from_netcdf(etop_file)
+        ElevationGrid._open.clear()
+
+        def fail(*args, **kwargs):
+            raise AssertionError("converted again")
+
+        monkeypatch.setattr(ElevationGrid, "convert", fail)
+        assert ElevationGrid.from_netcdf(etop_file).shape == (240, 300)
+
+    def test_updated_netcdf(self, etop_file):
+        z0 = ElevationGrid.from_netcdf(etop_file).get_nearest([50.0], [1.0])
+        write_etop(etop_file, z_offset=100.0)
+        stat = etop_file.stat()
+        os.utime(etop_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        z1 = ElevationGrid.from_netcdf(etop_file).get_nearest([50.0], [1.0])
+        np.testing.assert_allclose(z1 - z0, 100.0)
+
+    @pytest.mark.parametrize("mask", [None, "lat"])
+    def test_depth_as_library(self, etop_file, df_positions, mask):
+        mask_to_check = None if mask is None else df_positions[Df.LAT] > 51.0
+        bool_ref = get_bool_depth_above_treshold(
+            df_positions, threshold=0.0, mask_to_check=mask_to_check, etop_file=etop_file
+        )
+        bool_out = get_bool_depth_above_threshold_grid(
+            df_positions, threshold=0.0, mask_to_check=mask_to_check, etop_file=etop_file
+        )
+        assert 0 < bool_ref.sum() < bool_ref.shape[0]
+        pdt.assert_series_equal(bool_out, bool_ref, check_names=False)
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from df_qc_tools.qc import QCFlagConfig, get_bool_out_of_range
+from pandassta.df import CAT_TYPE, Df, QualityFlags
+
+from flags import (
+    CodedQCFlagConfig,
+    get_bool_out_of_range_columns,
+    get_codes,
+    get_flags,
+    keep_new,
+    scatter_codes,
+)
+from src.main import combine_df_all_w_dependency_output
+
+
+@pytest.fixture
+def df_flags() -> pd.DataFrame:
+    rng = np.random.default_rng(3)
+    nb = 200
+    flags = np.array(list(QualityFlags), dtype=object)
+    df = pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(nb) + 1000,
+            Df.RESULT: rng.normal(size=nb),
+            Df.QC_FLAG: pd.Categorical(rng.choice(flags, nb), dtype=CAT_TYPE),
+        },
+        index=rng.permutation(nb) * 2,
+    )
+    return df
+
+
+class TestFlags:
+    def test_codes_roundtrip(self, df_flags):
+        codes = get_codes(df_flags[Df.QC_FLAG])
+        assert codes.dtype == np.int8
+        pdt.assert_series_equal(
+            get_flags(codes, df_flags.index), df_flags[Df.QC_FLAG], check_names=False
+        )
+        assert get_codes(pd.Series([np.nan, QualityFlags.BAD])).tolist() == [
+            -1,
+            CAT_TYPE.categories.get_loc(QualityFlags.BAD),
+        ]
+
+    def test_scatter_codes(self):
+        codes = scatter_codes(
+            pd.Index([10, 20, 30]), pd.Index([30, 40, 10]), np.array([1, 2, 3]), fill=0
+        )
+        assert codes.tolist() == [3, 0, 1]
+
+    @pytest.mark.parametrize("merge_function", [max, keep_new])
+    @pytest.mark.parametrize("flag_on_false", [None, QualityFlags.PROBABLY_GOOD])
+    @pytest.mark.parametrize("subset", [False, True])
+    def test_coded_qc_flag_config(self, df_flags, merge_function, flag_on_false, subset):
+        # subset: bool_function only evaluated on a part of the observations
+        def bool_function(df):
+            if subset:
+                df = df.iloc[::3]
+            return df[Df.RESULT] > 0.5
+
+        kwargs = dict(
+            label="test",
+            bool_function=bool_function,
+            bool_merge_function=merge_function,
+            flag_on_true=QualityFlags.BAD,
+            flag_on_false=flag_on_false,
+            flag_on_nan=QualityFlags.NO_QUALITY_CONTROL,
+        )
+        series_ref = QCFlagConfig(**kwargs).execute(df_flags)  # type: ignore
+        series_out = CodedQCFlagConfig(**kwargs).execute(df_flags)  # type: ignore
+        pdt.assert_series_equal(series_out, series_ref.loc[df_flags.index])
+
+    def test_combine_df_all_w_dependency_output(self, df_flags):
+        df_flags[Df.QC_FLAG] = df_flags[Df.QC_FLAG].where(
+            df_flags[Df.QC_FLAG] != QualityFlags.BAD, QualityFlags.GOOD
+        )
+        dependency_flags = pd.Series(
+            QualityFlags.BAD, index=df_flags[Df.IOT_ID].iloc[:5]
+        ).astype(CAT_TYPE)
+        series_out = combine_df_all_w_dependency_output(df_flags, dependency_flags)
+        pdt.assert_index_equal(series_out.index, df_flags.index)
+        assert (series_out.iloc[:5] == QualityFlags.BAD).all()
+        pdt.assert_series_equal(
+            series_out.iloc[5:], df_flags[Df.QC_FLAG].iloc[5:], check_names=False
+        )
+
+    @pytest.mark.parametrize("limits", [["qc_range_min", "qc_range_max"], ["qc_range_max"]])
+    def test_get_bool_out_of_range_columns(self, df_flags, limits):
+        df_flags["qc_range_min"] = -1.0
+        df_flags["qc_range_max"] = np.where(df_flags[Df.IOT_ID] % 3 == 0, np.nan, 1.0)
+        df_flags = df_flags.drop(columns=set(["qc_range_min", "qc_range_max"]) - set(limits))
+        pdt.assert_series_equal(
+            get_bool_out_of_range_columns(df_flags, qc_on=Df.RESULT, qc_type="range"),
+            get_bool_out_of_range(df_flags, qc_on=Df.RESULT, qc_type="range"),
+        )
@@ -0,0 +1,114 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from pandassta.df import CAT_TYPE, Df, QualityFlags
+from pandassta.sta import Entities
+from pandassta.sta_requests import (
+    config,
+    get_all_data,
+    patch_qc_flags,
+    response_datastreams_to_df,
+    set_dryrun_var,
+    set_sta_url,
+)
+
+from benchmarks.frost_server import FrostServer, FrostStore, get_filter_mask
+from benchmarks.synthetic import get_response
+from patch_writer import PatchWriter
+from streaming import get_filter_time_range
+
+
+@pytest.fixture(scope="module")
+def response() -> dict:
+    return get_response(3, 1500)
+
+
+@pytest.fixture
+def server(response, tmp_path):
+    config.filename = tmp_path.joinpath(".staconf.ini")
+    with FrostServer(FrostStore.from_response(response), max_top=200) as server:
+        set_sta_url(server.url)
+        set_dryrun_var(False)
+        yield server
+
+
+def get_flags(nb: int, flag: QualityFlags) -> pd.Categorical:
+    return pd.Categorical([flag] * nb, dtype=CAT_TYPE)
+
+
+class TestFrostServer:
+    def test_filter(self):
+        df = pd.DataFrame(
+            {
+                "@iot.id": [1, 2, 3, 4],
+                "phenomenonTime": pd.date_range("2024-01-01", periods=4, freq="h", tz="UTC"),
+            }
+        )
+        assert get_filter_mask(df, "@iot.id in (1, 3)").tolist() == [True, False, True, False]
+        assert get_filter_mask(
+            df, "@iot.id eq 1 or (@iot.id ge 3 and phenomenonTime lt 2024-01-01T03:00:00.000000Z)"
+        ).tolist() == [True, False, True, False]
+
+    def test_get_all_data(self, server, response):
+        df = get_all_data(
+            thing_id=1,
+            filter_cfg=get_filter_time_range(
+                pd.Timestamp("2023-12-31").to_pydatetime(),
+                pd.Timestamp("2024-01-02").to_pydatetime(),
+            ),
+            filter_cfg_datastreams="@iot.id in (8000, 8002)",
+        )
+        df_ref = response_datastreams_to_df(
+            {"Datastreams": [response["Datastreams"][i] for i in [0, 2]]}
+        )
+        pdt.assert_frame_equal(df.reset_index(drop=True), df_ref)
+        # no $top in the query: pages of default_top observations
+        assert server.counts["get"] == 1 + 2 * int(np.ceil(1500 / server.default_top) - 1)
+
+    def test_filter_time_and_count(self, server):
+        df = get_all_data(
+            thing_id=1,
+            filter_cfg=get_filter_time_range(
+                pd.Timestamp("2024-01-01 00:10").to_pydatetime(),
+                pd.Timestamp("2024-01-01 00:15").to_pydatetime(),
+                closed_right=True,
+            ),
+            count_observations=True,
+        )
+        assert df.groupby(Df.DATASTREAM_ID).size().to_dict() == {8000: 300, 8001: 300, 8002: 300}
+        assert df[Df.TIME].min() == pd.Timestamp("2024-01-01 00:10:01")
+
+    def test_batch_patches(self, server):
+        df = server.store.observations.iloc[::7].rename(columns={"@iot.id": Df.IOT_ID})
+        df[Df.QC_FLAG] = get_flags(df.shape[0], QualityFlags.BAD)
+        # with retries on the injected failures
+        server.batch_failure_rate = 0.3
+        with PatchWriter(server.url + "/$batch", batch_size=50, backoff=0.0, max_retries=10) as writer:
+            counter = writer.submit(df).result()
+        assert counter == Counter({200: df.shape[0]})
+        assert server.counts["failed"] > 0
+        flags = server.store.observations["resultQuality"]
+        assert (flags.loc[df[Df.IOT_ID]] == 4).all()
+        assert (flags.sum()) == 4 * df.shape[0]
+
+    def test_patch_qc_flags_features(self, server):
+        df = pd.DataFrame(
+            {
+                Df.FEATURE_ID: server.store.features.index[:10],
+                Df.FEATURE_QC_FLAG: get_flags(10, QualityFlags.PROBABLY_GOOD),
+            }
+        )
+        df.loc[10] = [99, QualityFlags.PROBABLY_GOOD]
+        counter = patch_qc_flags(
+            df,
+            url=server.url + "/$batch",
+            columns=[Df.FEATURE_ID, Df.FEATURE_QC_FLAG],
+            url_entity=Entities.FEATURESOFINTEREST,
+            json_body_template='{"properties": {"resultQuality": "{value}"}}',
+        )
+        assert counter == Counter({200: 10, 404: 1})
+        assert server.store.features["resultQuality"].iloc[:10].eq(2).all()
+        assert server.store.features["resultQuality"].iloc[10:].eq(0).all()
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from df_qc_tools.qc import calc_gradient_results
+from omegaconf import OmegaConf
+from pandassta.df import Df
+
+from gradient import calc_gradients, get_previous_samples
+from obs_cache import ObservationCache
+
+
+@pytest.fixture
+def df_observations() -> pd.DataFrame:
+    rng = np.random.default_rng(21)
+    nb = 3000
+    df = pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(nb) + 1,
+            Df.DATASTREAM_ID: rng.choice([4, 5, 6, 7], nb),
+            Df.TIME: pd.Timestamp("2024-03-01")
+            + pd.to_timedelta(np.sort(rng.integers(0, 24 * 3600, nb)), "s"),
+            Df.RESULT: rng.normal(15.0, 3.0, nb),
+        },
+        index=rng.permutation(nb) * 2,
+    )
+    # a datastream with a single observation
+    df.loc[df[Df.TIME].idxmin(), Df.DATASTREAM_ID] = 99
+    return df
+
+
+class TestGradient:
+    def test_as_library(self, df_observations):
+        pdt.assert_series_equal(
+            calc_gradients(df_observations),
+            calc_gradient_results(df_observations, Df.DATASTREAM_ID)[Df.GRADIENT],
+            check_dtype=False,
+        )
+
+    def test_previous_samples(self, df_observations):
+        t_split = pd.Timestamp("2024-03-01 12:00")
+        bool_before = df_observations[Df.TIME] < t_split
+        df_before = df_observations.loc[bool_before]
+        df_after = df_observations.loc[~bool_before]
+        gradient_ref = calc_gradients(df_observations).loc[df_after.index]
+
+        gradient_no_previous = calc_gradients(df_after)
+        gradient_out = calc_gradients(df_after, df_previous=df_before)
+        pdt.assert_series_equal(gradient_out, gradient_ref)
+        # only the first observation of each datastream changes
+        bool_diff = ~np.isclose(gradient_no_previous, gradient_ref, equal_nan=True)
+        assert bool_diff.sum() == 4
+
+    def test_get_previous_samples(self, df_observations):
+        df_after = df_observations.loc[df_observations[Df.TIME] >= "2024-03-01 12:00"]
+        df_previous = get_previous_samples(df_after, df_observations)
+        assert sorted(df_previous[Df.DATASTREAM_ID]) == [4, 5, 6, 7]
+        for _, row_i in df_previous.iterrows():
+            df_ds = df_observations.loc[
+                df_observations[Df.DATASTREAM_ID] == row_i[Df.DATASTREAM_ID]
+            ]
+            t_first = df_after.loc[
+                df_after[Df.DATASTREAM_ID] == row_i[Df.DATASTREAM_ID], Df.TIME
+            ].min()
+            assert row_i[Df.TIME] == df_ds.loc[df_ds[Df.TIME] < t_first, Df.TIME].max()
+
+    def test_previous_from_cache(self, df_observations, tmp_path):
+        from src.main import get_previous_observations
+
+        cfg = OmegaConf.create(
+            {
+                "data_api": {"things": {"id": 1}},
+                "other": {"cache": {"path": str(tmp_path), "gradient_lookback": "1h"}},
+            }
+        )
+        t_split = pd.Timestamp("2024-03-01 12:00")
+        bool_before = df_observations[Df.TIME] < t_split
+        ObservationCache(tmp_path, thing_id=1).write(
+            df_observations.loc[bool_before],
+            pd.Timestamp("2024-02-29").to_pydatetime(),
+            t_split.to_pydatetime(),
+            None,
+        )
+        df_after = df_observations.loc[~bool_before]
+        df_previous = get_previous_observations(cfg, df_after)
+        assert df_previous[Df.TIME].min() > t_split - pd.Timedelta("2h")
+        assert df_previous[Df.DATASTREAM_ID].is_unique
+        pdt.assert_series_equal(
+            calc_gradients(df_after, df_previous),
+            calc_gradients(df_observations).loc[df_after.index],
+        )
@@ -0,0 +1,264 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+import pandas.testing as pdt
+import pytest
+from omegaconf import OmegaConf
+from pandassta import sta_requests
+from pandassta.sta_requests import config, get_all_data, set_dryrun_var, set_sta_url
+
+from benchmarks.frost_server import FrostServer, FrostStore
+from benchmarks.synthetic import get_cfg, get_response, write_resources
+from fetch_session import FetchSession, RequestLimiter
+from historical import (
+    Progress,
+    get_historical_window,
+    get_shard_cfg,
+    get_shard_fetch_ranges,
+    get_shard_ranges,
+    run_historical,
+)
+from metrics import RunMetrics
+
+FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+@pytest.fixture(scope="module")
+def response() -> dict:
+    return get_response(3, 2400, fraction_outliers=1e-2)
+
+
+def get_cfg_historical(
+    url: str,
+    window: str,
+    end: str = "2024-01-01 00:40:00",
+    shards: int = 1,
+    zscore_window: str = "60min",
+    zscore_limit: float = 5.0,
+) -> OmegaConf:
+    cfg = get_cfg(3)
+    for qc_i in cfg.QC:
+        qc_i.zscore = [-zscore_limit, zscore_limit]
+    cfg.merge_with(
+        {
+            "data_api": {
+                "base_url": url,
+                "dry_run": False,
+                "filter": {
+                    "phenomenonTime": {
+                        "format": FORMAT,
+                        "range": ["2023-12-31 23:59:59", end],
+                    },
+                },
+            },
+            "reset": {
+                "overwrite_flags": False,
+                "observation_flags": False,
+                "feature_flags": False,
+                "exit": False,
+            },
+            "other": {"count_observations": False, "write_flags_to_json": False},
+            "historical": {"window": window, "shards": shards, "max_requests": 2},
+            "QC_global": {"zscore": {"time_window": zscore_window}},
+        }
+    )
+    return cfg
+
+
+def run_server(response: dict, window: str, tmp_path, monkeypatch, **kwargs) -> tuple:
+    write_resources(tmp_path.joinpath("resources"))
+    tmp_path.joinpath("outputs").mkdir()
+    monkeypatch.chdir(tmp_path)
+    with FrostServer(FrostStore.from_response(response)) as server:
+        metrics = RunMetrics()
+        cfg = get_cfg_historical(server.url, window, **kwargs)
+        nb_patched = run_historical(cfg, metrics=metrics)
+        observations = server.store.observations.copy()
+    return nb_patched, observations, metrics
+
+
+class TestHistorical:
+    def test_get_historical_window(self):
+        assert get_historical_window(OmegaConf.create({})) == "6h"
+        assert get_historical_window(OmegaConf.create({"historical": {"window": "1h"}})) == "1h"
+
+    def test_windows_eq_single(self, response, tmp_path, monkeypatch, caplog):
+        nb_ref, observations_ref, _ = run_server(
+            response, "2h", tmp_path.joinpath("single"), monkeypatch
+        )
+        with caplog.at_level(logging.INFO, logger="historical"):
+            nb_patched, observations, metrics = run_server(
+                response, "10min", tmp_path.joinpath("windows"), monkeypatch
+            )
+        # the flags at the seams are the ones of a single window
+        pdt.assert_frame_equal(observations, observations_ref)
+        assert observations["resultQuality"].ne(0).all()
+        assert nb_patched == nb_ref == observations.shape[0]
+        assert metrics.stages["fetch"].calls == 5
+        # each observation is fetched once
+        assert metrics.stages["fetch"].rows_out == observations.shape[0]
+        assert "Window 5/5" in caplog.text
+        assert "observations/s" in caplog.text
+
+    def test_failed_patches_retried(self, response, tmp_path, monkeypatch):
+        write_resources(tmp_path.joinpath("resources"))
+        tmp_path.joinpath("outputs").mkdir()
+        monkeypatch.chdir(tmp_path)
+        with FrostServer(FrostStore.from_response(response), batch_failure_rate=1.0) as server:
+            cfg = get_cfg_historical(server.url, "10min")
+            cfg.merge_with(
+                {
+                    "other": {"cache": {"path": str(tmp_path.joinpath("cache"))}},
+                    "data_api": {"patch": {"max_retries": 0, "backoff": 0.0}},
+                }
+            )
+            assert run_historical(cfg) == 0
+            assert server.store.observations["resultQuality"].eq(0).all()
+            # the cache kept the flags of the database, they are patched again
+            server.batch_failure_rate = 0.0
+            nb_patched = run_historical(cfg)
+            observations = server.store.observations.copy()
+        assert nb_patched == observations.shape[0]
+        assert observations["resultQuality"].ne(0).all()
+
+    def test_progress(self):
+        progress = Progress([(datetime(2024, 1, 1), datetime(2024, 1, 2))], 4)
+        progress.update(datetime(2024, 1, 1, 6), 100)
+        assert progress.get_fraction() == 0.25
+        assert (progress.windows, progress.observations) == (1, 100)
+        assert progress.observations_per_s > 0
+        assert Progress([(datetime(2024, 1, 1), datetime(2024, 1, 1))], 0).get_fraction() == 1.0
+
+    def test_progress_shards(self):
+        progress = Progress(
+            [(datetime(2024, 1, 1), datetime(2024, 1, 2)), (datetime(2024, 1, 2), datetime(2024, 1, 3))], 8
+        )
+        # a window in the margin before a shard
+        progress.update(datetime(2024, 1, 1, 18), 10, shard=1)
+        assert progress.get_fraction() == 0.0
+        progress.update(datetime(2024, 1, 2, 12), 10, shard=1)
+        progress.update(datetime(2024, 1, 1, 12), 10, shard=0)
+        assert progress.get_fraction() == 0.5
+
+
+class TestShards:
+    def test_get_shard_ranges(self):
+        t0, t1 = datetime(2024, 1, 1), datetime(2024, 1, 1, 10)
+        ranges = get_shard_ranges(t0, t1, "1h", 3)
+        assert ranges == [
+            (t0, datetime(2024, 1, 1, 3)),
+            (datetime(2024, 1, 1, 3), datetime(2024, 1, 1, 7)),
+            (datetime(2024, 1, 1, 7), t1),
+        ]
+        # at most a shard per window
+        assert len(get_shard_ranges(t0, datetime(2024, 1, 1, 2), "1h", 4)) == 2
+        assert get_shard_ranges(t0, t1, "1h", 1) == [(t0, t1)]
+
+    def test_get_shard_fetch_ranges(self):
+        cfg = get_cfg(3)
+        t0, t1 = datetime(2024, 1, 1), datetime(2024, 1, 1, 10)
+        fetch_ranges = get_shard_fetch_ranges(cfg, get_shard_ranges(t0, t1, "1h", 2))
+        # 60 min z-score window (lookback and horizon) and the next sample
+        assert fetch_ranges == [
+            (t0, datetime(2024, 1, 1, 6, 1)),
+            (datetime(2024, 1, 1, 4), t1),
+        ]
+
+    def test_get_shard_cfg(self):
+        cfg = get_cfg_historical("http://sta", "1h")
+        cfg.merge_with(
+            {
+                "other": {"cache": {"path": "outputs/cache"}},
+                "QC_global": {"zscore": {"method": "online", "state": "outputs/zscore.parquet"}},
+            }
+        )
+        cfg_shard = get_shard_cfg(cfg, (datetime(2024, 1, 1), datetime(2024, 1, 1, 1)))
+        assert cfg_shard["data_api"]["filter"]["phenomenonTime"]["range"] == [
+            "2024-01-01 00:00:00",
+            "2024-01-01 01:00:00",
+        ]
+        # no files shared by the shard processes
+        assert cfg_shard["other"]["cache"] is None
+        assert cfg_shard["QC_global"]["zscore"]["state"] is None
+        assert cfg_shard["QC_global"]["zscore"]["method"] == "online"
+
+    def test_shards_eq_serial(self, tmp_path, monkeypatch, caplog):
+        response = get_response(3, 3 * 3600, fraction_outliers=1e-2)
+        # 60 min z-score window (lookback and horizon), shards of 60 min, many
+        # flags near the z-score limits
+        kwargs = {"end": "2024-01-01 03:00:00", "zscore_limit": 2.5}
+        # single window
+        _, observations_ref, _ = run_server(
+            response, "3h", tmp_path.joinpath("serial"), monkeypatch, **kwargs
+        )
+        with caplog.at_level(logging.INFO, logger="historical"):
+            nb_patched, observations, metrics = run_server(
+                response, "40min", tmp_path.joinpath("shards"), monkeypatch, shards=3, **kwargs
+            )
+        # the flags at the seams of the shards and windows are the ones of the
+        # single pass
+        pdt.assert_frame_equal(observations, observations_ref)
+        assert observations["resultQuality"].ne(0).all()
+        # each observation is patched once, the margins are fetched twice
+        assert nb_patched == observations.shape[0]
+        assert metrics.stages["fetch"].rows_out > observations.shape[0]
+        assert metrics.get_total().requests
+        assert "Shard 2 done" in caplog.text
+
+
+class TestRequestLimiter:
+    def test_limit(self, response, tmp_path):
+        config.filename = tmp_path.joinpath(".staconf.ini")
+        semaphore = threading.BoundedSemaphore(1)
+        running, max_running = [0], [0]
+        lock = threading.Lock()
+
+        class Semaphore:
+            def __enter__(self):
+                semaphore.acquire()
+                with lock:
+                    running[0] += 1
+                    max_running[0] = max(max_running[0], running[0])
+                time.sleep(0.01)
+
+            def __exit__(self, *args):
+                with lock:
+                    running[0] -= 1
+                semaphore.release()
+
+        with FrostServer(FrostStore.from_response(response)) as server:
+            set_sta_url(server.url)
+            set_dryrun_var(False)
+            limiter = RequestLimiter(Semaphore(), server.url).install()
+            try:
+                threads = [
+                    threading.Thread(target=get_all_data, kwargs={"thing_id": 1, "filter_cfg": ""})
+                    for _ in range(4)
+                ]
+                for ti in threads:
+                    ti.start()
+                for ti in threads:
+                    ti.join()
+            finally:
+                limiter.uninstall()
+        assert max_running[0] == 1
+
+
+class TestFetchSession:
+    def test_install(self, response, tmp_path):
+        config.filename = tmp_path.joinpath(".staconf.ini")
+        get_with_retry = sta_requests.get_with_retry
+        with FrostServer(FrostStore.from_response(response)) as server:
+            set_sta_url(server.url)
+            set_dryrun_var(False)
+            df_ref = get_all_data(thing_id=1, filter_cfg="")
+            with FetchSession() as session:
+                assert sta_requests.get_with_retry == session.get_with_retry
+                df = get_all_data(thing_id=1, filter_cfg="")
+                # the requests went through the pool of the session
+                assert session.session.get_adapter(server.url).poolmanager.pools
+        assert sta_requests.get_with_retry is get_with_retry
+        pdt.assert_frame_equal(df, df_ref)
+        assert df.shape[0] == sum(len(di["Observations"]) for di in response["Datastreams"])
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+from omegaconf import OmegaConf
+from pandassta.df import Df
+
+from ingest import PrecisionPolicy, compact_dtypes, get_float32_error, get_precision_policy
+
+
+@pytest.fixture
+def df_observations() -> pd.DataFrame:
+    nb = 100
+    return pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(nb, dtype=np.int64) + 10_000_000,
+            Df.DATASTREAM_ID: np.repeat([8000, 8001], nb // 2).astype(np.int64),
+            Df.FEATURE_ID: np.arange(nb, dtype=np.int64) + 1_000_000,
+            Df.RESULT: np.linspace(0.0, 10.0, nb),
+            Df.OBSERVATION_TYPE: np.repeat(["temperature", "salinity"], nb // 2),
+            Df.UNITS: np.repeat(["degC", "PSU"], nb // 2),
+            Df.LONG: np.linspace(2.5, 3.0, nb),
+            Df.LAT: np.linspace(51.0, 51.5, nb),
+        }
+    )
+
+
+class TestIngest:
+    def test_get_precision_policy(self):
+        assert get_precision_policy(OmegaConf.create({"other": {}})) is None
+        policy = get_precision_policy(
+            OmegaConf.create({"other": {"ingest": {"compact": True, "coordinate_tolerance": 1.0}}})
+        )
+        assert policy == PrecisionPolicy(coordinate_tolerance=1.0)
+
+    def test_compact_dtypes(self, df_observations):
+        df_ref = df_observations.copy()
+        df = compact_dtypes(df_observations, PrecisionPolicy())
+        for ci in [Df.IOT_ID, Df.DATASTREAM_ID, Df.FEATURE_ID]:
+            assert df[ci].dtype == np.int32
+            assert (df[ci] == df_ref[ci]).all()
+        for ci in [Df.OBSERVATION_TYPE, Df.UNITS]:
+            assert isinstance(df[ci].dtype, pd.CategoricalDtype)
+            assert (df[ci].astype(str) == df_ref[ci]).all()
+        # float32 errors of about 0.2 m at 51 degrees and of the results
+        for ci in [Df.LONG, Df.LAT, Df.RESULT]:
+            assert df[ci].dtype == np.float64
+
+    def test_compact_dtypes_tolerances(self, df_observations):
+        df = compact_dtypes(
+            df_observations.copy(),
+            PrecisionPolicy(coordinate_tolerance=1.0, result_tolerance=1e-6),
+        )
+        for ci in [Df.LONG, Df.LAT, Df.RESULT]:
+            assert df[ci].dtype == np.float32
+            assert np.allclose(df[ci], df_observations[ci], rtol=0.0, atol=1e-5)
+
+    def test_compact_dtypes_exact_results(self, df_observations):
+        df_observations[Df.RESULT] = np.round(df_observations[Df.RESULT] * 4) / 4
+        df_observations.loc[3, Df.RESULT] = np.nan
+        df = compact_dtypes(df_observations, PrecisionPolicy())
+        assert df[Df.RESULT].dtype == np.float32
+        assert df[Df.RESULT].isna().sum() == 1
+
+    def test_compact_dtypes_out_of_range(self, df_observations):
+        df_observations.loc[0, Df.IOT_ID] = 2**31
+        df = compact_dtypes(df_observations, PrecisionPolicy())
+        assert df[Df.IOT_ID].dtype == np.int64
+        assert df[Df.FEATURE_ID].dtype == np.int32
+
+    def test_compact_dtypes_empty(self):
+        df = pd.DataFrame()
+        assert compact_dtypes(df, PrecisionPolicy()) is df
+
+    def test_get_float32_error(self):
+        assert get_float32_error(np.array([0.5, np.nan, 2.0])) == 0.0
+        assert get_float32_error(np.array([np.nan])) == 0.0
+        assert 0.0 < get_float32_error(np.array([0.1])) < 1e-8
@@ -0,0 +1,116 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from df_qc_tools.qc import get_bool_natural_earth_land
+from shapely.geometry import Polygon, box
+
+from land_cache import LandCache, get_bbox, get_bool_natural_earth_land_cached
+
+
+@pytest.fixture
+def path_shp(tmp_path):
+    # a large continent (clipped), an island with a lake and a far away island
+    df_land = gpd.GeoDataFrame(
+        {"featurecla": ["Land", "Land", "Land"]},
+        geometry=[
+            box(-20.0, 52.0, 40.0, 70.0),
+            Polygon(
+                [(2.0, 50.0), (4.0, 50.0), (4.0, 51.0), (2.0, 51.0)],
+                holes=[[(2.5, 50.2), (3.0, 50.2), (3.0, 50.6), (2.5, 50.6)]],
+            ),
+            box(100.0, -10.0, 110.0, 0.0),
+        ],
+        crs="EPSG:4326",
+    )
+    path_shp = tmp_path.joinpath("ne_10m_land.shp")
+    df_land.to_file(path_shp)
+    return path_shp
+
+
+@pytest.fixture
+def df_track() -> gpd.GeoDataFrame:
+    rng = np.random.default_rng(3)
+    nb = 500
+    lon = rng.uniform(1.0, 5.0, nb)
+    lat = rng.uniform(49.5, 53.0, nb)
+    return gpd.GeoDataFrame(
+        {"lat": lat, "long": lon},
+        geometry=gpd.points_from_xy(lon, lat),
+        crs="EPSG:4326",
+        index=np.arange(nb) * 3,
+    )
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    LandCache.clear()
+    yield
+    LandCache.clear()
+
+
+class TestLandCache:
+    def test_get_bbox(self, df_track):
+        assert get_bbox(df_track.geometry, margin=1.0) == (0.0, 48.0, 6.0, 54.0)
+        assert get_bbox(gpd.GeoSeries(gpd.points_from_xy([179.5], [-89.5]))) == (
+            178.0,
+            -90.0,
+            180.0,
+            -88.0,
+        )
+
+    def test_as_library(self, path_shp, df_track):
+        bool_ref = get_bool_natural_earth_land(df_track, path_shp)
+        bool_out = get_bool_natural_earth_land_cached(
+            df_track, path_shp, folder=path_shp.parent.joinpath("cache")
+        )
+        assert 0 < bool_ref.sum() < df_track.shape[0]
+        pdt.assert_series_equal(bool_out, bool_ref, check_names=False)
+
+    def test_reused_from_disk(self, path_shp, df_track, monkeypatch):
+        folder = path_shp.parent.joinpath("cache")
+        bool_ref = get_bool_natural_earth_land_cached(df_track, path_shp, folder=folder)
+        assert len(list(folder.glob("*.feather"))) == 1
+
+        # new process: the clip is read from the feather file, not the shapefile
+        LandCache.clear()
+        monkeypatch.setattr(gpd, "read_file", pytest.fail)
+        # a part of the track is within the cached bbox
+        bool_out = get_bool_natural_earth_land_cached(
+            df_track.iloc[::2], path_shp, folder=folder
+        )
+        pdt.assert_series_equal(bool_out, bool_ref.iloc[::2])
+        assert len(LandCache._memory) == 1
+
+    def test_concurrent_clip(self, path_shp, df_track):
+        folder = path_shp.parent.joinpath("cache")
+        folder.mkdir()
+        # the temporary file of another process clipping the same bbox
+        file = LandCache(path_shp, folder=folder).get_file(get_bbox(df_track.geometry))
+        file_other = file.with_suffix(".tmp")
+        file_other.write_bytes(b"partial")
+
+        assert get_bool_natural_earth_land_cached(df_track, path_shp, folder=folder).any()
+        assert file.exists()
+        assert file_other.read_bytes() == b"partial"
+        assert list(folder.glob("*.tmp")) == [file_other]
+
+    def test_updated_shapefile(self, path_shp, df_track):
+        folder = path_shp.parent.joinpath("cache")
+        assert get_bool_natural_earth_land_cached(df_track, path_shp, folder=folder).any()
+        gpd.GeoDataFrame(
+            {"featurecla": ["Land"]}, geometry=[box(100.0, -10.0, 110.0, 0.0)], crs="EPSG:4326"
+        ).to_file(path_shp)
+        assert not get_bool_natural_earth_land_cached(
+            df_track, path_shp, folder=folder
+        ).any()
+
+    def test_empty_coordinates(self, path_shp):
+        df = gpd.GeoDataFrame(
+            geometry=gpd.points_from_xy([np.nan], [np.nan]), index=pd.Index([7])
+        )
+        bool_out = get_bool_natural_earth_land_cached(
+            df, path_shp, folder=path_shp.parent.joinpath("cache")
+        )
+        pdt.assert_series_equal(bool_out, pd.Series([False], index=[7]))
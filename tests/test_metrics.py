@@ -0,0 +1,160 @@
+import json
+import time
+
+import pandas as pd
+import pytest
+import requests
+from pandassta.df import Df
+from pandassta.sta_requests import (
+    config,
+    get_all_data,
+    response_datastreams_to_df,
+    set_dryrun_var,
+    set_sta_url,
+)
+
+from benchmarks.frost_server import FrostServer, FrostStore
+from benchmarks.synthetic import get_cfg, get_response, write_resources
+from main import qc_dependent_stabilization, run_qc
+from metrics import (
+    PROMETHEUS_FILENAME,
+    REPORT_FILENAME,
+    REQUEST_COUNTER,
+    RunMetrics,
+    get_prometheus_labels,
+)
+from patching import keep_fetched_flags
+
+
+@pytest.fixture
+def request_counter():
+    REQUEST_COUNTER.install()
+    yield REQUEST_COUNTER
+    REQUEST_COUNTER.uninstall()
+
+
+class TestRunMetrics:
+    def test_stage(self):
+        metrics = RunMetrics(image_tag="v1", git_hash=None)
+        with metrics.stage("fetch") as stage:
+            stage.rows_out = 10
+        for _ in range(2):
+            with metrics.stage("range", 100):
+                time.sleep(0.01)
+        report = metrics.to_dict()
+        assert report["labels"] == {"image_tag": "v1"}
+        stages = {si["stage"]: si for si in report["stages"]}
+        assert stages["fetch"]["rows_in"] == 0
+        assert stages["fetch"]["rows_out"] == 10
+        assert stages["range"]["calls"] == 2
+        assert stages["range"]["rows_in"] == stages["range"]["rows_out"] == 200
+        assert stages["range"]["wall_s"] >= 0.02
+        assert stages["range"]["rows_per_s"] == pytest.approx(200 / stages["range"]["wall_s"])
+        assert report["total"]["wall_s"] >= stages["range"]["wall_s"]
+        assert report["max_rss_bytes"] > 2**20
+
+    def test_stage_exception(self):
+        # the time until the exception is recorded
+        metrics = RunMetrics()
+        with pytest.raises(ValueError):
+            with metrics.stage("range", 5):
+                raise ValueError
+        assert metrics.stages["range"].calls == 1
+
+    def test_merge(self):
+        metrics = RunMetrics()
+        with metrics.stage("fetch") as stage:
+            stage.rows_out = 10
+        other = RunMetrics()
+        with other.stage("fetch") as stage:
+            stage.rows_out = 5
+        with other.stage("range", 5):
+            pass
+        total = other.get_total()
+        total.requests.update({"GET": 2})
+        metrics.merge(other.stages.values(), total)
+        assert metrics.stages["fetch"].calls == 2
+        assert metrics.stages["fetch"].rows_out == 15
+        assert metrics.stages["range"].rows_in == 5
+        assert metrics.get_total().requests["GET"] >= 2
+        assert metrics.get_total().cpu_s >= total.cpu_s
+
+    def test_prometheus(self):
+        metrics = RunMetrics(image_tag='v"1')
+        with metrics.stage("range", 100):
+            pass
+        metrics.stages["range"].requests.update({"GET": 3})
+        text = metrics.to_prometheus()
+        assert "# TYPE qc_stage_wall_seconds gauge" in text
+        assert 'qc_stage_rows_in{image_tag="v\\"1",stage="range"} 100' in text
+        assert 'qc_stage_http_requests{image_tag="v\\"1",stage="range",method="GET"} 3' in text
+        assert "# TYPE qc_max_rss_bytes gauge" in text
+        assert text.endswith("\n")
+
+    def test_prometheus_labels(self):
+        assert get_prometheus_labels({}) == ""
+        assert get_prometheus_labels({"a": "x\ny"}, b=1) == '{a="x\\ny",b="1"}'
+
+    def test_write(self, tmp_path):
+        metrics = RunMetrics()
+        with metrics.stage("range", 100):
+            pass
+        paths = metrics.write(tmp_path.joinpath("outputs"))
+        assert [pi.name for pi in paths] == [REPORT_FILENAME, PROMETHEUS_FILENAME]
+        assert json.loads(paths[0].read_text())["stages"][0]["stage"] == "range"
+        assert not list(tmp_path.joinpath("outputs").glob("*.tmp"))
+
+
+class TestRequestCounter:
+    def test_requests(self, request_counter, tmp_path):
+        config.filename = tmp_path.joinpath(".staconf.ini")
+        with FrostServer(FrostStore.from_response(get_response(2, 300))) as server:
+            set_sta_url(server.url)
+            set_dryrun_var(False)
+            metrics = RunMetrics()
+            with metrics.stage("fetch") as stage:
+                df = get_all_data(thing_id=1, filter_cfg="")
+                stage.rows_out = df.shape[0]
+            with metrics.stage("patch"):
+                requests.post(server.url + "/$batch", json={"requests": []})
+        stages = metrics.stages
+        # first page and the nextLinks of 300 observations per datastream
+        assert stages["fetch"].requests == {"GET": server.counts["get"]}
+        assert stages["fetch"].rows_out == 599
+        assert stages["patch"].requests == {"POST": 1}
+        assert metrics.get_total().requests == {"GET": server.counts["get"], "POST": 1}
+
+    def test_install_once(self, request_counter):
+        send = requests.adapters.HTTPAdapter.send
+        request_counter.install()
+        assert requests.adapters.HTTPAdapter.send is send
+
+
+class TestRunQcStages:
+    def test_stages(self, tmp_path, monkeypatch):
+        write_resources(tmp_path.joinpath("resources"))
+        monkeypatch.chdir(tmp_path)
+        cfg = get_cfg(3)
+        df_all = keep_fetched_flags(response_datastreams_to_df(get_response(3, 600)))
+        df_independent = df_all.loc[df_all[Df.DATASTREAM_ID] == cfg.QC_dependent[0].independent]
+        df_all = qc_dependent_stabilization(cfg, df_all, df_independent)
+        metrics = RunMetrics()
+        run_qc(cfg, df_all, pd.Series(), metrics=metrics)
+        assert list(metrics.stages) == [
+            "gradient_calc",
+            "track",
+            "etop_file",
+            "ne_10m_shp",
+            "range",
+            "gradient",
+            "location_land",
+            "location_spacial_outlier",
+            "location_depth_ne_land",
+            "location_velocity_acceleration",
+            "merge_flags",
+            "zscore",
+            "dependent",
+        ]
+        assert metrics.stages["range"].rows_in == df_all.shape[0]
+        # once per position
+        assert metrics.stages["location_land"].rows_in == 600
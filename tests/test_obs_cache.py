@@ -0,0 +1,141 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from pandassta.df import CAT_TYPE, Df, QualityFlags
+
+from obs_cache import (
+    ObservationCache,
+    get_data_cached,
+    merge_intervals,
+    subtract_intervals,
+)
+
+
+def dt(hour: int, minute: int = 0, day: int = 1) -> datetime:
+    return datetime(2024, 1, day, hour, minute)
+
+
+@pytest.fixture
+def df_observations() -> pd.DataFrame:
+    # two days, two datastreams, one observation per minute per datastream
+    times = pd.Timestamp("2024-01-01") + pd.to_timedelta(np.arange(2 * 24 * 60), "min")
+    df = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    Df.IOT_ID: np.arange(times.size) + i * times.size,
+                    Df.DATASTREAM_ID: ds_i,
+                    Df.TIME: times,
+                    Df.RESULT: np.arange(times.size, dtype=float),
+                    Df.OBSERVATION_TYPE: pd.Categorical(["temperature"] * times.size),
+                    Df.QC_FLAG: pd.Series(
+                        QualityFlags.NO_QUALITY_CONTROL, index=range(times.size)
+                    ).astype(CAT_TYPE),
+                }
+            )
+            for i, ds_i in enumerate([10, 20])
+        ],
+        ignore_index=True,
+    )
+    return df
+
+
+class Fetcher:
+    def __init__(self, df: pd.DataFrame, datastream_ids):
+        self.df = df
+        self.datastream_ids = datastream_ids
+        self.ranges = []
+        self.nb_rows = 0
+
+    def __call__(self, t0, t1):
+        self.ranges.append((t0, t1))
+        df = self.df
+        if self.datastream_ids is not None:
+            df = df.loc[df[Df.DATASTREAM_ID].isin(self.datastream_ids)]
+        df = df.loc[(df[Df.TIME] > t0) & (df[Df.TIME] <= t1)].reset_index(drop=True)
+        self.nb_rows += df.shape[0]
+        return df
+
+
+def expected(df, t0, t1, datastream_ids=None):
+    if datastream_ids is not None:
+        df = df.loc[df[Df.DATASTREAM_ID].isin(datastream_ids)]
+    df = df.loc[(df[Df.TIME] > t0) & (df[Df.TIME] < t1)]
+    return df.sort_values(Df.TIME, kind="stable").reset_index(drop=True)
+
+
+class TestIntervals:
+    def test_merge_intervals(self):
+        assert merge_intervals([(dt(3), dt(4)), (dt(1), dt(2)), (dt(2), dt(3))]) == [
+            (dt(1), dt(4))
+        ]
+
+    def test_subtract_intervals(self):
+        covered = [(dt(1), dt(2)), (dt(3), dt(4))]
+        assert subtract_intervals(dt(0), dt(5), covered) == [
+            (dt(0), dt(1)),
+            (dt(2), dt(3)),
+            (dt(4), dt(5)),
+        ]
+        assert subtract_intervals(dt(1, 30), dt(2), covered) == []
+
+
+class TestObservationCache:
+    def test_roundtrip(self, df_observations, tmp_path):
+        cache = ObservationCache(tmp_path, thing_id=1)
+        fetch = Fetcher(df_observations, None)
+        df = get_data_cached(cache, fetch, dt(22), dt(2, day=2), None)
+        pdt.assert_frame_equal(
+            df, expected(df_observations, dt(22), dt(2, day=2)), check_categorical=False
+        )
+        assert df[Df.QC_FLAG].dtype == CAT_TYPE
+        assert cache.plan(dt(22), dt(2, day=2), [10, 20]) == []
+
+    def test_overlapping_windows(self, df_observations, tmp_path):
+        # windows of 60 min every 10 min, as the cron job
+        cache = ObservationCache(tmp_path, thing_id=1)
+        fetch = Fetcher(df_observations, [10])
+        for i in range(12):
+            t0 = pd.Timestamp("2024-01-01 06:00") + pd.Timedelta(minutes=10 * i)
+            t1 = t0 + pd.Timedelta("60min")
+            df = get_data_cached(cache, fetch, t0.to_pydatetime(), t1.to_pydatetime(), [10])
+            pdt.assert_frame_equal(
+                df, expected(df_observations, t0, t1, [10]), check_categorical=False
+            )
+        # 60 + 11 * 10 minutes fetched instead of 12 * 60
+        assert fetch.nb_rows == 170
+
+    def test_revalidate(self, df_observations, tmp_path):
+        cache = ObservationCache(tmp_path, thing_id=1, revalidate="2h")
+        fetch = Fetcher(df_observations, [10, 20])
+        get_data_cached(cache, fetch, dt(0), dt(12), [10, 20], now=dt(12))
+        assert cache.plan(dt(0), dt(12), [10, 20], now=dt(12)) == [(dt(10), dt(12))]
+        assert cache.plan(dt(0), dt(12), [10], now=dt(12)) == [(dt(10), dt(12))]
+        assert cache.plan(dt(0), dt(12), [30], now=dt(12)) == [(dt(0), dt(12))]
+
+    def test_datastream_coverage(self, df_observations, tmp_path):
+        cache = ObservationCache(tmp_path, thing_id=1)
+        get_data_cached(cache, Fetcher(df_observations, [10]), dt(0), dt(6), [10])
+        get_data_cached(cache, Fetcher(df_observations, [20]), dt(3), dt(9), [20])
+        assert cache.plan(dt(0), dt(9), [10, 20]) == [(dt(0), dt(3)), (dt(6), dt(9))]
+        # the coverage of a specific datastream is not the coverage of the thing
+        assert cache.plan(dt(0), dt(9), None) == [(dt(0), dt(9))]
+
+    def test_update_flags(self, df_observations, tmp_path):
+        cache = ObservationCache(tmp_path, thing_id=1)
+        df = get_data_cached(cache, Fetcher(df_observations, None), dt(0), dt(2), None)
+        df_patched = df.iloc[::3].copy()
+        df_patched[Df.QC_FLAG] = pd.Series(
+            QualityFlags.BAD, index=df_patched.index
+        ).astype(CAT_TYPE)
+        assert cache.update_flags(df_patched) == df_patched.shape[0]
+
+        df_cached = cache.read(dt(0), dt(2), None)
+        pdt.assert_series_equal(
+            df_cached.loc[df_cached[Df.QC_FLAG] == QualityFlags.BAD, Df.IOT_ID],
+            df_patched[Df.IOT_ID],
+            check_index=False,
+        )
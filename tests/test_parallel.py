@@ -0,0 +1,70 @@
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from df_qc_tools.qc import calc_gradient_results
+from pandassta.df import Df
+
+from gradient import get_previous_samples
+from parallel import get_shards, gradient_stage, run_per_datastream, zscore_stage
+
+
+@pytest.fixture
+def df_datastreams() -> pd.DataFrame:
+    rng = np.random.default_rng(7)
+    nb = 600
+    df = pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(nb) + 1,
+            Df.DATASTREAM_ID: rng.choice([10, 20, 30, 40, 50], nb),
+            Df.TIME: pd.Timestamp("2024-01-01")
+            + pd.to_timedelta(np.sort(rng.integers(0, 6 * 3600, nb)), "s"),
+            Df.RESULT: rng.normal(10.0, 2.0, nb),
+            Df.LAT: 51.0,
+        },
+        # non sequential index, as after filtering
+        index=np.arange(nb)[::-1] * 2,
+    )
+    return df
+
+
+class TestParallel:
+    def test_get_shards(self):
+        sizes = pd.Series({1: 100, 2: 60, 3: 50, 4: 10})
+        shards = get_shards(sizes, 2)
+        assert shards == [[1, 4], [2, 3]]
+        assert get_shards(sizes, 10) == [[1], [2], [3], [4]]
+
+    @pytest.mark.parametrize(
+        "stage", [gradient_stage, partial(zscore_stage, rolling_time_window="30min")]
+    )
+    def test_run_per_datastream(self, df_datastreams, stage):
+        series_ref = run_per_datastream(stage, df_datastreams, workers=1)
+        series_pool = run_per_datastream(stage, df_datastreams, workers=3)
+        pdt.assert_index_equal(series_ref.index, df_datastreams.index)
+        pdt.assert_series_equal(
+            series_pool.astype(float), series_ref.astype(float), check_names=False
+        )
+        assert series_ref.notna().sum() > 0.9 * df_datastreams.shape[0]
+
+    def test_gradient_previous(self, df_datastreams):
+        t_split = pd.Timestamp("2024-01-01 03:00")
+        bool_before = df_datastreams[Df.TIME] < t_split
+        df_after = df_datastreams.loc[~bool_before]
+        df_previous = get_previous_samples(df_after, df_datastreams.loc[bool_before])
+        # the previous samples are sent with the stage to the processes
+        pdt.assert_series_equal(
+            run_per_datastream(
+                partial(gradient_stage, df_previous=df_previous), df_after, workers=2
+            ),
+            run_per_datastream(gradient_stage, df_datastreams, workers=1).loc[df_after.index],
+        )
+
+    def test_gradient_as_library(self, df_datastreams):
+        pdt.assert_series_equal(
+            run_per_datastream(gradient_stage, df_datastreams, workers=2),
+            calc_gradient_results(df_datastreams, Df.DATASTREAM_ID)[Df.GRADIENT],
+            check_dtype=False,
+        )
@@ -0,0 +1,158 @@
+import threading
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+from pandassta.df import CAT_TYPE, Df, QualityFlags
+from pandassta.sta import Entities
+
+import patch_writer
+from patch_writer import STATUS_FAILED, PatchWriter, gather_futures
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, nb_responses: int = 0, body: str = "json"):
+        self.status_code = status_code
+        self.nb_responses = nb_responses
+        self.body = body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error")
+
+    def json(self):
+        if self.body == "invalid":
+            raise requests.JSONDecodeError("Expecting value", "<html>", 0)
+        if self.body == "no responses":
+            return {"message": "ok"}
+        return {"responses": [{"status": 200}] * self.nb_responses}
+
+
+class FakeSession(requests.Session):
+    def __init__(self, statuses=None):
+        super().__init__()
+        self.statuses = list(statuses or [])
+        self.bodies = []
+        self.lock = threading.Lock()
+
+    def post(self, url, json=None, **kwargs):
+        with self.lock:
+            self.bodies.append(json)
+            status = self.statuses.pop(0) if self.statuses else 200
+        if status is None:
+            raise requests.ConnectionError("connection reset")
+        if isinstance(status, str):
+            return FakeResponse(200, len(json["requests"]), body=status)
+        return FakeResponse(status, len(json["requests"]))
+
+
+@pytest.fixture(autouse=True)
+def no_dry_run(monkeypatch):
+    monkeypatch.setattr(patch_writer.config, "load_dryrun_var", lambda: False)
+
+
+@pytest.fixture
+def df_flags() -> pd.DataFrame:
+    nb = 25
+    df = pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(nb) + 100,
+            Df.FEATURE_ID: np.arange(nb) + 1000,
+            Df.QC_FLAG: pd.Categorical([QualityFlags.BAD] * nb, dtype=CAT_TYPE),
+            Df.FEATURE_QC_FLAG: pd.Categorical([QualityFlags.GOOD] * nb, dtype=CAT_TYPE),
+        },
+        index=np.arange(nb) * 3,
+    )
+    return df
+
+
+class TestPatchWriter:
+    def test_batches(self, df_flags):
+        session = FakeSession()
+        with PatchWriter("http://sta/$batch", batch_size=10, session=session) as writer:
+            counter = writer.submit(df_flags).result()
+        assert counter == Counter({200: 25})
+        assert sorted(len(bi["requests"]) for bi in session.bodies) == [5, 10, 10]
+        urls = sorted(ri["url"] for bi in session.bodies for ri in bi["requests"])
+        assert urls == sorted(f"Observations({i})" for i in df_flags[Df.IOT_ID])
+        request = session.bodies[0]["requests"][0]
+        assert request["method"] == "patch"
+        assert request["body"] == {"resultQuality": int(str(QualityFlags.BAD))}
+
+    def test_features_body(self, df_flags):
+        session = FakeSession()
+        with PatchWriter("http://sta/$batch", session=session) as writer:
+            writer.submit(
+                df_flags.iloc[:1],
+                columns=[Df.FEATURE_ID, Df.FEATURE_QC_FLAG],
+                url_entity=Entities.FEATURESOFINTEREST,
+                json_body_template='{"properties": {"resultQuality": "{value}"}}',
+            ).result()
+        request = session.bodies[0]["requests"][0]
+        assert request["url"] == "FeaturesOfInterest(1000)"
+        assert request["body"] == {"properties": {"resultQuality": int(str(QualityFlags.GOOD))}}
+
+    def test_retry(self, df_flags):
+        session = FakeSession([None, 503])
+        with PatchWriter(
+            "http://sta/$batch", max_workers=1, backoff=0.0, session=session
+        ) as writer:
+            counter = writer.submit(df_flags).result()
+        assert counter == Counter({200: 25})
+        assert len(session.bodies) == 3
+
+    def test_failed(self, df_flags):
+        session = FakeSession([401, 503, 503])
+        with PatchWriter(
+            "http://sta/$batch",
+            max_workers=1,
+            batch_size=20,
+            max_retries=1,
+            backoff=0.0,
+            session=session,
+        ) as writer:
+            counter = writer.submit(df_flags).result()
+        # no retry on 401, the second batch fails after one retry
+        assert counter == Counter({STATUS_FAILED: 25})
+        assert len(session.bodies) == 3
+
+    def test_on_done(self, df_flags):
+        session = FakeSession([200, 401])
+        done = []
+        with PatchWriter(
+            "http://sta/$batch", max_workers=1, batch_size=20, session=session
+        ) as writer:
+            counter = writer.submit(df_flags, on_done=lambda df, c: done.append((df, c))).result()
+        # called before the result, with the rows of each request
+        assert [(df_i.shape[0], c_i) for df_i, c_i in done] == [
+            (20, Counter({200: 20})),
+            (5, Counter({STATUS_FAILED: 5})),
+        ]
+        pd.testing.assert_frame_equal(done[1][0], df_flags.iloc[20:])
+        assert counter == Counter({200: 20, STATUS_FAILED: 5})
+
+    def test_invalid_body(self, df_flags, monkeypatch):
+        failed = []
+        monkeypatch.setattr(PatchWriter, "_write_failed", staticmethod(failed.append))
+        session = FakeSession(["invalid", "no responses"])
+        with PatchWriter(
+            "http://sta/$batch", max_workers=1, batch_size=10, session=session
+        ) as writer:
+            counter = writer.submit(df_flags).result()
+        # no retry, the patches of the invalid responses are written
+        assert counter == Counter({STATUS_FAILED: 20, 200: 5})
+        assert len(session.bodies) == 3
+        assert len(failed) == 2
+
+    def test_empty_and_dry_run(self, df_flags, monkeypatch):
+        session = FakeSession()
+        with PatchWriter("http://sta/$batch", session=session) as writer:
+            assert writer.submit(df_flags.iloc[:0]).result() == Counter()
+            monkeypatch.setattr(patch_writer.config, "load_dryrun_var", lambda: True)
+            assert writer.submit(df_flags).result() == Counter()
+        assert not session.bodies
+
+    def test_gather_futures(self):
+        assert gather_futures([]).result() == Counter()
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandassta.df import CAT_TYPE, Df, QualityFlags
+from pandassta.sta import Entities
+
+from patching import (
+    PatchCounter,
+    get_changed_features,
+    get_changed_observations,
+    get_fetched_column,
+    keep_fetched_flags,
+    set_fetched_flags,
+)
+
+
+@pytest.fixture
+def df_fetched() -> pd.DataFrame:
+    df = pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(6) + 1,
+            Df.FEATURE_ID: [1, 1, 2, 2, 3, 3],
+            Df.QC_FLAG: pd.Series(
+                [QualityFlags.NO_QUALITY_CONTROL] * 3 + [QualityFlags.PROBABLY_GOOD] * 3
+            ).astype(CAT_TYPE),
+            Df.FEATURE_QC_FLAG: pd.Series(
+                [QualityFlags.PROBABLY_GOOD] * 6
+            ).astype(CAT_TYPE),
+        }
+    )
+    return keep_fetched_flags(df)
+
+
+class TestPatching:
+    def test_keep_fetched_flags(self, df_fetched):
+        df_fetched[Df.QC_FLAG] = pd.Series(
+            [QualityFlags.BAD] * 6
+        ).astype(CAT_TYPE)
+        df_out = keep_fetched_flags(df_fetched)
+        assert (
+            df_out[get_fetched_column(Df.QC_FLAG)] != QualityFlags.BAD
+        ).all()
+
+    def test_keep_fetched_flags_empty(self):
+        assert keep_fetched_flags(pd.DataFrame()).empty
+
+    def test_get_changed_observations(self, df_fetched):
+        assert get_changed_observations(df_fetched).empty
+        df_fetched[Df.QC_FLAG] = pd.Series(
+            [QualityFlags.PROBABLY_GOOD] * 5 + [np.nan]
+        ).astype(CAT_TYPE)
+        df_changed = get_changed_observations(df_fetched)
+        assert df_changed[Df.IOT_ID].tolist() == [1, 2, 3, 6]
+
+    def test_get_changed_features(self, df_fetched):
+        df_fetched[Df.FEATURE_QC_FLAG] = pd.Series(
+            [QualityFlags.BAD] + [QualityFlags.PROBABLY_GOOD] * 4 + [QualityFlags.BAD]
+        ).astype(CAT_TYPE)
+        df_changed = get_changed_features(df_fetched)
+        # feature 1 keeps the flag of its last observation
+        assert df_changed[Df.FEATURE_ID].tolist() == [3]
+
+    def test_set_fetched_flags(self, df_fetched):
+        df_out = set_fetched_flags(
+            df_fetched, Df.QC_FLAG, QualityFlags.NO_QUALITY_CONTROL
+        )
+        assert df_out[get_fetched_column(Df.QC_FLAG)].dtype == CAT_TYPE
+        assert get_changed_observations(df_out)[Df.IOT_ID].tolist() == [4, 5, 6]
+
+    def test_patch_counter(self):
+        counter = PatchCounter()
+        counter.add(Entities.OBSERVATIONS, 2, 10)
+        other = PatchCounter()
+        other.add(Entities.OBSERVATIONS, 1, 5)
+        other.add(Entities.FEATURESOFINTEREST, 3, 0)
+        counter.update(other)
+        assert counter.sent[Entities.OBSERVATIONS] == 3
+        assert counter.skipped[Entities.OBSERVATIONS] == 15
+        assert counter.sent[Entities.FEATURESOFINTEREST] == 3
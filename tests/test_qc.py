@@ -28,6 +28,8 @@ from df_qc_tools.qc import (
     qc_dependent_quantity_secondary,
 )
 
+from outlier import get_bool_spacial_outlier
+
 
 @pytest.fixture
 def df_velocity_acceleration() -> gpd.GeoDataFrame:
@@ -270,7 +272,11 @@ def test_qc_region_to_flag_set_on_false(df_testing):
         ([3, 6], -1, [Df.LAT]),
     ],
 )
-def test_location_outlier(df_testing, idx, dx, columns):
+@pytest.mark.parametrize(
+    "bool_function",
+    [get_bool_spacial_outlier_compared_to_median, get_bool_spacial_outlier],
+)
+def test_location_outlier(bool_function, df_testing, idx, dx, columns):
     df_testing[Df.LONG] = df_testing.index * 0.001 + 50.0
     df_testing[Df.LAT] = df_testing.index * 0.001 + 20.0
 
@@ -282,7 +288,7 @@ def test_location_outlier(df_testing, idx, dx, columns):
         gpd.points_from_xy(df_testing[Df.LONG], df_testing[Df.LAT], crs="EPSG:4326")
     )
 
-    res = get_bool_spacial_outlier_compared_to_median(
+    res = bool_function(
         df_testing, max_dx_dt=300.0, time_window="5min"
     )
     mask = np.ma.masked_array(res, mask=res)
@@ -303,7 +309,11 @@ def test_location_outlier(df_testing, idx, dx, columns):
         ([6], Df.LONG),
     ],
 )
-def test_location_outlier_eq(df_testing, idx, column):
+@pytest.mark.parametrize(
+    "bool_function",
+    [get_bool_spacial_outlier_compared_to_median, get_bool_spacial_outlier],
+)
+def test_location_outlier_eq(bool_function, df_testing, idx, column):
     df_testing[Df.LONG] = df_testing.index * 0.001 + 50.0
     df_testing[Df.LAT] = df_testing.index * 0.001 + 20.0
 
@@ -321,7 +331,7 @@ def test_location_outlier_eq(df_testing, idx, column):
         gpd.points_from_xy(df_testing[Df.LONG], df_testing[Df.LAT], crs="EPSG:4326")
     )
 
-    res = get_bool_spacial_outlier_compared_to_median(
+    res = bool_function(
         df_testing, max_dx_dt=300.0, time_window="5min"
     )
     mask = np.ma.masked_array(res, mask=res)
@@ -340,7 +350,11 @@ def test_location_outlier_eq(df_testing, idx, column):
         ([3, 6], [Df.LONG, Df.LAT]),
     ],
 )
-def test_location_outlier_zero(df_testing, idx, columns):
+@pytest.mark.parametrize(
+    "bool_function",
+    [get_bool_spacial_outlier_compared_to_median, get_bool_spacial_outlier],
+)
+def test_location_outlier_zero(bool_function, df_testing, idx, columns):
     df_testing[Df.LONG] = df_testing.index * 0.001 + 50.0
     df_testing[Df.LAT] = df_testing.index * 0.001 + 20.0
 
@@ -352,7 +366,7 @@ def test_location_outlier_zero(df_testing, idx, columns):
         gpd.points_from_xy(df_testing[Df.LONG], df_testing[Df.LAT], crs="EPSG:4326")
     )
 
-    res = get_bool_spacial_outlier_compared_to_median(
+    res = bool_function(
         df_testing, max_dx_dt=300.0, time_window="5min"
     )
     mask = np.ma.masked_array(res, mask=res)
@@ -369,7 +383,11 @@ def test_location_outlier_zero(df_testing, idx, columns):
         ([3, 6], -1, [Df.LAT]),
     ],
 )
-def test_location_outlier_long_eq_lat(df_testing, idx, dx, columns):
+@pytest.mark.parametrize(
+    "bool_function",
+    [get_bool_spacial_outlier_compared_to_median, get_bool_spacial_outlier],
+)
+def test_location_outlier_long_eq_lat(bool_function, df_testing, idx, dx, columns):
     df_testing[Df.LONG] = df_testing.index * 0.001 + 50.0
     df_testing[Df.LAT] = df_testing.index * 0.001 + 20.0
 
@@ -385,7 +403,7 @@ def test_location_outlier_long_eq_lat(df_testing, idx, dx, columns):
         gpd.points_from_xy(df_testing[Df.LONG], df_testing[Df.LAT], crs="EPSG:4326")
     )
 
-    res = get_bool_spacial_outlier_compared_to_median(
+    res = bool_function(
         df_testing, max_dx_dt=300, time_window="5min"
     )
     mask = np.ma.masked_array(res, mask=res)
@@ -535,7 +553,11 @@ import pytest
 import pandas as pd
 from pandas.testing import assert_frame_equal
 from datetime import datetime, timedelta
-from src.main import limit_value_fctn
+from src.main import (
+    combine_df_all_w_dependency_output,
+    limit_value_fctn,
+    qc_dependent_quantities,
+)
 from pandassta.df import Df, QualityFlags
 
 
@@ -601,6 +623,73 @@ def test_limit_value_fctn():
     assert_frame_equal(result_df, expected_df)
 
 
+def limit_value_fctn_loop(group):
+    # reference: per block implementation of limit_value_fctn
+    g = (group[Df.RESULT] > group["QC_range_min"]) & (
+        group[Df.RESULT] < group["QC_range_max"]
+    )
+    group["WITHIN_LIMITS"] = g
+
+    group["dt"] = group[Df.TIME].diff().fillna(pd.Timedelta(seconds=0))
+    group["cumsum"] = (group["dt"]).cumsum()
+
+    tmp_down = group["cumsum"].where(group["WITHIN_LIMITS"])
+    tmp_down.iloc[0] = pd.Timedelta(seconds=0)
+    group["time_down"] = group["cumsum"] - tmp_down.ffill()
+
+    tmp_up = group["cumsum"].where((group["time_down"] > group["max_allowed_downtime"]))
+    tmp_up.iloc[0] = pd.Timedelta(seconds=0)
+    group["time_up_since"] = group["cumsum"] - tmp_up.ffill()
+
+    group["block_id"] = (
+        group["WITHIN_LIMITS"] != group["WITHIN_LIMITS"].shift()
+    ).cumsum()
+
+    group["max_downtime"] = pd.Timedelta(seconds=0)
+    for block_id, sub_group in group.groupby("block_id"):
+        if not sub_group["WITHIN_LIMITS"].iloc[0]:
+            max_down = sub_group["time_down"].max()
+            group.loc[sub_group.index, "max_downtime"] = max_down
+
+    group[Df.QC_FLAG] = get_qc_flag_from_bool(
+        group["time_up_since"] < group["dt_stabilization"],
+        flag_on_true=QualityFlags.BAD,
+        flag_on_false=QualityFlags.NO_QUALITY_CONTROL,
+    ).astype(CAT_TYPE)
+    return group
+
+
+@pytest.mark.parametrize("nb_datastreams", [1, 3])
+def test_limit_value_fctn_grouped_eq_loop(nb_datastreams):
+    rng = np.random.default_rng(42)
+    n = 500
+    df = pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(n * nb_datastreams),
+            Df.RESULT: rng.choice([0.0, 5.0], size=n * nb_datastreams, p=[0.2, 0.8]),
+            Df.DATASTREAM_ID: np.repeat(np.arange(nb_datastreams) + 10, n),
+            Df.TIME: pd.Timestamp("2024-01-01", tz="UTC")
+            + pd.to_timedelta(
+                np.cumsum(rng.integers(1, 600, size=n * nb_datastreams)), "s"
+            ),
+            "max_allowed_downtime": "15min",
+            "dt_stabilization": "20min",
+            "QC_range_min": 0.2,
+            "QC_range_max": 10.0,
+        }
+    ).sample(frac=1.0, random_state=1)
+
+    df_ref = (
+        df.sort_values(Df.TIME)
+        .groupby(by=[Df.DATASTREAM_ID], group_keys=False)[df.columns.tolist()]
+        .apply(limit_value_fctn_loop)
+    )
+    df_out = limit_value_fctn(df.sort_values(Df.TIME), groupby=Df.DATASTREAM_ID)
+
+    assert (df_ref["max_downtime"] > pd.Timedelta(0)).any()
+    assert_frame_equal(df_out, df_ref)
+
+
 @pytest.mark.parametrize("n", tuple(range(len(base_list_region))))
 def test_qc_dependent_quantities(df_testing, n):
     # setup ref count
@@ -976,3 +1065,71 @@ def test_qc_dependent_quantities_secondary_fct_missing_dependent(
             {"second": 2, "str": "ing", "float": 4.5},
         )
         assert out == {"first": 1, "str": "testing", "second": 2, "float": 6.8}
+
+
+def qc_dependent_quantities_loop(df, independent, dependents, range_):
+    # reference: per dependent implementation of qc_dependent_quantities
+    for dependent_i in dependents:
+        base_flags = qc_dependent_quantity_base(
+            df, independent=independent, dependent=dependent_i, dt_tolerance="0.5s"
+        )
+        df[Df.QC_FLAG] = combine_df_all_w_dependency_output(df, base_flags)
+        secondary_flags = qc_dependent_quantity_secondary(
+            df,
+            independent=independent,
+            dependent=dependent_i,
+            range_=range_,
+            dt_tolerance="0.5s",
+        )
+        df[Df.QC_FLAG] = combine_df_all_w_dependency_output(df, secondary_flags)
+    return df[Df.QC_FLAG]
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_qc_dependent_quantities_batched_eq_loop(seed):
+    rng = np.random.default_rng(seed)
+    n = 300
+    flags = np.array(list(QualityFlags), dtype=object)
+    t_indep = pd.Timestamp("2024-01-01") + pd.to_timedelta(
+        np.sort(rng.choice(2 * n, n, replace=False)), "s"
+    )
+    dfs = [
+        pd.DataFrame(
+            {
+                Df.DATASTREAM_ID: 0,
+                Df.TIME: t_indep,
+                Df.RESULT: rng.uniform(-2.0, 12.0, n),
+                Df.QC_FLAG: rng.choice(flags[[0, 1, 2, 3, -1]], n),
+            }
+        )
+    ]
+    for ds_i in [1, 2, 3]:
+        dfs.append(
+            pd.DataFrame(
+                {
+                    Df.DATASTREAM_ID: ds_i,
+                    Df.TIME: pd.Timestamp("2024-01-01")
+                    + pd.to_timedelta(
+                        np.arange(n) * 2 + rng.choice([0.0, 0.3, 0.5, 0.7], n), "s"
+                    ),
+                    Df.RESULT: rng.normal(size=n),
+                    Df.QC_FLAG: rng.choice(flags[[1, 2, -1]], n),
+                }
+            )
+        )
+    # the library functions need a RangeIndex (as df_all after the merge in run_qc)
+    df = (
+        pd.concat(dfs, ignore_index=True)
+        .sample(frac=1.0, random_state=seed)
+        .reset_index(drop=True)
+    )
+    df[Df.IOT_ID] = np.arange(df.shape[0]) + 100
+    df[Df.OBSERVATION_TYPE] = "type"
+    df[Df.QC_FLAG] = df[Df.QC_FLAG].astype(CAT_TYPE)
+
+    flags_ref = qc_dependent_quantities_loop(df.copy(), 0, [1, 2, 3], (0.0, 10.0))
+    flags_out = qc_dependent_quantities(
+        df, independent=0, dependents=[1, 2, 3], range_=(0.0, 10.0), dt_tolerance="0.5s"
+    )
+    assert (flags_ref != df[Df.QC_FLAG]).any()
+    pdt.assert_series_equal(flags_out, flags_ref, check_names=False)
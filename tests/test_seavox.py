@@ -0,0 +1,272 @@
+import os
+import threading
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from omegaconf import OmegaConf
+from pandassta.df import Df
+from pandassta.sta_requests import response_datastreams_to_df
+from searegion_detection.queryregion import DbCredentials
+
+import main
+from benchmarks.synthetic import get_cfg, get_response, write_resources
+from patching import keep_fetched_flags
+from seavox import (
+    TABLE,
+    SeaVoxRegions,
+    SeaVoxRegionsOffline,
+    get_seavox_regions,
+    open_seavox_regions,
+)
+
+
+def get_region(x, y):
+    if x < 2.0:
+        return None
+    return ("North Sea", "Southern Bight" if y < 52.0 else "Central")
+
+
+# the regions of get_region, ordered as exported
+REGIONS = [
+    ("North Sea", "Central", shapely.box(2.0, 52.0, 10.0, 60.0)),
+    ("North Sea", "Southern Bight", shapely.box(2.0, 40.0, 10.0, 52.0)),
+]
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        if params is None:
+            # export
+            self.rows = [(ri, si, memoryview(shapely.to_wkb(gi))) for ri, si, gi in REGIONS]
+            return
+        self.connection.pool.batches.append(len(params[0]))
+        # unordered, as returned by the database
+        self.rows = [
+            (i, *(get_region(x, y) or (None, None))) for i, x, y in zip(*params)
+        ][::-1]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.max_in_use = 0
+        self.closed = False
+
+    def getconn(self):
+        with self.lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        return FakeConnection(self)
+
+    def putconn(self, connection):
+        with self.lock:
+            self.in_use -= 1
+
+    def closeall(self):
+        self.closed = True
+
+
+@pytest.fixture
+def df_track() -> pd.DataFrame:
+    rng = np.random.default_rng(9)
+    nb = 300
+    df = pd.DataFrame(
+        {
+            Df.LONG: np.round(rng.uniform(1.0, 4.0, nb), 2),
+            Df.LAT: np.round(rng.uniform(51.0, 53.0, nb), 2),
+        }
+    )
+    # repeated positions
+    return pd.concat([df, df.iloc[:50]], ignore_index=True)
+
+
+class TestSeaVoxRegions:
+    def test_intersect_df_region(self, df_track):
+        pool = FakePool()
+        seavox_regions = SeaVoxRegions(pool=pool, max_workers=3, batch_size=40)
+        df_out = seavox_regions.intersect_df_region(df_track)
+
+        nb_unique = df_track.drop_duplicates().shape[0]
+        assert sum(pool.batches) == nb_unique
+        assert max(pool.batches) == 40
+        assert pool.in_use == 0
+        regions_ref = [
+            get_region(x, y) or (None, None)
+            for x, y in df_track[[Df.LONG, Df.LAT]].to_numpy()
+        ]
+        for ci, i in [(Df.REGION, 0), (Df.SUB_REGION, 1)]:
+            pd.testing.assert_series_equal(
+                df_out[ci].astype(object).where(df_out[ci].notnull(), None),
+                pd.Series([ri[i] for ri in regions_ref], name=ci, dtype=object),
+            )
+
+    def test_only_missing_regions(self, df_track):
+        pool = FakePool()
+        df_track[Df.REGION] = None
+        df_track.loc[:99, Df.REGION] = "Known"
+        df_out = SeaVoxRegions(pool=pool).intersect_df_region(df_track)
+        assert sum(pool.batches) == df_track.iloc[100:].drop_duplicates(
+            [Df.LONG, Df.LAT]
+        ).shape[0]
+        assert (df_out.loc[:99, Df.REGION] == "Known").all()
+
+    def test_nothing_to_query(self, df_track):
+        pool = FakePool()
+        df_track[Df.REGION] = "Known"
+        SeaVoxRegions(pool=pool).intersect_df_region(df_track)
+        assert pool.batches == []
+
+
+@pytest.fixture
+def path_regions(tmp_path):
+    return SeaVoxRegions(pool=FakePool()).export(tmp_path.joinpath("seavox.parquet"))
+
+
+class TestSeaVoxRegionsOffline:
+    def test_export(self, path_regions):
+        df_regions = gpd.read_parquet(path_regions)
+        assert df_regions[Df.SUB_REGION].tolist() == ["Central", "Southern Bight"]
+        assert df_regions.crs == "EPSG:4326"
+
+    def test_as_database(self, path_regions, df_track):
+        # points on the borders
+        df_track.loc[0, [Df.LONG, Df.LAT]] = [3.0, 52.0]
+        df_track.loc[1, [Df.LONG, Df.LAT]] = [2.0, 51.0]
+        df_ref = SeaVoxRegions(pool=FakePool()).intersect_df_region(df_track)
+        df_out = SeaVoxRegionsOffline(path_regions).intersect_df_region(df_track)
+        pd.testing.assert_frame_equal(df_out, df_ref)
+        assert df_out.loc[0, Df.SUB_REGION] == "Central"
+
+    def test_get_seavox_regions(self, path_regions, tmp_path, monkeypatch):
+        cfg = OmegaConf.create({"location": {"seavox": {"file": str(path_regions)}}})
+        assert isinstance(get_seavox_regions(cfg), SeaVoxRegionsOffline)
+        assert get_seavox_regions(OmegaConf.create({"location": {}})) is None
+
+        # exported once from the connection
+        monkeypatch.setattr(
+            "seavox.ThreadedConnectionPool", lambda *args, **kwargs: FakePool()
+        )
+        file = tmp_path.joinpath("resources", "regions.parquet")
+        cfg = OmegaConf.create(
+            {
+                "location": {
+                    "connection": {
+                        "database": "seavox_areas",
+                        "user": "sevox",
+                        "host": "localhost",
+                        "port": 5432,
+                        "passphrase": "ChangeMe",
+                    },
+                    "seavox": {"file": str(file)},
+                }
+            }
+        )
+        assert isinstance(get_seavox_regions(cfg), SeaVoxRegionsOffline)
+        assert file.exists()
+        cfg.location.seavox.file = None
+        assert type(get_seavox_regions(cfg)) is SeaVoxRegions
+
+
+class TestRunQcSeaVoxRegions:
+    def test_lookup_per_run(self, tmp_path, monkeypatch):
+        pools = []
+
+        def get_pool(*args, **kwargs):
+            pools.append(FakePool())
+            return pools[-1]
+
+        monkeypatch.setattr("seavox.ThreadedConnectionPool", get_pool)
+        write_resources(tmp_path.joinpath("resources"))
+        monkeypatch.chdir(tmp_path)
+        cfg = get_cfg(3)
+        cfg.location.connection = {
+            "database": "seavox_areas",
+            "user": "sevox",
+            "host": "localhost",
+            "port": 5432,
+            "passphrase": "ChangeMe",
+        }
+        df_all = keep_fetched_flags(response_datastreams_to_df(get_response(3, 300)))
+
+        # one pool for the chunks of a run, closed by the caller
+        with open_seavox_regions(cfg) as seavox_regions:
+            for _ in range(2):
+                df_out, _, _ = main.run_qc(
+                    cfg, df_all.copy(), pd.Series(), seavox_regions=seavox_regions
+                )
+            assert len(pools) == 1 and not pools[0].closed
+        assert pools[0].closed
+        assert df_out[Df.SUB_REGION].notna().any()
+
+        # without a lookup, the one created is closed, also when a stage failed
+        def fail(*args, **kwargs):
+            raise RuntimeError("stage failed")
+
+        monkeypatch.setattr(main, "get_bool_out_of_range_columns", fail)
+        with pytest.raises(RuntimeError, match="stage failed"):
+            main.run_qc(cfg, df_all.copy(), pd.Series())
+        assert len(pools) == 2 and pools[1].closed
+
+
+@pytest.mark.skipif(
+    "SEAVOX_TEST_HOST" not in os.environ,
+    reason="needs a PostGIS database, e.g. docker run -e POSTGRES_PASSWORD=ChangeMe"
+    " -p 5432:5432 postgis/postgis and SEAVOX_TEST_HOST=localhost",
+)
+def test_postgis(df_track):
+    db_credentials = DbCredentials(
+        database=os.environ.get("SEAVOX_TEST_DATABASE", "postgres"),
+        user=os.environ.get("SEAVOX_TEST_USER", "postgres"),
+        host=os.environ["SEAVOX_TEST_HOST"],
+        port=int(os.environ.get("SEAVOX_TEST_PORT", 5432)),
+        passphrase=os.environ.get("SEAVOX_TEST_PASSPHRASE", "ChangeMe"),
+    )
+    with SeaVoxRegions(db_credentials, max_workers=2, batch_size=100) as seavox_regions:
+        connection = seavox_regions.pool.getconn()
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
+            cursor.execute(f"DROP TABLE IF EXISTS {TABLE};")
+            cursor.execute(
+                f"CREATE TABLE {TABLE} (region text, sub_region text, geom geometry);"
+                f"INSERT INTO {TABLE} VALUES"
+                " ('North Sea', 'Southern Bight', ST_MakeEnvelope(2, 40, 10, 52, 4326)),"
+                " ('North Sea', 'Central', ST_MakeEnvelope(2, 52, 10, 60, 4326));"
+            )
+        connection.commit()
+        seavox_regions.pool.putconn(connection)
+
+        # the points on the shared border are in both, the first is kept
+        df_track.loc[0, [Df.LONG, Df.LAT]] = [3.0, 52.0]
+        df_out = seavox_regions.intersect_df_region(df_track)
+    bool_in = df_track[Df.LONG] >= 2.0
+    assert df_out.loc[bool_in, Df.REGION].eq("North Sea").all()
+    assert df_out.loc[~bool_in, Df.REGION].isnull().all()
+    assert df_out.loc[0, Df.SUB_REGION] == "Central"
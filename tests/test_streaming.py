@@ -0,0 +1,304 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from omegaconf import OmegaConf
+from pandassta.df import CAT_TYPE, Df, QualityFlags
+from pandassta.sta_requests import response_datastreams_to_df
+
+from benchmarks.synthetic import get_cfg, get_response, write_resources
+from main import qc_chunk
+from patching import keep_fetched_flags
+from streaming import (
+    StreamState,
+    get_chunk_ranges,
+    get_filter_time_range,
+    get_max_sampling_interval,
+    get_stream_horizon,
+    get_stream_lookback,
+    iter_prefetched,
+)
+
+
+@pytest.fixture
+def cfg_stream():
+    cfg = OmegaConf.create(
+        {
+            "location": {"time_window": "10min"},
+            "QC_global": {"zscore": {"time_window": "60min"}},
+            "QC_dependent": [
+                {"independent": 1, "dt_stabilization": "90min"},
+                {"independent": 2},
+            ],
+        }
+    )
+    return cfg
+
+
+@pytest.fixture
+def df_observations() -> pd.DataFrame:
+    nb = 600
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(nb) + 1,
+            Df.DATASTREAM_ID: np.tile([10, 20], nb // 2),
+            Df.TIME: pd.Timestamp("2024-01-01") + pd.to_timedelta(np.arange(nb), "min"),
+            Df.RESULT: rng.normal(size=nb),
+            Df.QC_FLAG: pd.Series(
+                QualityFlags.NO_QUALITY_CONTROL, index=range(nb)
+            ).astype(CAT_TYPE),
+        }
+    )
+    return df
+
+
+@pytest.fixture(scope="module")
+def df_synthetic() -> pd.DataFrame:
+    return keep_fetched_flags(response_datastreams_to_df(get_response(3, 3600)))
+
+
+@pytest.fixture
+def cfg_zscore():
+    # z-score limits close to the values of the random walks: many flags
+    # depend on the observations at the other side of a chunk boundary
+    cfg = get_cfg(3)
+    cfg.QC_global.zscore.time_window = "10min"
+    for qc_i in cfg.QC:
+        qc_i.zscore = [-2.5, 2.5]
+    return cfg
+
+
+def get_state(cfg, t0: datetime) -> StreamState:
+    return StreamState(t0, get_stream_lookback(cfg), get_stream_horizon(cfg))
+
+
+def qc_chunked(cfg, df: pd.DataFrame, chunk: str) -> pd.DataFrame:
+    t0 = df[Df.TIME].min().to_pydatetime() - pd.Timedelta("1s")
+    t1 = df[Df.TIME].max().to_pydatetime() + pd.Timedelta("1s")
+    state = get_state(cfg, t0)
+    df_final_list = []
+    ranges = get_chunk_ranges(t0, t1, chunk)
+    for i, (ti0, ti1) in enumerate(ranges):
+        times = df[Df.TIME]
+        df_new = df.loc[(times > ti0) & (times <= ti1)]
+        df_final, _ = qc_chunk(cfg, state, df_new, ti1, last=i == len(ranges) - 1)
+        df_final_list.append(df_final)
+    return (
+        pd.concat(df_final_list, ignore_index=True)
+        .sort_values([Df.TIME, Df.IOT_ID], kind="stable")
+        .reset_index(drop=True)
+    )
+
+
+def qc_centered_window(df: pd.DataFrame) -> pd.DataFrame:
+    # flag values above the centered rolling mean (depends on past and future values)
+    df = df.copy()
+    mean = (
+        df.set_index(Df.TIME)
+        .groupby(Df.DATASTREAM_ID)[Df.RESULT]
+        .rolling("20min", center=True)
+        .mean()
+        .reset_index(level=0, drop=True)
+    )
+    bool_bad = df[Df.RESULT].to_numpy() > mean.reindex(df[Df.TIME]).to_numpy() + 0.5
+    flags = np.where(bool_bad, QualityFlags.BAD, QualityFlags.PROBABLY_GOOD)
+    df[Df.QC_FLAG] = pd.Series(flags, index=df.index).astype(CAT_TYPE)
+    return df
+
+
+class TestStreaming:
+    def test_get_chunk_ranges(self):
+        t0, t1 = datetime(2024, 1, 1), datetime(2024, 1, 2, 3)
+        ranges = get_chunk_ranges(t0, t1, "6h")
+        assert len(ranges) == 5
+        assert ranges[0] == (t0, datetime(2024, 1, 1, 6))
+        assert ranges[-1] == (datetime(2024, 1, 2), t1)
+        assert all(r0[1] == r1[0] for r0, r1 in zip(ranges[:-1], ranges[1:]))
+
+    def test_get_chunk_ranges_invalid(self):
+        with pytest.raises(ValueError):
+            get_chunk_ranges(datetime(2024, 1, 1), datetime(2024, 1, 2), "0h")
+
+    def test_get_filter_time_range(self):
+        t0, t1 = datetime(2024, 1, 1), datetime(2024, 1, 2)
+        assert get_filter_time_range(t0, t1) == (
+            "phenomenonTime gt 2024-01-01T00:00:00.000000Z and "
+            "phenomenonTime lt 2024-01-02T00:00:00.000000Z"
+        )
+        assert get_filter_time_range(t0, t1, closed_right=True).endswith(
+            "phenomenonTime le 2024-01-02T00:00:00.000000Z"
+        )
+
+    def test_lookback_horizon(self, cfg_stream):
+        assert get_stream_lookback(cfg_stream) == pd.Timedelta("90min")
+        # the full z-score window: a centered MAD of a centered median
+        assert get_stream_horizon(cfg_stream) == pd.Timedelta("61min")
+
+    def test_lookback_horizon_defaults(self, cfg_stream):
+        cfg_stream.pop("QC_global")
+        cfg_stream.pop("QC_dependent")
+        assert get_stream_lookback(cfg_stream) == pd.Timedelta("60min")
+        assert get_stream_horizon(cfg_stream) == pd.Timedelta("61min")
+
+    def test_horizon_location_sampling_interval(self, cfg_stream):
+        cfg_stream.location.time_window = "3h"
+        cfg_stream.other = {"stream_sampling_interval": "5min"}
+        assert get_stream_horizon(cfg_stream) == pd.Timedelta("95min")
+
+    def test_get_max_sampling_interval(self, df_observations):
+        # a gap in datastream 10 doesn't count
+        df = df_observations.drop(index=range(100, 300, 2))
+        assert get_max_sampling_interval(df) == pd.Timedelta("2min")
+        assert get_max_sampling_interval(df.iloc[:0]) == pd.Timedelta(0)
+
+    def test_add_deduplicates(self, df_observations):
+        state = StreamState(
+            datetime(2024, 1, 1), pd.Timedelta("1h"), pd.Timedelta("10min")
+        )
+        state.tail = df_observations.iloc[:20]
+        df_chunk = state.add(df_observations.iloc[10:30].iloc[::-1])
+        assert df_chunk.shape[0] == 30
+        assert df_chunk[Df.TIME].is_monotonic_increasing
+        assert df_chunk.index.equals(pd.RangeIndex(30))
+
+    def test_finalize_tail(self, df_observations):
+        state = StreamState(
+            datetime(2024, 1, 1), pd.Timedelta("30min"), pd.Timedelta("10min")
+        )
+        df_chunk = state.add(df_observations.iloc[:120])
+        df_qc = df_chunk.copy()
+        df_qc[Df.QC_FLAG] = pd.Series(
+            QualityFlags.BAD, index=df_qc.index
+        ).astype(CAT_TYPE)
+        df_final = state.finalize(df_chunk, df_qc, datetime(2024, 1, 1, 2))
+
+        assert state.boundary == datetime(2024, 1, 1, 1, 50)
+        assert df_final[Df.TIME].max() == pd.Timestamp(state.boundary)
+        assert state.tail[Df.TIME].min() > pd.Timestamp("2024-01-01 01:20")
+        mask_final = state.tail[Df.TIME] <= pd.Timestamp(state.boundary)
+        assert (state.tail.loc[mask_final, Df.QC_FLAG] == QualityFlags.BAD).all()
+        assert (
+            state.tail.loc[~mask_final, Df.QC_FLAG] == QualityFlags.NO_QUALITY_CONTROL
+        ).all()
+
+    def test_finalize_tail_flags(self, df_observations):
+        state = StreamState(
+            datetime(2024, 1, 1), pd.Timedelta("30min"), pd.Timedelta("10min")
+        )
+        df_chunk = state.add(df_observations.iloc[:120])
+        df_qc = df_chunk.copy()
+        df_qc[Df.QC_FLAG] = pd.Series(QualityFlags.BAD, index=df_qc.index).astype(CAT_TYPE)
+        df_flags = df_qc.copy()
+        df_flags[Df.QC_FLAG] = pd.Series(
+            QualityFlags.PROBABLY_GOOD, index=df_qc.index
+        ).astype(CAT_TYPE)
+        df_final = state.finalize(
+            df_chunk, df_qc, datetime(2024, 1, 1, 2), df_flags=df_flags.iloc[::-1]
+        )
+
+        assert (df_final[Df.QC_FLAG] == QualityFlags.BAD).all()
+        mask_final = state.tail[Df.TIME] <= pd.Timestamp(state.boundary)
+        assert mask_final.any()
+        assert (
+            state.tail.loc[mask_final, Df.QC_FLAG] == QualityFlags.PROBABLY_GOOD
+        ).all()
+
+    @pytest.mark.parametrize("chunk", ["45min", "2h", "7h"])
+    def test_streaming_eq_batch(self, df_observations, chunk):
+        t0 = df_observations[Df.TIME].iloc[0].to_pydatetime()
+        t1 = df_observations[Df.TIME].iloc[-1].to_pydatetime()
+
+        state = StreamState(t0, pd.Timedelta("20min"), pd.Timedelta("15min"))
+        df_final_list = []
+        ranges = get_chunk_ranges(t0, t1, chunk)
+        for i, (ti0, ti1) in enumerate(ranges):
+            last = i == len(ranges) - 1
+            times = df_observations[Df.TIME]
+            df_new = df_observations.loc[
+                (times > ti0) & ((times <= ti1) if not last else (times < ti1))
+            ]
+            df_chunk = state.add(df_new)
+            df_final_list.append(
+                state.finalize(df_chunk, qc_centered_window(df_chunk), ti1, last=last)
+            )
+        df_stream = pd.concat(df_final_list, ignore_index=True)
+
+        times = df_observations[Df.TIME]
+        df_ref = qc_centered_window(
+            df_observations.loc[(times > t0) & (times < t1)].reset_index(drop=True)
+        )
+        assert df_stream[Df.IOT_ID].is_unique
+        pdt.assert_frame_equal(df_stream, df_ref)
+
+    def test_iter_prefetched(self):
+        out = list(iter_prefetched(lambda x: x**2, range(5)))
+        assert out == [(i, i**2) for i in range(5)]
+
+    def test_iter_prefetched_raises(self):
+        def fetch(x):
+            if x == 2:
+                raise IOError("failed")
+            return x
+
+        out = []
+        with pytest.raises(IOError):
+            for item_i, _ in iter_prefetched(fetch, range(5)):
+                out.append(item_i)
+        assert out == [0, 1]
+
+
+class TestQcChunk:
+    @pytest.fixture(autouse=True)
+    def resources(self, tmp_path, monkeypatch):
+        write_resources(tmp_path.joinpath("resources"))
+        monkeypatch.chdir(tmp_path)
+
+    @pytest.mark.parametrize("chunk", ["7min", "25min"])
+    def test_chunked_eq_single_pass(self, cfg_zscore, df_synthetic, chunk):
+        df_ref = qc_chunked(cfg_zscore, df_synthetic, "2h")
+        df_stream = qc_chunked(cfg_zscore, df_synthetic, chunk)
+
+        assert (df_ref[Df.ZSCORE].abs() > 2.5).sum() > 10
+        assert df_stream[Df.IOT_ID].is_unique
+        assert df_stream.shape[0] == df_synthetic.shape[0]
+        pdt.assert_series_equal(df_stream[Df.IOT_ID], df_ref[Df.IOT_ID])
+        for ci in [Df.QC_FLAG, Df.FEATURE_QC_FLAG]:
+            pdt.assert_series_equal(df_stream[ci], df_ref[ci])
+        pdt.assert_series_equal(df_stream[Df.ZSCORE], df_ref[Df.ZSCORE])
+
+    def test_zscore_flag_in_lookback(self, cfg_zscore, df_synthetic):
+        # the z-score flags of the first chunk don't filter the z-score input
+        # of the next one
+        t0 = df_synthetic[Df.TIME].min().to_pydatetime() - pd.Timedelta("1s")
+        state = get_state(cfg_zscore, t0)
+        t_end = t0 + pd.Timedelta("30min")
+        df_final, _ = qc_chunk(
+            cfg_zscore, state, df_synthetic.loc[df_synthetic[Df.TIME] <= t_end], t_end
+        )
+
+        flags_tail = state.tail.set_index(Df.IOT_ID)[Df.QC_FLAG]
+        df_done = df_final.loc[df_final[Df.IOT_ID].isin(flags_tail.index)]
+        bool_zscore = (df_done[Df.ZSCORE].abs() > 2.5) & (
+            flags_tail.loc[df_done[Df.IOT_ID]].to_numpy() <= QualityFlags.PROBABLY_GOOD
+        )
+        assert bool_zscore.any()
+        assert (df_done.loc[bool_zscore, Df.QC_FLAG] == QualityFlags.BAD).all()
+
+        df_ref = qc_chunked(cfg_zscore, df_synthetic, "2h")
+        df_next, _ = qc_chunk(
+            cfg_zscore,
+            state,
+            df_synthetic.loc[df_synthetic[Df.TIME] > t_end],
+            df_synthetic[Df.TIME].max().to_pydatetime() + pd.Timedelta("1s"),
+            last=True,
+        )
+        df_ref = df_ref.set_index(Df.IOT_ID).loc[df_next[Df.IOT_ID]]
+        pdt.assert_series_equal(
+            df_next.set_index(Df.IOT_ID)[Df.ZSCORE], df_ref[Df.ZSCORE]
+        )
+        pdt.assert_series_equal(
+            df_next.set_index(Df.IOT_ID)[Df.QC_FLAG], df_ref[Df.QC_FLAG]
+        )
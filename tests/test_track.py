@@ -0,0 +1,123 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from df_qc_tools.qc import get_bool_spacial_outlier_compared_to_median
+from pandassta.df import (
+    CAT_TYPE,
+    Df,
+    QualityFlags,
+    get_dt_velocity_and_acceleration_series,
+)
+
+from outlier import get_bool_spacial_outlier, get_dt_velocity_and_acceleration
+from track import Track
+
+
+@pytest.fixture
+def df_positions() -> pd.DataFrame:
+    # 3 datastreams observed at each position of the ship, in random order
+    rng = np.random.default_rng(5)
+    nb = 120
+    df_track = pd.DataFrame(
+        {
+            Df.FEATURE_ID: np.arange(nb) + 500,
+            Df.TIME: pd.Timestamp("2024-01-01") + pd.to_timedelta(np.arange(nb) * 10, "s"),
+            Df.LAT: 51.3 + np.cumsum(rng.normal(0.0, 1e-4, nb)),
+            Df.LONG: 3.0 + np.cumsum(rng.normal(0.0, 1e-4, nb)),
+        }
+    )
+    df_track.loc[[20, 70], Df.LAT] += 0.5
+    df = pd.concat(
+        [df_track.assign(**{Df.DATASTREAM_ID: ds_i}) for ds_i in [1, 2, 3]]
+    ).sample(frac=1.0, random_state=2)
+    df[Df.IOT_ID] = np.arange(df.shape[0])
+    df[Df.QC_FLAG] = pd.Categorical(
+        [QualityFlags.NO_QUALITY_CONTROL] * df.shape[0], dtype=CAT_TYPE
+    )
+    return df.set_axis(np.arange(df.shape[0]) * 2)
+
+
+class TestTrack:
+    def test_track(self, df_positions):
+        track = Track(df_positions, crs="EPSG:4326")
+        assert track.df.shape[0] == 120
+        assert track.df[Df.FEATURE_ID].is_unique
+        pdt.assert_series_equal(
+            track.broadcast(track.df[Df.FEATURE_ID]),
+            df_positions[Df.FEATURE_ID],
+            check_names=False,
+        )
+
+    def test_broadcast_subset(self, df_positions):
+        track = Track(df_positions)
+        bool_track = (track.df[Df.FEATURE_ID] % 2 == 0).iloc[::3]
+        bool_obs = track.broadcast(bool_track)
+        assert bool_obs.dtype == bool
+        assert bool_obs.shape[0] == 3 * bool_track.shape[0]
+        assert (
+            df_positions.loc[bool_obs.index, Df.FEATURE_ID].isin(
+                track.df.loc[bool_track.index, Df.FEATURE_ID]
+            )
+        ).all()
+
+    def test_on_track_once(self, df_positions):
+        calls = []
+
+        def bool_function(df):
+            calls.append(df.shape[0])
+            return df[Df.LAT] > 51.5
+
+        bool_function_track = Track(df_positions).on_track(bool_function)
+        bool_function_track(df_positions)
+        bool_obs = bool_function_track(df_positions)
+        assert calls == [120]
+        assert bool_obs.sum() == 6
+
+    def test_spacial_outlier_as_observations(self, df_positions):
+        df_obs = gpd.GeoDataFrame(
+            df_positions,
+            geometry=gpd.points_from_xy(df_positions[Df.LONG], df_positions[Df.LAT]),
+            crs="EPSG:4326",
+        )
+        bool_ref = get_bool_spacial_outlier_compared_to_median(
+            df_obs, max_dx_dt=6.89, time_window="10min"
+        )
+        track = Track(df_positions, crs="EPSG:4326")
+        bool_out = track.on_track(
+            lambda df: get_bool_spacial_outlier_compared_to_median(
+                df, max_dx_dt=6.89, time_window="10min"
+            )
+        )(df_positions)
+        assert bool_ref.sum() == 6
+        pdt.assert_series_equal(bool_out.sort_index(), bool_ref.sort_index())
+
+    def test_spacial_outlier_vectorized(self, df_positions):
+        track = Track(df_positions, crs="EPSG:4326")
+        # excluded from the medians
+        track.df.loc[[5, 50], Df.LAT] = 0.0
+        track.df.loc[[6], Df.LONG] = track.df.loc[[6], Df.LAT]
+        track.df = track.df.set_geometry(
+            gpd.points_from_xy(track.df[Df.LONG], track.df[Df.LAT], crs="EPSG:4326")
+        )
+        bool_ref = get_bool_spacial_outlier_compared_to_median(
+            track.df, max_dx_dt=6.89, time_window="10min"
+        )
+        bool_out = get_bool_spacial_outlier(track.df, max_dx_dt=6.89, time_window="10min")
+        assert bool_ref.sum() == 5
+        pdt.assert_series_equal(bool_out, bool_ref)
+
+    def test_velocity_and_acceleration_vectorized(self, df_positions):
+        track = Track(df_positions, crs="EPSG:4326")
+        # a jump within a millisecond and not in time order
+        track.df.loc[31, Df.TIME] = track.df.loc[30, Df.TIME] + pd.Timedelta("1ms")
+        df_track = track.df.sample(frac=1.0, random_state=3)
+        dt_ref, velocity_ref, acceleration_ref = get_dt_velocity_and_acceleration_series(
+            df_track
+        )
+        df_out = get_dt_velocity_and_acceleration(df_track)
+        pdt.assert_series_equal(df_out["dt"], dt_ref)
+        pdt.assert_series_equal(df_out["velocity"], velocity_ref, rtol=1e-9)
+        pdt.assert_series_equal(df_out["acceleration"], acceleration_ref, rtol=1e-6)
+        assert df_out["velocity"].notna().sum() == 119
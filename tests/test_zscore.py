@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+from omegaconf import OmegaConf
+from pandassta.df import Df
+
+from zscore import RollingZScore, get_zscore_engine
+
+
+@pytest.fixture
+def df_observations() -> pd.DataFrame:
+    rng = np.random.default_rng(12)
+    nb = 2000
+    df = pd.DataFrame(
+        {
+            Df.IOT_ID: np.arange(nb) + 1,
+            Df.DATASTREAM_ID: rng.choice([1, 2, 3], nb),
+            Df.TIME: pd.Timestamp("2024-01-01")
+            + pd.to_timedelta(np.sort(rng.integers(0, 12 * 3600, nb)), "s"),
+            Df.RESULT: rng.normal(1000.0, 2.0, nb),
+        },
+        index=np.arange(nb) * 2 + 1,
+    )
+    df.loc[df.index[::97], Df.RESULT] = np.nan
+    return df
+
+
+def get_zscore_ref(df: pd.DataFrame, time_window: str) -> pd.Series:
+    def zscore(df_):
+        roll = df_.dropna().rolling(time_window, on=Df.TIME)[Df.RESULT]
+        std = roll.std()
+        return (df_[Df.RESULT] - roll.mean()) / std.where(std > 0)
+
+    return (
+        df.groupby(Df.DATASTREAM_ID, group_keys=False)[[Df.TIME, Df.RESULT]]
+        .apply(zscore)
+        .reindex(df.index)
+    )
+
+
+class TestRollingZScore:
+    def test_as_pandas(self, df_observations):
+        zscore = RollingZScore("30min").update(df_observations)
+        pdt.assert_series_equal(
+            zscore,
+            get_zscore_ref(df_observations, "30min"),
+            check_names=False,
+            rtol=1e-8,
+        )
+        assert zscore.notna().sum() > 0.9 * df_observations.shape[0]
+
+    def test_chunks(self, df_observations, tmp_path):
+        zscore_ref = RollingZScore("30min").update(df_observations)
+        path = tmp_path.joinpath("zscore_state.parquet")
+        chunks = []
+        for t0 in pd.date_range("2024-01-01", periods=6, freq="2h"):
+            # overlapping with the previous chunk
+            bool_chunk = df_observations[Df.TIME].between(
+                t0 - pd.Timedelta("10min"), t0 + pd.Timedelta("2h"), inclusive="left"
+            )
+            engine = RollingZScore.load(path, "30min")
+            chunks.append(engine.update(df_observations.loc[bool_chunk]))
+            engine.save(path)
+            assert (
+                engine.state[Df.TIME].min()
+                > df_observations.loc[bool_chunk, Df.TIME].max() - pd.Timedelta("1h")
+            )
+        zscore_chunks = pd.concat(chunks)
+        # the observations added again have a truncated window, as streaming
+        # their first z-score is kept
+        zscore_chunks = zscore_chunks[~zscore_chunks.index.duplicated(keep="first")]
+        pdt.assert_series_equal(zscore_chunks.sort_index(), zscore_ref, rtol=1e-8)
+
+    def test_get_zscore_engine(self, df_observations, tmp_path):
+        path = tmp_path.joinpath("state", "zscore.parquet")
+        cfg = OmegaConf.create(
+            {"QC_global": {"zscore": {"time_window": "20min", "state": str(path)}}}
+        )
+        engine = get_zscore_engine(cfg)
+        assert engine.time_window == pd.Timedelta("20min") and engine.state.empty
+        engine.update(df_observations)
+        engine.save(path)
+        assert get_zscore_engine(cfg).state.shape[0] == engine.state.shape[0] > 0